@@ -27,6 +27,35 @@ except KeyError:
     pass
 
 from mapview.types import Coordinate, Bbox
-from mapview.source import MapSource
-from mapview.view import MapView, MapMarker, MapLayer, MarkerMapLayer, \
-    MapMarkerPopup
+
+# the widgets and the sources pull Kivy and the downloaders: they are
+# imported on first access (PEP 562), so `import mapview` stays cheap.
+_lazy_names = {
+    "MapSource": "mapview.source",
+    "MapView": "mapview.view",
+    "MapMarker": "mapview.view",
+    "MapLayer": "mapview.view",
+    "MarkerMapLayer": "mapview.view",
+    "MapMarkerPopup": "mapview.view"}
+
+
+def __getattr__(name):
+    module = _lazy_names.get(name)
+    if module is None:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name))
+    from importlib import import_module
+    value = globals()[name] = getattr(import_module(module), name)
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
+
+
+import sys
+if sys.version_info < (3, 7):
+    from mapview.source import MapSource
+    from mapview.view import MapView, MapMarker, MapLayer, MarkerMapLayer, \
+        MapMarkerPopup
+del sys
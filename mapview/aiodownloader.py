@@ -0,0 +1,227 @@
+# coding=utf-8
+"""
+Asyncio downloader backend
+==========================
+
+A :class:`~mapview.downloader.Downloader` fetching the tiles with aiohttp,
+from an asyncio event loop running in a dedicated thread. A single thread
+can keep hundreds of requests in flight, limited per host by the connector.
+
+The results are handed back to the Kivy Clock exactly like the thread
+backend does, and the thread pool is still used for blocking work
+(:meth:`Downloader.submit`, :meth:`Downloader.download`, cache writes).
+
+Select it before the first :class:`MapView` is created::
+
+    from mapview.downloader import Downloader
+    Downloader.BACKEND = "asyncio"
+
+or with the `MAPVIEW_DOWNLOADER_BACKEND=asyncio` environment variable.
+Requires Python 3 and aiohttp.
+"""
+
+__all__ = ["AsyncioDownloader"]
+
+from os.path import exists
+from time import time
+import asyncio
+import threading
+import traceback
+import aiohttp
+from mapview.downloader import Downloader, DEBUG, _get_request_headers, \
+    _get_meta, _read_meta, _write_meta, _write_atomic
+from mapview.retry import RetryLater
+
+
+class AsyncioDownloader(Downloader):
+    """Downloader backend based on asyncio and aiohttp.
+
+    :param int max_connections: Maximum number of concurrent requests of this
+        downloader. The asyncio downloaders are not bound by
+        :attr:`Downloader.MAX_CONCURRENCY`.
+    :param int max_per_host: Maximum number of concurrent connections to the
+        same host
+    :param float timeout: Timeout of a tile request, in seconds
+    """
+
+    MAX_CONNECTIONS = 256
+    MAX_PER_HOST = 16
+    MAX_PREFETCH = 8
+    TIMEOUT = 5
+
+    def __init__(self, max_connections=None, timeout=None, **kwargs):
+        super(AsyncioDownloader, self).__init__(**kwargs)
+        self.max_connections = max_connections or self.MAX_CONNECTIONS
+        self.timeout = timeout or self.TIMEOUT
+        self._session = None
+        self._slots = None
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._run_loop, name="mapview-downloader")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        """Close the connections and stop the event loop
+        """
+        super(AsyncioDownloader, self).stop()
+        if not self.loop.is_running():
+            return
+        asyncio.run_coroutine_threadsafe(
+            self._close_session(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+    async def _close_session(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_slots(self):
+        # created from the event loop too
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        return self._slots
+
+    def _get_session(self):
+        # the session must be created from the event loop
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                limit_per_host=self.max_per_host)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def _submit_tile(self, tile, key, attempt=0):
+        return self._submit(self._aload_tile(tile, key))
+
+    def _submit_prefetch(self, item):
+        map_source, cache_dir, zoom, tile_x, tile_y = item
+        cache_fn = map_source.get_cache_fn(zoom, tile_x, tile_y, cache_dir)
+        return self._submit(self._afetch_tile(
+            map_source, zoom, tile_x, tile_y, cache_fn, block=False))
+
+    def _submit_revalidate(self, *args):
+        self._submit(self._arevalidate_tile(*args))
+
+    def fetch_tile(self, map_source, zoom, tile_x, tile_y, cache_fn):
+        # blocking bridge for the callers living in other threads (seeding),
+        # must not be called from the event loop.
+        return self._submit(self._afetch_tile(
+            map_source, zoom, tile_x, tile_y, cache_fn)).result()
+
+    async def _aload_tile(self, tile, key):
+        cache_fn = None
+        tiles = self._inflight.get(key, [tile])
+        if any(t.state != "done" for t in tiles):
+            try:
+                cache_fn = await self._afetch_tile(
+                    tile.map_source, tile.zoom, tile.tile_x, tile.tile_y,
+                    tile.cache_fn)
+            except Exception:
+                traceback.print_exc()
+        return self._load_tile_done, (key, cache_fn)
+
+    async def _afetch_tile(self, map_source, zoom, tile_x, tile_y, cache_fn,
+                           block=True):
+        # waiting for a retry is cheap here, only the prefetch gives up
+        if exists(cache_fn):
+            self.stats.incr("cache.disk")
+            self.tracer.emit("cache-hit", map_source.cache_key, zoom, tile_x,
+                             tile_y)
+            if DEBUG:
+                print("Downloader: use cache {}".format(cache_fn))
+            meta = _read_meta(cache_fn)
+            if meta["expires"] <= time():
+                self.revalidate_tile(map_source, zoom, tile_x, tile_y,
+                                     cache_fn, meta)
+            return cache_fn
+        attempt = 0
+        while True:
+            try:
+                return await self._adownload_tile(
+                    map_source, zoom, tile_x, tile_y, cache_fn,
+                    attempt=attempt)
+            except RetryLater as e:
+                if not block:
+                    raise
+                attempt = e.attempt
+                await asyncio.sleep(e.delay)
+
+    async def _arevalidate_tile(self, map_source, zoom, tile_x, tile_y,
+                                cache_fn, meta):
+        try:
+            return await self._adownload_tile(
+                map_source, zoom, tile_x, tile_y, cache_fn, meta)
+        except RetryLater:
+            pass
+        finally:
+            with self._revalidating_lock:
+                self._revalidating.discard(cache_fn)
+
+    async def _adownload_tile(self, map_source, zoom, tile_x, tile_y,
+                              cache_fn, meta=None, attempt=0):
+        uri = map_source.get_tile_url(zoom, tile_x, tile_y)
+        policy = self.get_host_policy(uri)
+        delay = policy.get_delay()
+        if delay > 0:
+            raise RetryLater(delay, attempt)
+        headers = _get_request_headers(meta)
+        if DEBUG:
+            print("Downloader: download(tile) {}".format(uri))
+        slots = self._get_slots()
+        await slots.acquire()
+        try:
+            start = time()
+            self.tracer.emit("network-start", map_source.cache_key, zoom,
+                             tile_x, tile_y)
+            async with self._get_session().get(uri, headers=headers) as req:
+                if policy.is_retryable(req.status):
+                    return self._tile_failed(
+                        policy, uri, req.status, attempt,
+                        req.headers.get("Retry-After"))
+                policy.success()
+                if req.status == 304 and meta:
+                    if DEBUG:
+                        print("Not modified: {}".format(uri))
+                    meta = _get_meta(req.headers, meta)
+                    data = None
+                else:
+                    req.raise_for_status()
+                    meta = _get_meta(req.headers)
+                    data = await req.read()
+                self.stats.observe_since("download.latency_ms", start)
+            # the filesystem is blocking, keep it out of the event loop
+            await self.loop.run_in_executor(
+                self.executor, self._write_tile, cache_fn, data, meta)
+            if data is not None:
+                self.stats.incr("cache.network")
+                if DEBUG:
+                    print("Downloaded {} bytes: {}".format(len(data), uri))
+            return cache_fn
+        except RetryLater:
+            raise
+        except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+            return self._tile_failed(policy, uri, None, attempt, None, e)
+        except Exception as e:
+            print("Downloader error: {!r}".format(e))
+        finally:
+            slots.release()
+            self.tracer.emit("network-end", map_source.cache_key, zoom,
+                             tile_x, tile_y)
+
+    @staticmethod
+    def _write_tile(cache_fn, data, meta):
+        if data is not None:
+            _write_atomic(cache_fn, data)
+        _write_meta(cache_fn, meta)
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Tile texture atlas
+==================
+
+Pack the loaded tiles into a few large textures (pages), and draw all the
+tiles of a page with a single :class:`~kivy.graphics.Mesh`. This cuts the
+number of texture binds and draw calls from one per tile to one per page.
+
+Each page is a grid of slots of the tile size. A tile is copied into a free
+slot by rendering its texture into the page :class:`~kivy.graphics.Fbo`, and
+the mesh of the page has one quad per slot: a free slot is an empty quad,
+so adding, moving or removing a tile only rewrites its own vertices.
+"""
+
+__all__ = ["TileAtlas"]
+
+from kivy.graphics import Canvas, Fbo, Color, Mesh, Rectangle, \
+    ClearColor, ClearBuffers
+
+
+class _AtlasPage(object):
+
+    def __init__(self, size, slot_size):
+        super(_AtlasPage, self).__init__()
+        self.columns = size // slot_size
+        count = self.columns ** 2
+        self.fbo = fbo = Fbo(size=(size, size))
+        with fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+        fbo.draw()
+        fbo.clear()
+        self.vertices = [0.] * (count * 16)
+        indices = []
+        for slot in range(count):
+            i = slot * 4
+            indices.extend((i, i + 1, i + 2, i + 2, i + 3, i))
+        self.mesh = Mesh(vertices=self.vertices, indices=indices,
+                         mode="triangles", texture=self.fbo.texture)
+        self.free = list(range(count - 1, -1, -1))
+        self.tiles = {}
+        self.dirty = False
+
+
+class TileAtlas(object):
+    """Atlas of tiles, drawn by its `canvas`.
+
+    :param int slot_size: Size of a tile texture, in pixels
+    :param int page_size: Size of a page texture, in pixels
+    """
+
+    def __init__(self, slot_size=256, page_size=2048):
+        super(TileAtlas, self).__init__()
+        self.slot_size = slot_size
+        self.page_size = max(page_size, slot_size)
+        self.canvas = Canvas()
+        with self.canvas:
+            Color(1, 1, 1, 1)
+        self.pages = []
+        self._blit = Rectangle(size=(slot_size, slot_size))
+
+    def __len__(self):
+        return sum(len(page.tiles) for page in self.pages)
+
+    def __contains__(self, tile):
+        return getattr(tile, "atlas_slot", None) is not None
+
+    def add(self, tile):
+        """Copy the texture of a tile into a free slot, and return True, or
+        False if the tile cannot be packed.
+        """
+        texture = tile.texture
+        if texture is None or tile in self:
+            return False
+        if tuple(texture.size) != (self.slot_size, self.slot_size):
+            return False
+        page = None
+        for candidate in self.pages:
+            if candidate.free:
+                page = candidate
+                break
+        if page is None:
+            page = _AtlasPage(self.page_size, self.slot_size)
+            self.pages.append(page)
+            self.canvas.add(page.mesh)
+        slot = page.free.pop()
+
+        # render the texture into the slot, keeping the rest of the page
+        u, v = self._get_slot_pos(page, slot)
+        blit = self._blit
+        blit.texture = texture
+        blit.pos = (u, v)
+        page.fbo.add(blit)
+        page.fbo.draw()
+        page.fbo.remove(blit)
+        blit.texture = None
+
+        page.tiles[slot] = tile
+        tile.atlas_slot = (page, slot)
+        self.update_tile(tile)
+        return True
+
+    def remove(self, tile):
+        """Free the slot of a tile
+        """
+        if tile not in self:
+            return
+        page, slot = tile.atlas_slot
+        tile.atlas_slot = None
+        del page.tiles[slot]
+        page.free.append(slot)
+        page.vertices[slot * 16:slot * 16 + 16] = [0.] * 16
+        page.dirty = True
+
+    def update_tile(self, tile):
+        """Write the quad of a tile from its position and size
+        """
+        page, slot = tile.atlas_slot
+        size = float(self.page_size)
+        u0, v0 = self._get_slot_pos(page, slot)
+        u1 = (u0 + self.slot_size) / size
+        v1 = (v0 + self.slot_size) / size
+        u0 /= size
+        v0 /= size
+        x0, y0 = tile.pos
+        w, h = tile.size
+        x1 = x0 + w
+        y1 = y0 + h
+        offset = slot * 16
+        page.vertices[offset:offset + 16] = [
+            x0, y0, u0, v0,
+            x1, y0, u1, v0,
+            x1, y1, u1, v1,
+            x0, y1, u0, v1]
+        page.dirty = True
+
+    def update(self):
+        """Upload the vertices of the pages that changed
+        """
+        for page in self.pages:
+            if page.dirty:
+                page.dirty = False
+                page.mesh.vertices = page.vertices
+
+    def clear(self):
+        """Remove all the tiles, and release the pages
+        """
+        for page in self.pages:
+            for tile in page.tiles.values():
+                tile.atlas_slot = None
+            self.canvas.remove(page.mesh)
+        self.pages = []
+
+    def _get_slot_pos(self, page, slot):
+        return ((slot % page.columns) * self.slot_size,
+                (slot // page.columns) * self.slot_size)
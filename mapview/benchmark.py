@@ -0,0 +1,419 @@
+# coding=utf-8
+"""
+Benchmarks
+==========
+
+Measure the map engine without a display nor the network: import time,
+projections, KDBush and SuperCluster, markers repositioning, GeoJSON
+tessellation, MBTiles reads, and the downloader against a local HTTP server.
+
+Run all the benchmarks, and write the results into a json file for
+regression tracking::
+
+    python -m mapview.benchmark --output bench.json
+    python -m mapview.benchmark --quick --only projection,kdbush
+
+By default, Kivy is started headless (offscreen SDL window, mock OpenGL
+backend), so the GPU is not measured. Use `--window` to keep the Kivy
+configuration of the environment.
+"""
+
+__all__ = ["BENCHMARKS", "run", "main"]
+
+from collections import OrderedDict
+from random import Random
+from time import time
+import argparse
+import json
+import os
+import platform
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import zlib
+
+#: name -> function(quick) returning a dict of measures
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _measure(func, count=1, repeat=3):
+    # best of `repeat` runs of `func`, and the rate of `count` operations
+    best = None
+    for i in range(repeat):
+        start = time()
+        func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return {"seconds": best,
+            "per_second": count / best if best else None}
+
+
+def _png(size=256):
+    # a valid RGB png, without any imaging library
+    def chunk(tag, data):
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + \
+            struct.pack(">I", zlib.crc32(body) & 0xffffffff)
+    row = b"\x00" + b"\x80\xc0\xff" * size
+    return b"\x89PNG\r\n\x1a\n" + \
+        chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)) + \
+        chunk(b"IDAT", zlib.compress(row * size)) + \
+        chunk(b"IEND", b"")
+
+
+def _make_view():
+    from mapview import MapView
+    mapview = MapView(zoom=10, lat=48.85, lon=2.35, size=(1024, 768))
+    mapview._pause = True
+    return mapview
+
+
+_IMPORT_CODE = """
+import sys, time
+start = time.time()
+{}
+elapsed = time.time() - start
+sys.stdout.write(" ".join(["import-time", str(elapsed)] +
+                          [m for m in {!r} if m in sys.modules]) + "\\n")
+"""
+
+# statements, and the heavy modules they should not pull
+_IMPORTS = (
+    ("import kivy", ()),
+    ("import mapview", ("requests", "kivy.core.window", "mapview.view")),
+    ("from mapview.mbtsource import MBTilesMapSource",
+     ("requests", "kivy.core.window")),
+    ("from mapview import MapView", ("requests", )))
+
+
+@benchmark("import")
+def bench_import(quick):
+    # each statement in a fresh interpreter, the kivy import included
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(
+        [path] + [p for p in [env.get("PYTHONPATH")] if p])
+    results = {}
+    with open(os.devnull, "w") as devnull:
+        for statement, modules in _IMPORTS:
+            code = _IMPORT_CODE.format(statement, modules)
+            best = None
+            for i in range(1 if quick else 5):
+                output = subprocess.check_output(
+                    [sys.executable, "-c", code], env=env, stderr=devnull)
+                for line in output.decode("utf8").splitlines():
+                    if line.startswith("import-time "):
+                        words = line.split()
+                elapsed = float(words[1])
+                if best is None or elapsed < best:
+                    best = elapsed
+            results[statement] = {"seconds": best, "loaded": words[2:]}
+    return results
+
+
+@benchmark("projection")
+def bench_projection(quick):
+    from mapview import MapSource
+    source = MapSource()
+    count = 20000 if quick else 200000
+    rnd = Random(0)
+    points = [(rnd.uniform(-80, 80), rnd.uniform(-180, 180))
+              for i in range(count)]
+
+    def forward():
+        get_x = source.get_x
+        get_y = source.get_y
+        for lat, lon in points:
+            get_x(10, lon)
+            get_y(10, lat)
+
+    xy = [(source.get_x(10, lon), source.get_y(10, lat))
+          for lat, lon in points]
+
+    def inverse():
+        get_lon = source.get_lon
+        get_lat = source.get_lat
+        for x, y in xy:
+            get_lon(10, x)
+            get_lat(10, y)
+
+    return {"points": count,
+            "forward": _measure(forward, count),
+            "inverse": _measure(inverse, count)}
+
+
+def _random_markers(count, seed=0):
+    from mapview.clustered_marker_layer import Marker
+    rnd = Random(seed)
+    return [Marker(lon=rnd.uniform(-180, 180), lat=rnd.uniform(-80, 80))
+            for i in range(count)]
+
+
+@benchmark("kdbush")
+def bench_kdbush(quick):
+    from mapview.clustered_marker_layer import KDBush
+    count = 10000 if quick else 100000
+    markers = _random_markers(count)
+    tree = KDBush(markers, 64)
+    rnd = Random(1)
+    queries = [(rnd.random(), rnd.random()) for i in range(1000)]
+
+    def query_range():
+        for x, y in queries:
+            tree.range(x, y, x + .01, y + .01)
+
+    def query_within():
+        for x, y in queries:
+            tree.within(x, y, .01)
+
+    return {"points": count,
+            "build": _measure(lambda: KDBush(markers, 64), count),
+            "range": _measure(query_range, len(queries)),
+            "within": _measure(query_within, len(queries))}
+
+
+@benchmark("supercluster")
+def bench_supercluster(quick):
+    from mapview.clustered_marker_layer import SuperCluster
+    count = 5000 if quick else 50000
+    markers = _random_markers(count)
+    cluster = SuperCluster(min_zoom=0, max_zoom=16)
+    build = _measure(lambda: cluster.load(markers), count, repeat=1)
+    rnd = Random(2)
+    boxes = []
+    for i in range(200):
+        lon, lat = rnd.uniform(-170, 160), rnd.uniform(-70, 60)
+        boxes.append(((lon, lat, lon + 10, lat + 10), rnd.randint(0, 16)))
+
+    def query():
+        for bbox, zoom in boxes:
+            cluster.get_clusters(bbox, zoom)
+
+    return {"points": count,
+            "build": build,
+            "query": _measure(query, len(boxes))}
+
+
+@benchmark("markers")
+def bench_markers(quick):
+    from mapview import MapMarker
+    from mapview.view import MarkerMapLayer
+    results = {}
+    for count in ((1000, 10000) if quick else (1000, 10000, 100000)):
+        mapview = _make_view()
+        # the ordered insertion is quadratic, keep the setup short
+        layer = MarkerMapLayer(order_marker_by_latitude=False)
+        mapview.add_layer(layer)
+        rnd = Random(3)
+        for i in range(count):
+            layer.add_widget(MapMarker(
+                lat=48.85 + rnd.uniform(-.5, .5),
+                lon=2.35 + rnd.uniform(-.5, .5)))
+        results[str(count)] = _measure(layer.reposition, count)
+    return results
+
+
+def _random_geojson(count, seed=4):
+    from math import cos, sin, pi
+    rnd = Random(seed)
+    features = []
+    for i in range(count):
+        lon, lat = rnd.uniform(2, 2.7), rnd.uniform(48.6, 49.1)
+        radius = rnd.uniform(.001, .01)
+        ring = [[lon + radius * cos(a * pi / 16),
+                 lat + radius * sin(a * pi / 16) * (1 + (a % 2))]
+                for a in range(32)]
+        ring.append(ring[0])
+        features.append({
+            "type": "Feature", "properties": {"color": "#ff000088"},
+            "geometry": {"type": "Polygon", "coordinates": [ring]}})
+        features.append({
+            "type": "Feature", "properties": {"stroke-width": 2},
+            "geometry": {"type": "LineString", "coordinates": ring[:8]}})
+    return {"type": "FeatureCollection", "features": features}
+
+
+@benchmark("geojson")
+def bench_geojson(quick):
+    from mapview.geojson import GeoJsonMapLayer
+    count = 200 if quick else 2000
+    mapview = _make_view()
+
+    def load():
+        layer = GeoJsonMapLayer()
+        mapview.add_layer(layer, mode="scatter")
+        layer.geojson = _random_geojson(count)
+        mapview.remove_layer(layer)
+
+    layer = GeoJsonMapLayer()
+    mapview.add_layer(layer, mode="scatter")
+    layer.geojson = _random_geojson(count)
+    return {"features": count * 2,
+            "load": _measure(load, count * 2),
+            "reposition": _measure(layer.reposition, count * 2)}
+
+
+@benchmark("mbtiles")
+def bench_mbtiles(quick):
+    import sqlite3
+    from mapview.mbtsource import MBTilesMapSource
+    tmpdir = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(tmpdir, "bench.mbtiles")
+        db = sqlite3.connect(filename)
+        db.execute("CREATE TABLE metadata (name text, value text)")
+        db.execute("CREATE TABLE tiles (zoom_level integer, "
+                   "tile_column integer, tile_row integer, tile_data blob)")
+        db.execute("CREATE UNIQUE INDEX tile_index ON tiles "
+                   "(zoom_level, tile_column, tile_row)")
+        db.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("format", "png"), ("minzoom", "0"), ("maxzoom", "4")])
+        data = _png()
+        tiles = [(4, x, y) for x in range(16) for y in range(16)]
+        db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                       [(z, x, y, data) for z, x, y in tiles])
+        db.commit()
+        db.close()
+        if quick:
+            tiles = tiles[:64]
+
+        class Tile(object):
+            state = "loading"
+
+        source = MBTilesMapSource(filename)
+
+        def read():
+            for zoom, x, y in tiles:
+                tile = Tile()
+                tile.zoom, tile.tile_x, tile.tile_y = zoom, x, y
+                source._load_tile(tile)
+
+        return {"tiles": len(tiles), "read": _measure(read, len(tiles))}
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+@benchmark("downloader")
+def bench_downloader(quick):
+    try:
+        from http.server import HTTPServer, BaseHTTPRequestHandler
+    except ImportError:
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from mapview import MapSource
+    from mapview.downloader import Downloader
+    from mapview.retry import HostPolicy
+
+    data = _png()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Cache-Control", "max-age=3600")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    tmpdir = tempfile.mkdtemp()
+    count = 64 if quick else 512
+    tiles = [(9, x, y) for x in range(32) for y in range(count // 32)]
+    # as many requests in flight as workers
+    downloader = Downloader(cache_dir=tmpdir,
+                            max_per_host=Downloader.MAX_WORKERS)
+    host = "127.0.0.1:{}".format(server.server_port)
+    # measure the downloader, not the rate limit
+    downloader.host_policies[host] = HostPolicy()
+    try:
+        source = MapSource(
+            url="http://" + host + "/{z}/{x}/{y}.png",
+            cache_key="bench", cache_dir=tmpdir)
+
+        def fetch():
+            futures = [downloader.executor.submit(
+                downloader.fetch_tile, source, zoom, x, y,
+                source.get_cache_fn(zoom, x, y))
+                for zoom, x, y in tiles]
+            for future in futures:
+                future.result()
+
+        network = _measure(fetch, len(tiles), repeat=1)
+        cache = _measure(fetch, len(tiles))
+        return {"tiles": len(tiles), "network": network, "cache": cache}
+    finally:
+        downloader.stop()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def run(names=None, quick=False):
+    """Run the benchmarks, all of them by default, and return the results
+    """
+    import kivy
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        start = time()
+        results[name] = BENCHMARKS[name](quick)
+        results[name]["total_seconds"] = time() - start
+    return {
+        "timestamp": time(),
+        "quick": quick,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "kivy": kivy.__version__,
+        "results": results}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the map engine, without display nor network")
+    parser.add_argument("--output", default=None,
+                        help="Write the results to this json file")
+    parser.add_argument("--only", default=None,
+                        help="Comma separated benchmarks, among: {}".format(
+                            ", ".join(BENCHMARKS)))
+    parser.add_argument("--quick", action="store_true",
+                        help="Smaller datasets")
+    parser.add_argument("--window", action="store_true",
+                        help="Keep the Kivy window configuration")
+    args = parser.parse_args(argv)
+
+    names = args.only.split(",") if args.only else None
+    for name in names or ():
+        if name not in BENCHMARKS:
+            parser.error("Unknown benchmark {!r}".format(name))
+    if not args.window:
+        os.environ.setdefault("SDL_VIDEODRIVER", "offscreen")
+        os.environ.setdefault("KIVY_GL_BACKEND", "mock")
+    os.environ.setdefault("KIVY_NO_ARGS", "1")
+
+    results = run(names, args.quick)
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as fd:
+            fd.write(text)
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+# coding=utf-8
+"""
+Cache paths
+===========
+
+Path strategy of a :class:`~mapview.source.MapSource`: compute the cache
+filename of a tile, and the lookup keys usable by other cache backends.
+
+The parts of the filename that depend only on the source (cache key, image
+extension) and on the cache directory are formatted once, so a tile
+filename costs a single positional format.
+"""
+
+__all__ = ["CachePath"]
+
+from os.path import join
+from struct import Struct
+
+_key_struct = Struct(">BII")
+_length_struct = Struct(">I")
+
+
+class CachePath(object):
+    """Path strategy of a source.
+
+    :param str cache_key: Key of the source
+    :param str image_ext: Extension of the tile images
+    :param str fmt: Filename format, using `{cache_key}`, `{zoom}`,
+        `{tile_x}`, `{tile_y}` and `{image_ext}`
+    """
+
+    def __init__(self, cache_key, image_ext,
+                 fmt="{cache_key}_{zoom}_{tile_x}_{tile_y}.{image_ext}"):
+        super(CachePath, self).__init__()
+        self.cache_key = cache_key
+        self.image_ext = image_ext
+        self.fmt = fmt
+        # the length keeps the keys distinct, whatever the cache keys are
+        prefix = cache_key.encode("utf8")
+        self._prefix = _length_struct.pack(len(prefix)) + prefix
+        self._templates = {}
+
+    def get_filename(self, zoom, tile_x, tile_y, cache_dir):
+        """Return the filename of a tile within `cache_dir`
+        """
+        template = self._templates.get(cache_dir)
+        if template is None:
+            template = self._templates[cache_dir] = self._get_template(
+                cache_dir)
+        return template.format(zoom, tile_x, tile_y)
+
+    def get_key(self, zoom, tile_x, tile_y):
+        """Return an integer key of a tile, unique within the source
+        """
+        return (((zoom << 32) | tile_x) << 32) | tile_y
+
+    def get_bytes_key(self, zoom, tile_x, tile_y):
+        """Return a bytes key of a tile, unique across the sources
+        """
+        return self._prefix + _key_struct.pack(zoom, tile_x, tile_y)
+
+    def _get_template(self, cache_dir):
+        def escape(value):
+            return value.replace("{", "{{").replace("}", "}}")
+        fn = self.fmt.format(
+            cache_key=escape(self.cache_key),
+            image_ext=escape(self.image_ext),
+            zoom="{0}", tile_x="{1}", tile_y="{2}")
+        return join(escape(cache_dir), fn)
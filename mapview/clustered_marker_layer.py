@@ -6,13 +6,14 @@ Layer that support point clustering
 
 from os.path import dirname, join
 from math import sin, log, pi, atan, exp, floor, sqrt
-from mapview.view import MapLayer, MapMarker
-from kivy.lang import Builder
+from mapview.view import MapLayer, MapMarker, _load_kv_first
+from mapview.stats import stats
 from kivy.metrics import dp
-from kivy.properties import (ObjectProperty, NumericProperty, StringProperty, ListProperty)
+from kivy.properties import (ObjectProperty, NumericProperty, StringProperty, ListProperty,
+                             BooleanProperty)
 
 
-Builder.load_string("""
+_load_kv_first("""
 <ClusterMapMarker>:
     size_hint: None, None
     source: root.source
@@ -25,7 +26,7 @@ Builder.load_string("""
         size: root.size
         text: "{}".format(root.num_points)
         font_size: dp(18)
-""")
+""", "mapview/clustered_marker_layer.kv")
 
 
 # longitude/latitude to spherical mercator in [0..1] range
@@ -293,13 +294,11 @@ class SuperCluster(object):
         clusters = points
         for z in range(self.max_zoom, self.min_zoom - 1, -1):
             start = time()
-            print("build tree", z)
             self.trees[z + 1] = KDBush(clusters, self.node_size)
-            print("kdbush", (time() - start) * 1000)
+            stats.observe_since("supercluster.kdbush_ms", start)
             start = time()
             clusters = self._cluster(clusters, z)
-            print(len(clusters))
-            print("clustering", (time() - start) * 1000)
+            stats.observe_since("supercluster.cluster_ms", start)
         self.trees[self.min_zoom] = KDBush(clusters, self.node_size)
 
     def get_clusters(self, bbox, zoom):
@@ -383,6 +382,9 @@ class ClusterMapMarker(MapMarker):
 
 
 class ClusteredMarkerLayer(MapLayer):
+    # querying the clusters is slow
+    cheap = BooleanProperty(False)
+
     cluster_cls = ObjectProperty(ClusterMapMarker)
     cluster_min_zoom = NumericProperty(0)
     cluster_max_zoom = NumericProperty(16)
@@ -0,0 +1,173 @@
+# coding=utf-8
+"""
+Composite map source
+====================
+
+Stack several raster sources (a base map and its overlays) into a single
+texture per tile, so the GPU draws one quad per tile instead of one per
+source.
+
+The tiles of every layer are fetched in parallel, each one as a job of the
+downloader of its source (cache, retries, revalidation, worker budget). Once
+all of them are in, they are blended off the main thread with Pillow, and
+the result is stored in the cache until the first of the layers expires. A
+tile missing an overlay is displayed, but not stored. Requires Pillow.
+"""
+
+__all__ = ["CompositeMapSource"]
+
+from io import BytesIO
+from os.path import exists
+from time import time
+import hashlib
+import traceback
+from kivy.graphics.texture import Texture
+from mapview.source import MapSource
+from mapview.mbtsource import MBTilesMapSource
+from mapview.downloader import _read_meta, _write_meta, _write_atomic
+from mapview.trace import tracer
+try:
+    from PIL import Image as PILImage
+except ImportError:
+    PILImage = None
+
+
+class CompositeMapSource(MapSource):
+    """Blend several raster sources into one tile.
+
+    :param list layers: List of (map_source, opacity), from the bottom to the
+        top. The first one is the base map, and gives the zoom range and the
+        tile size.
+    """
+
+    def __init__(self, layers, **kwargs):
+        if PILImage is None:
+            raise ImportError("CompositeMapSource requires Pillow")
+        base = layers[0][0]
+        for source, opacity in layers:
+            if isinstance(source, MBTilesMapSource):
+                raise ValueError("Only url sources can be composited")
+        key = repr([(source.cache_key, opacity) for source, opacity in layers])
+        kwargs.setdefault("cache_dir", base.cache_dir)
+        super(CompositeMapSource, self).__init__(
+            url=base.url,
+            cache_key="composite-" + hashlib.sha224(
+                key.encode("utf8")).hexdigest()[:10],
+            min_zoom=base.min_zoom, max_zoom=base.max_zoom,
+            tile_size=base.tile_size, image_ext="png",
+            attribution=" - ".join(
+                source.attribution for source, opacity in layers
+                if source.attribution),
+            subdomains=base.subdomains, **kwargs)
+        self.layers = list(layers)
+
+    def fill_tile(self, tile):
+        if tile.state == "done":
+            return
+        self.get_downloader(tile).submit(self._load_tile, tile)
+
+    def prefetch_tiles(self, tiles, cache_dir=None, downloader=None):
+        # only the base map is worth anticipating
+        self.layers[0][0].prefetch_tiles(tiles, cache_dir, downloader)
+
+    def _load_tile(self, tile):
+        cache_fn = tile.cache_fn
+        if exists(cache_fn) and _read_meta(cache_fn)["expires"] > time():
+            return self._load_tile_done, (tile, cache_fn)
+        # missing or expired: blended again from the layers
+        return self._fetch_layers, (tile, )
+
+    def _fetch_layers(self, tile):
+        # one job per layer, no worker waits for the others
+        if tile.state == "done":
+            return
+        filenames = [None] * len(self.layers)
+        pending = [len(self.layers)]
+        for index, (source, opacity) in enumerate(self.layers):
+            source.get_downloader(tile).submit(
+                self._fetch_layer, source, tile, index, filenames, pending)
+
+    def _fetch_layer(self, source, tile, index, filenames, pending):
+        zoom, tile_x, tile_y = tile.zoom, tile.tile_x, tile.tile_y
+        fn = None
+        if source.min_zoom <= zoom <= source.max_zoom and \
+                tile.state != "done":
+            cache_fn = source.get_cache_fn(
+                zoom, tile_x, tile_y, tile.cache_dir)
+            try:
+                fn = source.get_downloader(tile).fetch_tile(
+                    source, zoom, tile_x, tile_y, cache_fn)
+            except Exception:
+                traceback.print_exc()
+        return self._fetch_layer_done, (tile, index, fn, filenames, pending)
+
+    def _fetch_layer_done(self, tile, index, fn, filenames, pending):
+        filenames[index] = fn
+        pending[0] -= 1
+        if pending[0] or tile.state == "done":
+            return
+        zoom = tile.zoom
+        complete = all(
+            fn or not source.min_zoom <= zoom <= source.max_zoom
+            for fn, (source, opacity) in zip(filenames, self.layers))
+        if not complete and exists(tile.cache_fn):
+            # an expired composite is better than a partial one
+            tile.set_source(tile.cache_fn)
+            return
+        # an overlay can be missing, but not the base map
+        if not filenames[0]:
+            tile.state = "done"
+            return
+        layers = [(fn, opacity)
+                  for fn, (source, opacity) in zip(filenames, self.layers)
+                  if fn]
+        self.get_downloader(tile).submit(
+            self._blend_tile, tile, layers, complete)
+
+    def _blend_tile(self, tile, layers, complete):
+        if tile.state == "done":
+            return
+        image = self._blend(layers)
+        if not complete:
+            # displayed, but not cached: the layer may be back later
+            return self._blend_done, (tile, image.size, image.tobytes())
+        cache_fn = tile.cache_fn
+        self._save(cache_fn, image, [fn for fn, opacity in layers])
+        return self._load_tile_done, (tile, cache_fn)
+
+    def _blend(self, layers):
+        out = None
+        for fn, opacity in layers:
+            im = PILImage.open(fn).convert("RGBA")
+            if out is None:
+                out = PILImage.new("RGBA", im.size)
+            elif im.size != out.size:
+                im = im.resize(out.size)
+            if opacity < 1:
+                im.putalpha(im.getchannel("A").point(
+                    lambda a: int(a * opacity)))
+            out = PILImage.alpha_composite(out, im)
+        return out
+
+    def _save(self, cache_fn, image, filenames):
+        # the composite expires with the first of its layers, then it is
+        # blended again from the revalidated ones
+        data = BytesIO()
+        image.save(data, "png")
+        _write_atomic(cache_fn, data.getvalue())
+        _write_meta(cache_fn, {"expires": min(
+            _read_meta(fn)["expires"] for fn in filenames)})
+
+    def _load_tile_done(self, tile, cache_fn):
+        if tile.state != "done":
+            tile.set_source(cache_fn)
+
+    def _blend_done(self, tile, size, data):
+        if tile.state == "done":
+            return
+        texture = Texture.create(size=size, colorfmt="rgba")
+        texture.blit_buffer(data, colorfmt="rgba", bufferfmt="ubyte")
+        texture.flip_vertical()
+        tile.texture = texture
+        tracer.emit_tile("decoded", tile)
+        tile.state = "need-animation"
@@ -3,14 +3,26 @@
 __all__ = ["Downloader"]
 
 from kivy.clock import Clock
-from os.path import join, exists
+from os.path import join, exists, getmtime, dirname, abspath
 from os import makedirs, environ
-from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
-from random import choice
-import requests
+from email.utils import parsedate_tz, mktime_tz
+from collections import deque
+from functools import partial
+import threading
 import traceback
-from time import time
+import json
+import os
+import re
+import tempfile
+from time import time, sleep
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
 from mapview import CACHE_DIR
+from mapview.retry import RetryLater, RetryPolicy, HostPolicy
+from mapview.stats import stats
+from mapview.trace import tracer
 
 
 DEBUG = "MAPVIEW_DEBUG_DOWNLOADER" in environ
@@ -18,35 +30,199 @@ DEBUG = "MAPVIEW_DEBUG_DOWNLOADER" in environ
 # I tried it with a simpler one (just Mozilla/5.0) this also gets rejected
 USER_AGENT = 'Kivy-garden.mapview'
 
+# freshness of a cached tile when the server doesn't tell (seconds)
+DEFAULT_MAX_AGE = 7 * 24 * 3600
+
+
+def _write_atomic(filename, data, mode="wb"):
+    # write in a temporary file, then rename it, so concurrent writers and
+    # readers never see a partial file
+    fd, tmp_fn = tempfile.mkstemp(
+        dir=dirname(filename) or ".", prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as fp:
+            fp.write(data)
+        _replace(tmp_fn, filename)
+    except Exception:
+        if exists(tmp_fn):
+            os.remove(tmp_fn)
+        raise
+
+
+_replace = getattr(os, "replace", os.rename)
+
+
+def _read_meta(cache_fn):
+    # freshness metadata of a cached tile, stored next to it
+    try:
+        with open(cache_fn + ".meta") as fd:
+            return json.load(fd)
+    except (IOError, OSError, ValueError):
+        return {"expires": getmtime(cache_fn) + DEFAULT_MAX_AGE}
+
+
+def _write_meta(cache_fn, meta):
+    _write_atomic(cache_fn + ".meta", json.dumps(meta), "w")
+
+
+def _get_meta(headers, meta=None):
+    # build the freshness metadata from the response headers, a 304 response
+    # keeps the validators of the previous one
+    meta = dict(meta or {})
+    now = time()
+    if headers.get("ETag"):
+        meta["etag"] = headers["ETag"]
+    if headers.get("Last-Modified"):
+        meta["last_modified"] = headers["Last-Modified"]
+    cache_control = headers.get("Cache-Control", "").lower()
+    max_age = re.search(r"max-age=(\d+)", cache_control)
+    expires = headers.get("Expires")
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        meta["expires"] = now
+    elif max_age:
+        meta["expires"] = now + int(max_age.group(1))
+    elif expires and parsedate_tz(expires):
+        meta["expires"] = mktime_tz(parsedate_tz(expires))
+    else:
+        meta["expires"] = now + DEFAULT_MAX_AGE
+    return meta
+
+
+def _get_request_headers(meta=None):
+    # conditional request for a cached tile with validators
+    headers = {'User-agent': USER_AGENT}
+    if meta:
+        if "etag" in meta:
+            headers["If-None-Match"] = meta["etag"]
+        if "last_modified" in meta:
+            headers["If-Modified-Since"] = meta["last_modified"]
+    return headers
+
 
 class Downloader(object):
-    _instance = None
+    # one shared downloader per cache directory
+    _instances = {}
     MAX_WORKERS = 5
+    MAX_PREFETCH = 1
     CAP_TIME = 0.064  # 15 FPS
+    # loaded tiles applied to the views per frame, the nearest to the center
+    # of their view first. Higher fills the map faster, lower keeps the
+    # frame rate.
+    MAX_APPLY = 8
+    # per host: requests per second, burst, and retries of a failed tile
+    HOST_RATE = 30.
+    HOST_BURST = 60
+    RETRIES = 3
+    # requests in flight to the same host, None for half of the workers: a
+    # slow host (ie: an overlay) leaves workers to the others
+    MAX_PER_HOST = None
+    # maximum number of requests in flight across all the thread downloaders
+    MAX_CONCURRENCY = 256
+    _slots = threading.BoundedSemaphore(MAX_CONCURRENCY)
+    # delay before trying again a request over a concurrency limit
+    BUSY_DELAY = .05
+    # backend created by instance(): "thread" or "asyncio"
+    BACKEND = environ.get("MAPVIEW_DOWNLOADER_BACKEND", "thread")
+    # see mapview.stats and mapview.trace
+    stats = stats
+    tracer = tracer
 
     @staticmethod
     def instance(cache_dir):
-        if Downloader._instance is None:
-            if not cache_dir:
-                cache_dir = CACHE_DIR
-            Downloader._instance = Downloader(cache_dir=cache_dir)
-        return Downloader._instance
+        """Return the downloader shared by everything using `cache_dir`.
+        A :class:`MapSource` or a :class:`MapView` can use their own
+        downloader instead, see their `downloader` attribute.
+        """
+        if not cache_dir:
+            cache_dir = CACHE_DIR
+        key = abspath(cache_dir)
+        downloader = Downloader._instances.get(key)
+        if downloader is None:
+            cls = Downloader.get_backend()
+            downloader = Downloader._instances[key] = cls(cache_dir=cache_dir)
+        return downloader
 
-    def __init__(self, max_workers=None, cap_time=None, **kwargs):
+    @staticmethod
+    def set_max_concurrency(count):
+        """Change the maximum number of requests in flight across all the
+        downloaders. Must be called before any download.
+        """
+        Downloader.MAX_CONCURRENCY = count
+        Downloader._slots = threading.BoundedSemaphore(count)
+
+    @staticmethod
+    def get_backend(name=None):
+        """Return the downloader class of a backend, defaults to
+        :attr:`BACKEND`. The "asyncio" backend requires aiohttp.
+        """
+        name = name or Downloader.BACKEND
+        if name == "asyncio":
+            from mapview.aiodownloader import AsyncioDownloader
+            return AsyncioDownloader
+        if name != "thread":
+            raise ValueError("Unknown downloader backend {!r}".format(name))
+        return Downloader
+
+    def __init__(self, max_workers=None, cap_time=None, max_prefetch=None,
+                 max_apply=None, max_per_host=None, **kwargs):
         self.cache_dir = kwargs.get('cache_dir', CACHE_DIR)
         if max_workers is None:
-            max_workers = Downloader.MAX_WORKERS
+            max_workers = self.MAX_WORKERS
         if cap_time is None:
-            cap_time = Downloader.CAP_TIME
+            cap_time = self.CAP_TIME
+        if max_prefetch is None:
+            max_prefetch = self.MAX_PREFETCH
+        if max_apply is None:
+            max_apply = self.MAX_APPLY
+        if max_per_host is None:
+            max_per_host = self.MAX_PER_HOST or max(1, (max_workers + 1) // 2)
         super(Downloader, self).__init__()
         self.is_paused = False
         self.cap_time = cap_time
+        self.max_prefetch = max_prefetch
+        self.max_apply = max_apply
+        self.max_per_host = max_per_host
+        # imported here with requests, offline apps never pay for them
+        from concurrent.futures import ThreadPoolExecutor
         self.executor = ThreadPoolExecutor(max_workers=max_workers)
         self._futures = []
-        Clock.schedule_interval(self._check_executor, 1 / 60.)
+        # results of the workers waiting to be applied on the main thread
+        self._ready = []
+        # key of the downloads in flight -> tiles or callbacks waiting for it
+        self._inflight = {}
+        self._prefetch_queue = deque()
+        self._prefetch_futures = []
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
+        self.host_policies = {}
+        self._host_policies_lock = threading.Lock()
+        # host policy -> requests in flight
+        self._host_active = {}
+        # the blocking callers wait here for a slot
+        self._slot_freed = threading.Condition(self._host_policies_lock)
+        self._check_event = Clock.schedule_interval(
+            self._check_executor, 1 / 60.)
         if not exists(self.cache_dir):
             makedirs(self.cache_dir)
 
+    def stop(self):
+        """Cancel the pending work, and release the workers. The downloader
+        must not be used anymore.
+        """
+        self._check_event.cancel()
+        self._prefetch_queue.clear()
+        for future in self._futures + self._prefetch_futures:
+            future.cancel()
+        self._futures = []
+        self._prefetch_futures = []
+        del self._ready[:]
+        self._inflight.clear()
+        self.executor.shutdown(wait=False)
+        instances = Downloader._instances
+        for key, downloader in list(instances.items()):
+            if downloader is self:
+                del instances[key]
+
     def submit(self, f, *args, **kwargs):
         future = self.executor.submit(f, *args, **kwargs)
         self._futures.append(future)
@@ -55,67 +231,322 @@ class Downloader(object):
         if DEBUG:
             print("Downloader: queue(tile) zoom={} x={} y={}".format(
                 tile.zoom, tile.tile_x, tile.tile_y))
-        future = self.executor.submit(self._load_tile, tile)
-        self._futures.append(future)
+        # the same file in the same cache is downloaded once
+        key = tile.cache_fn
+        waiters = self._inflight.get(key)
+        if waiters is not None:
+            # already in flight, the tile will be filled with the others
+            waiters.append(tile)
+            return
+        self._inflight[key] = [tile]
+        self._futures.append(self._submit_tile(tile, key))
+
+    def _submit_tile(self, tile, key, attempt=0):
+        # return a future resolving to (self._load_tile_done, args)
+        return self.executor.submit(self._load_tile, tile, key, attempt)
+
+    def get_host_policy(self, url):
+        """Return the :class:`~mapview.retry.HostPolicy` (rate limit,
+        retries, circuit breaker) of the host of an url. Policies can be
+        customized by setting `host_policies[host]`.
+        """
+        host = urlsplit(url).netloc
+        with self._host_policies_lock:
+            policy = self.host_policies.get(host)
+            if policy is None:
+                policy = self.host_policies[host] = HostPolicy(
+                    rate=self.HOST_RATE, burst=self.HOST_BURST,
+                    retry=RetryPolicy(retries=self.RETRIES))
+            return policy
+
+    def prefetch_tiles(self, map_source, tiles, cache_dir=None):
+        """Replace the queue of tiles to prefetch in the cache. Prefetching is
+        done in a low priority lane: at most `max_prefetch` tiles at a time,
+        and only when no visible tile is loading.
+        """
+        cache_dir = cache_dir or self.cache_dir
+        self._prefetch_queue = deque(
+            (map_source, cache_dir, zoom, tile_x, tile_y)
+            for zoom, tile_x, tile_y in tiles)
 
     def download(self, url, callback, **kwargs):
         if DEBUG:
             print("Downloader: queue(url) {}".format(url))
-        future = self.executor.submit(
-            self._download_url, url, callback, kwargs)
+        key = (url, repr(sorted(kwargs.items())))
+        callbacks = self._inflight.get(key)
+        if callbacks is not None:
+            callbacks.append(callback)
+            return
+        self._inflight[key] = [callback]
+        future = self.executor.submit(self._download_url, url, key, kwargs)
         self._futures.append(future)
 
-    def _download_url(self, url, callback, kwargs):
+    def _download_url(self, url, key, kwargs):
+        import requests
         if DEBUG:
             print("Downloader: download(url) {}".format(url))
-        r = requests.get(url, **kwargs)
-        return callback, (url, r, )
+        try:
+            r = requests.get(url, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            r = None
+        return self._download_url_done, (key, url, r)
+
+    def _download_url_done(self, key, url, r):
+        callbacks = self._inflight.pop(key, [])
+        if r is None:
+            return
+        for callback in callbacks:
+            callback(url, r)
+
+    def _load_tile(self, tile, key, attempt=0):
+        cache_fn = None
+        tiles = self._inflight.get(key, [tile])
+        if any(t.state != "done" for t in tiles):
+            try:
+                cache_fn = self._fetch_tile(
+                    tile.map_source, tile.zoom, tile.tile_x, tile.tile_y,
+                    tile.cache_fn, attempt=attempt, block=False)
+            except RetryLater as e:
+                # don't hold a worker while waiting, retry from the Clock
+                return self._retry_tile, (tile, key, e)
+            except Exception:
+                traceback.print_exc()
+        return self._load_tile_done, (key, cache_fn)
+
+    def _retry_tile(self, tile, key, e):
+        if DEBUG:
+            print("Downloader: retry(tile) zoom={} x={} y={} in {:.1f}s".format(
+                tile.zoom, tile.tile_x, tile.tile_y, e.delay))
+        Clock.schedule_once(
+            partial(self._resubmit_tile, tile, key, e.attempt), e.delay)
 
-    def _load_tile(self, tile):
-        if tile.state == "done":
+    def _resubmit_tile(self, tile, key, attempt, *largs):
+        self._futures.append(self._submit_tile(tile, key, attempt))
+
+    def _load_tile_done(self, key, cache_fn):
+        tiles = self._inflight.pop(key, [])
+        if not cache_fn:
+            # failed, the view stops waiting for it
+            for tile in tiles:
+                tile.state = "done"
             return
-        cache_fn = tile.cache_fn
+        for tile in tiles:
+            if tile.state != "done":
+                start = time()
+                tile.set_source(cache_fn)
+                self.stats.observe_since("tile.decode_ms", start)
+
+    def _prefetch_tile(self, map_source, cache_dir, zoom, tile_x, tile_y):
+        cache_fn = map_source.get_cache_fn(zoom, tile_x, tile_y, cache_dir)
+        # a throttled prefetch is dropped, it will be asked again
+        self._fetch_tile(map_source, zoom, tile_x, tile_y, cache_fn,
+                         block=False)
+
+    def fetch_tile(self, map_source, zoom, tile_x, tile_y, cache_fn):
+        """Ensure a tile is in the cache, and return its filename, or None
+        if the download failed. This is blocking, and can be called from any
+        thread. Failed downloads are retried according to the host policy.
+        A stale tile is returned at once, and revalidated in the background.
+        """
+        return self._fetch_tile(map_source, zoom, tile_x, tile_y, cache_fn)
+
+    def _fetch_tile(self, map_source, zoom, tile_x, tile_y, cache_fn,
+                    attempt=0, block=True):
+        # without `block`, RetryLater is raised instead of waiting
         if exists(cache_fn):
+            self.stats.incr("cache.disk")
+            self.tracer.emit("cache-hit", map_source.cache_key, zoom, tile_x,
+                             tile_y)
             if DEBUG:
                 print("Downloader: use cache {}".format(cache_fn))
-            return tile.set_source, (cache_fn, )
-        tile_y = tile.map_source.get_row_count(tile.zoom) - tile.tile_y - 1
-        uri = tile.map_source.url.format(z=tile.zoom, x=tile.tile_x, y=tile_y,
-                                         s=choice(tile.map_source.subdomains))
+            meta = _read_meta(cache_fn)
+            if meta["expires"] <= time():
+                self.revalidate_tile(map_source, zoom, tile_x, tile_y,
+                                     cache_fn, meta)
+            return cache_fn
+        while True:
+            try:
+                return self._download_tile(
+                    map_source, zoom, tile_x, tile_y, cache_fn,
+                    attempt=attempt, block=block)
+            except RetryLater as e:
+                if not block:
+                    raise
+                attempt = e.attempt
+                sleep(e.delay)
+
+    def revalidate_tile(self, map_source, zoom, tile_x, tile_y, cache_fn,
+                        meta):
+        """Queue a conditional request for a stale tile in the cache
+        """
+        with self._revalidating_lock:
+            if cache_fn in self._revalidating:
+                return
+            self._revalidating.add(cache_fn)
+        self._submit_revalidate(map_source, zoom, tile_x, tile_y, cache_fn,
+                                meta)
+
+    def _submit_revalidate(self, *args):
+        self.executor.submit(self._revalidate_tile, *args)
+
+    def _revalidate_tile(self, map_source, zoom, tile_x, tile_y, cache_fn,
+                         meta):
+        try:
+            return self._download_tile(
+                map_source, zoom, tile_x, tile_y, cache_fn, meta)
+        except RetryLater:
+            # keep the stale tile, it will be revalidated on the next use
+            pass
+        finally:
+            with self._revalidating_lock:
+                self._revalidating.discard(cache_fn)
+
+    def _download_tile(self, map_source, zoom, tile_x, tile_y, cache_fn,
+                       meta=None, attempt=0, block=False):
+        import requests
+        uri = map_source.get_tile_url(zoom, tile_x, tile_y)
+        policy = self.get_host_policy(uri)
+        # only the blocking callers wait for a slot, never the workers
+        if not self._acquire_slot(policy, block):
+            raise RetryLater(self.BUSY_DELAY, attempt)
+        delay = policy.get_delay()
+        if delay > 0:
+            self._release_slot(policy)
+            raise RetryLater(delay, attempt)
+        headers = _get_request_headers(meta)
         if DEBUG:
             print("Downloader: download(tile) {}".format(uri))
-        req = requests.get(uri, headers={'User-agent': USER_AGENT}, timeout=5)
         try:
+            start = time()
+            self.tracer.emit("network-start", map_source.cache_key,
+                             zoom, tile_x, tile_y)
+            try:
+                req = requests.get(uri, headers=headers, timeout=5)
+            finally:
+                self._release_slot(policy)
+                self.tracer.emit("network-end", map_source.cache_key,
+                                 zoom, tile_x, tile_y)
+            self.stats.observe_since("download.latency_ms", start)
+        except (requests.Timeout, requests.ConnectionError) as e:
+            return self._tile_failed(policy, uri, None, attempt, None, e)
+        if policy.is_retryable(req.status_code):
+            return self._tile_failed(
+                policy, uri, req.status_code, attempt,
+                req.headers.get("Retry-After"))
+        policy.success()
+        try:
+            if req.status_code == 304 and meta:
+                if DEBUG:
+                    print("Not modified: {}".format(uri))
+                _write_meta(cache_fn, _get_meta(req.headers, meta))
+                return cache_fn
             req.raise_for_status()
             data = req.content
-            with open(cache_fn, "wb") as fd:
-                fd.write(data)
+            _write_atomic(cache_fn, data)
+            _write_meta(cache_fn, _get_meta(req.headers))
+            self.stats.incr("cache.network")
             if DEBUG:
                 print("Downloaded {} bytes: {}".format(len(data), uri))
-            return tile.set_source, (cache_fn, )
+            return cache_fn
         except Exception as e:
             print("Downloader error: {!r}".format(e))
 
+    def _acquire_slot(self, policy, block=False):
+        # take a slot of the host and a global one, or return False. With
+        # `block`, wait until they are free.
+        with self._slot_freed:
+            while True:
+                active = self._host_active.get(policy, 0)
+                if active < self.max_per_host and \
+                        Downloader._slots.acquire(False):
+                    self._host_active[policy] = active + 1
+                    return True
+                if not block:
+                    return False
+                # the global slots are freed by the other downloaders too
+                self._slot_freed.wait(self.BUSY_DELAY)
+
+    def _release_slot(self, policy):
+        with self._slot_freed:
+            self._host_active[policy] -= 1
+            Downloader._slots.release()
+            self._slot_freed.notify_all()
+
+    def _tile_failed(self, policy, uri, status, attempt, retry_after,
+                     error=None):
+        # raise RetryLater, or give up when the retries are exhausted
+        delay = policy.failure(status, attempt, retry_after)
+        if delay is None:
+            print("Downloader error: {} failed after {} attempts ({!r})".format(
+                uri, attempt + 1, error or status))
+            return
+        if DEBUG:
+            print("Downloader: {} failed ({!r}), retry in {:.1f}s".format(
+                uri, error or status, delay))
+        raise RetryLater(delay, attempt + 1)
+
     def _check_executor(self, dt):
         start = time()
-        try:
-            for future in as_completed(self._futures[:], 0):
-                self._futures.remove(future)
-                try:
-                    result = future.result()
-                except Exception:
-                    traceback.print_exc()
-                    # make an error tile?
-                    continue
-                if result is None:
-                    continue
-                callback, args = result
-                callback(*args)
+        ready = self._ready
+        futures = self._futures
+        if self.stats.enabled:
+            self.stats.observe("downloader.queue", len(futures) + len(ready))
+        for future in [f for f in futures if f.done()]:
+            futures.remove(future)
+            try:
+                result = future.result()
+            except Exception:
+                traceback.print_exc()
+                # make an error tile?
+                continue
+            if result is not None:
+                ready.append(result)
 
-                # capped executor in time, in order to prevent too much
-                # slowiness.
-                # seems to works quite great with big zoom-in/out
+        if ready:
+            # the results are applied by priority, and capped in count and
+            # in time, in order to prevent too much slowiness.
+            # seems to works quite great with big zoom-in/out
+            ready.sort(key=self._get_priority)
+            count = 0
+            while ready and count < self.max_apply:
+                callback, args = ready.pop(0)
+                callback(*args)
+                count += 1
                 if time() - start > self.cap_time:
                     break
-        except TimeoutError:
-            pass
+        self._check_prefetch()
+
+    def _get_priority(self, result):
+        # lowest `priority` of the tiles waiting for a result, the tiles
+        # set it from their distance to the center of their view.
+        callback, args = result
+        if callback == self._load_tile_done:
+            tiles = self._inflight.get(args[0], ())
+        else:
+            tiles = args[:1]
+        return min([getattr(tile, "priority", 0) for tile in tiles] or [0])
+
+    def _check_prefetch(self):
+        # the prefetch lane yields to the visible tiles
+        futures = self._prefetch_futures
+        for future in futures[:]:
+            if future.done():
+                futures.remove(future)
+                if future.exception() is not None and DEBUG:
+                    print("Downloader: prefetch error {!r}".format(
+                        future.exception()))
+        queue = self._prefetch_queue
+        inflight = self._inflight
+        while queue and not self._futures and not self._ready and \
+                len(futures) < self.max_prefetch:
+            item = queue.popleft()
+            map_source, cache_dir, zoom, tile_x, tile_y = item
+            cache_fn = map_source.get_cache_fn(zoom, tile_x, tile_y,
+                                               cache_dir)
+            if cache_fn in inflight:
+                continue
+            futures.append(self._submit_prefetch(item))
+
+    def _submit_prefetch(self, item):
+        return self.executor.submit(self._prefetch_tile, *item)
@@ -20,7 +20,7 @@ Supports:
 __all__ = ["GeoJsonMapLayer"]
 
 import json
-from kivy.properties import StringProperty, ObjectProperty
+from kivy.properties import StringProperty, ObjectProperty, BooleanProperty
 from kivy.graphics import (Canvas, PushMatrix, PopMatrix, MatrixInstruction,
                            Translate, Scale)
 from kivy.graphics import Mesh, Line, Color
@@ -30,6 +30,7 @@ from kivy.metrics import dp
 from mapview import CACHE_DIR
 from mapview.view import MapLayer
 from mapview.downloader import Downloader
+from mapview.geometry import GeometryStore, unit_lon, unit_lat
 
 COLORS = {
     'aliceblue': '#f0f8ff',
@@ -182,11 +183,9 @@ COLORS = {
 }
 
 
-def flatten(l):
-    return [item for sublist in l for item in sublist]
-
-
 class GeoJsonMapLayer(MapLayer):
+    # rebuilding the geometries is slow
+    cheap = BooleanProperty(False)
 
     source = StringProperty()
     geojson = ObjectProperty()
@@ -195,9 +194,12 @@ class GeoJsonMapLayer(MapLayer):
     def __init__(self, **kwargs):
         self.first_time = True
         self.initial_zoom = None
+        self.store = None
+        self._store_geojson = None
         super(GeoJsonMapLayer, self).__init__(**kwargs)
         with self.canvas:
             self.canvas_polygon = Canvas()
+            self.canvas_line = Canvas()
         with self.canvas_polygon.before:
             PushMatrix()
             self.g_matrix = MatrixInstruction()
@@ -247,29 +249,14 @@ class GeoJsonMapLayer(MapLayer):
     @property
     def bounds(self):
         # return the min lon, max lon, min lat, max lat
-        bounds = [float("inf"), float("-inf"), float("inf"), float("-inf")]
-
-        def _submit_coordinate(coord):
-            lon, lat = coord
-            bounds[0] = min(bounds[0], lon)
-            bounds[1] = max(bounds[1], lon)
-            bounds[2] = min(bounds[2], lat)
-            bounds[3] = max(bounds[3], lat)
-
-        def _get_bounds(feature):
-            geometry = feature["geometry"]
-            tp = geometry["type"]
-            if tp == "Point":
-                _submit_coordinate(geometry["coordinates"])
-            elif tp == "Polygon":
-                for coordinate in geometry["coordinates"][0]:
-                    _submit_coordinate(coordinate)
-            elif tp == "MultiPolygon":
-                for polygon in geometry["coordinates"]:
-                    for coordinate in polygon[0]:
-                        _submit_coordinate(coordinate)
-        self.traverse_feature(_get_bounds)
-        return bounds
+        store = self.store
+        if store is None:
+            return [float("inf"), float("-inf"), float("inf"), float("-inf")]
+        min_x, min_y, max_x, max_y = store.bounds
+        if min_x > max_x:
+            return [float("inf"), float("-inf"), float("inf"), float("-inf")]
+        return [unit_lon(min_x), unit_lon(max_x),
+                unit_lat(min_y), unit_lat(max_y)]
 
     @property
     def center(self):
@@ -279,15 +266,21 @@ class GeoJsonMapLayer(MapLayer):
         return min_lon + cx, min_lat + cy
 
     def on_geojson(self, instance, geojson, update=False):
+        if geojson is not self._store_geojson:
+            # convert the geometries only once, everything else is working
+            # on the store buffers
+            self.store = GeometryStore()
+            self.store.load(geojson)
+            self._store_geojson = geojson
         if self.parent is None:
             return
         if not update:
             # print "Reload geojson (polygon)"
             self.g_canvas_polygon.clear()
-            self._geojson_part(geojson, geotype="Polygon")
+            self._geojson_part(geotype="Polygon")
         # print "Reload geojson (LineString)"
         self.canvas_line.clear()
-        self._geojson_part(geojson, geotype="LineString")
+        self._geojson_part(geotype="LineString")
 
     def on_source(self, instance, value):
         if value.startswith("http://") or value.startswith("https://"):
@@ -302,40 +295,32 @@ class GeoJsonMapLayer(MapLayer):
     def _load_geojson_url(self, url, r):
         self.geojson = r.json()
 
-    def _geojson_part(self, part, geotype=None):
-        tp = part["type"]
-        if tp == "FeatureCollection":
-            for feature in part["features"]:
-                if geotype and feature["geometry"]["type"] != geotype:
-                    continue
-                self._geojson_part_f(feature)
-        elif tp == "Feature":
-            if geotype and part["geometry"]["type"] == geotype:
-                self._geojson_part_f(part)
-        else:
-            # unhandled geojson part
-            pass
-
-    def _geojson_part_f(self, feature):
-        properties = feature["properties"]
-        geometry = feature["geometry"]
-        graphics = self._geojson_part_geometry(geometry, properties)
-        for g in graphics:
-            tp = geometry["type"]
-            if tp == "Polygon":
-                self.g_canvas_polygon.add(g)
-            else:
-                self.canvas_line.add(g)
-
-    def _geojson_part_geometry(self, geometry, properties):
-        tp = geometry["type"]
+    def _geojson_part(self, geotype):
+        store = self.store
+        transform = self._get_transform()
+        for index, tp in enumerate(store.types):
+            if tp != geotype:
+                continue
+            graphics = self._geojson_part_geometry(index, transform)
+            for g in graphics:
+                if tp == "Polygon":
+                    self.g_canvas_polygon.add(g)
+                else:
+                    self.canvas_line.add(g)
+
+    def _geojson_part_geometry(self, index, transform):
+        store = self.store
+        tp = store.types[index]
+        properties = store.properties[index]
         graphics = []
         if tp == "Polygon":
             tess = Tesselator()
-            for c in geometry["coordinates"]:
-                xy = list(self._lonlat_to_xy(c))
-                xy = flatten(xy)
-                tess.add_contour(xy)
+            start, end = store.get_vertex_range(index)
+            xy = memoryview(store.project(*transform, start=start, end=end))
+            for rings in store.get_parts(index):
+                for ring_start, ring_end in rings:
+                    tess.add_contour(xy[(ring_start - start) * 2:
+                                        (ring_end - start) * 2])
 
             tess.tesselate(WINDING_ODD, TYPE_POLYGONS)
 
@@ -351,21 +336,26 @@ class GeoJsonMapLayer(MapLayer):
         elif tp == "LineString":
             stroke = get_color_from_hex(properties.get("stroke", "#ffffff"))
             stroke_width = dp(properties.get("stroke-width"))
-            xy = list(self._lonlat_to_xy(geometry["coordinates"]))
-            xy = flatten(xy)
+            start, end = store.get_vertex_range(index)
+            xy = store.project(*transform, start=start, end=end)
             graphics.append(Color(*stroke))
             graphics.append(Line(points=xy, width=stroke_width))
 
         return graphics
 
-    def _lonlat_to_xy(self, lonlats):
+    def _get_transform(self):
+        # the projection from the unit mercator square to the layer
+        # coordinates is affine, compute its terms once per update.
         view = self.parent
-        zoom = view.zoom
-        for lon, lat in lonlats:
-            p = view.get_window_xy_from(lat, lon, zoom)
-            p = p[0] - self.parent.delta_x, p[1] - self.parent.delta_y
-            p = self.parent._scatter.to_local(*p)
-            yield p
+        world = pow(2., view.zoom) * view.map_source.dp_tile_size
+        scale = view.scale
+        vx, vy = view.viewport_pos
+        ox = view.x - view.delta_x - vx * scale
+        oy = view.y - view.delta_y - vy * scale
+        to_local = view._scatter.to_local
+        x0, y0 = to_local(ox, oy)
+        x1, y1 = to_local(ox + world * scale, oy + world * scale)
+        return x1 - x0, x0, y1 - y0, y0
 
     def _get_color_from(self, value):
         color = COLORS.get(value.lower(), value)
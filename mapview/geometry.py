@@ -0,0 +1,194 @@
+# coding=utf-8
+"""
+Columnar geometry storage
+=========================
+
+GeoJSON geometries are converted once into flat buffers, in a layout close
+to GeoArrow: all the vertices of all the features are stored in a single
+``array("d")``, and offsets tables map each feature to its parts, each part
+to its rings and each ring to its vertices.
+
+Vertices are stored in a unit spherical mercator square: both axis are in
+the [0..1] range, with the same orientation as :meth:`MapSource.get_x` and
+:meth:`MapSource.get_y`. Projecting to any zoom level is then a simple
+affine transformation of the buffer, without any trigonometry.
+"""
+
+__all__ = ["GeometryStore", "unit_x", "unit_y", "unit_lon", "unit_lat"]
+
+from array import array
+from math import log, tan, cos, pi, atan, exp
+from mapview import MIN_LONGITUDE, MAX_LONGITUDE, MIN_LATITUDE, MAX_LATITUDE
+from mapview.utils import clamp
+
+
+def unit_x(lon):
+    """Project a longitude in the unit mercator square
+    """
+    lon = clamp(lon, MIN_LONGITUDE, MAX_LONGITUDE)
+    return (lon + 180.) / 360.
+
+
+def unit_y(lat):
+    """Project a latitude in the unit mercator square
+    """
+    lat = clamp(-lat, MIN_LATITUDE, MAX_LATITUDE)
+    lat = lat * pi / 180.
+    return (1.0 - log(tan(lat) + 1.0 / cos(lat)) / pi) / 2.
+
+
+def unit_lon(x):
+    """Get the longitude of a x position in the unit mercator square
+    """
+    return clamp(x * 360. - 180., MIN_LONGITUDE, MAX_LONGITUDE)
+
+
+def unit_lat(y):
+    """Get the latitude of a y position in the unit mercator square
+    """
+    n = pi - 2 * pi * y
+    lat = -180. / pi * atan(.5 * (exp(n) - exp(-n)))
+    return clamp(lat, MIN_LATITUDE, MAX_LATITUDE)
+
+
+# normalize the coordinates of every geometry type into parts / rings
+_PARTS = {
+    "Point": lambda c: [[[c]]],
+    "MultiPoint": lambda c: [[c]],
+    "LineString": lambda c: [[c]],
+    "MultiLineString": lambda c: [[ring] for ring in c],
+    "Polygon": lambda c: [c],
+    "MultiPolygon": lambda c: c,
+}
+
+
+class GeometryStore(object):
+    """Flat storage of the geometries of a GeoJSON document.
+
+    - `coords`: x, y of every vertex in the unit mercator square
+    - `ring_offsets`: index of the first vertex of each ring
+    - `part_offsets`: index of the first ring of each part
+    - `geom_offsets`: index of the first part of each feature
+    - `bboxes`: min x, min y, max x, max y of each feature
+
+    Each offsets table have one more entry than the number of items, so the
+    range of the item `i` is always `table[i]:table[i + 1]`.
+    """
+
+    def __init__(self):
+        super(GeometryStore, self).__init__()
+        self.coords = array("d")
+        self.ring_offsets = array("l", [0])
+        self.part_offsets = array("l", [0])
+        self.geom_offsets = array("l", [0])
+        self.bboxes = array("d")
+        self.bounds = (float("inf"), float("inf"),
+                       float("-inf"), float("-inf"))
+        self.types = []
+        self.properties = []
+
+    def __len__(self):
+        return len(self.types)
+
+    def load(self, geojson):
+        """Add all the features of a GeoJSON Feature or FeatureCollection
+        """
+        if not geojson:
+            return
+        tp = geojson["type"]
+        if tp == "FeatureCollection":
+            for feature in geojson["features"]:
+                self.add_feature(feature)
+        elif tp == "Feature":
+            self.add_feature(geojson)
+
+    def add_feature(self, feature):
+        """Add a GeoJSON feature, and return its index in the store.
+        Unsupported geometries (GeometryCollection) are stored without parts.
+        """
+        geometry = feature.get("geometry") or {}
+        tp = geometry.get("type")
+        to_parts = _PARTS.get(tp)
+        parts = to_parts(geometry["coordinates"]) if to_parts else []
+
+        coords = self.coords
+        ring_offsets = self.ring_offsets
+        part_offsets = self.part_offsets
+        min_x = min_y = float("inf")
+        max_x = max_y = float("-inf")
+        for part in parts:
+            for ring in part:
+                for coord in ring:
+                    x = unit_x(coord[0])
+                    y = unit_y(coord[1])
+                    coords.append(x)
+                    coords.append(y)
+                    if x < min_x:
+                        min_x = x
+                    if x > max_x:
+                        max_x = x
+                    if y < min_y:
+                        min_y = y
+                    if y > max_y:
+                        max_y = y
+                ring_offsets.append(len(coords) // 2)
+            part_offsets.append(len(ring_offsets) - 1)
+        self.geom_offsets.append(len(part_offsets) - 1)
+
+        # per-feature bbox, and the aggregated bounds are maintained
+        # incrementally
+        self.bboxes.extend((min_x, min_y, max_x, max_y))
+        b_min_x, b_min_y, b_max_x, b_max_y = self.bounds
+        self.bounds = (min(b_min_x, min_x), min(b_min_y, min_y),
+                       max(b_max_x, max_x), max(b_max_y, max_y))
+        self.types.append(tp)
+        self.properties.append(feature.get("properties") or {})
+        return len(self.types) - 1
+
+    def get_parts(self, index):
+        """Return the parts of a feature, as a list of rings, each ring being
+        a (start, end) range of vertices.
+        """
+        ring_offsets = self.ring_offsets
+        part_offsets = self.part_offsets
+        parts = []
+        for part in range(self.geom_offsets[index],
+                          self.geom_offsets[index + 1]):
+            parts.append([
+                (ring_offsets[ring], ring_offsets[ring + 1])
+                for ring in range(part_offsets[part], part_offsets[part + 1])])
+        return parts
+
+    def get_vertex_range(self, index):
+        """Return the (start, end) range of all the vertices of a feature
+        """
+        part_offsets = self.part_offsets
+        geom_offsets = self.geom_offsets
+        ring_start = part_offsets[geom_offsets[index]]
+        ring_end = part_offsets[geom_offsets[index + 1]]
+        return self.ring_offsets[ring_start], self.ring_offsets[ring_end]
+
+    def get_bounds(self, index=None):
+        """Return the (min x, min y, max x, max y) of a feature, or of the
+        whole store if `index` is None, in the unit mercator square.
+        """
+        if index is None:
+            return self.bounds
+        return tuple(self.bboxes[index * 4:index * 4 + 4])
+
+    def project(self, ax, bx, ay, by, start=0, end=None):
+        """Apply the affine transformation `x * ax + bx`, `y * ay + by` on a
+        range of vertices, and return a flat ``array("f")``, usable directly
+        by the :class:`~kivy.graphics.tesselator.Tesselator` and
+        :class:`~kivy.graphics.Line`.
+        """
+        if end is None:
+            end = len(self.coords) // 2
+        coords = self.coords
+        out = array("f", [0.]) * (2 * (end - start))
+        i = 0
+        for offset in range(start * 2, end * 2, 2):
+            out[i] = coords[offset] * ax + bx
+            out[i + 1] = coords[offset + 1] * ay + by
+            i += 2
+        return out
@@ -11,7 +11,7 @@ __all__ = ["MBTilesMapSource"]
 
 
 from mapview.source import MapSource
-from mapview.downloader import Downloader
+from mapview.trace import tracer
 from kivy.core.image import Image as CoreImage, ImageLoader
 import threading
 import sqlite3
@@ -19,6 +19,9 @@ import io
 
 
 class MBTilesMapSource(MapSource):
+    # vector maps are handled by VectorMBTilesMapSource
+    is_vector = False
+
     def __init__(self, filename, **kwargs):
         super(MBTilesMapSource, self).__init__(**kwargs)
         self.filename = filename
@@ -27,8 +30,10 @@ class MBTilesMapSource(MapSource):
         # read metadata
         c = self.db.cursor()
         metadata = dict(c.execute("SELECT * FROM metadata"))
-        if metadata["format"] == "pbf":
-            raise ValueError("Only raster maps are supported, not vector maps.")
+        if metadata["format"] == "pbf" and not self.is_vector:
+            raise ValueError(
+                "Only raster maps are supported, not vector maps. "
+                "Use VectorMBTilesMapSource instead.")
         self.min_zoom = int(metadata["minzoom"])
         self.max_zoom = int(metadata["maxzoom"])
         self.attribution = metadata.get("attribution", "")
@@ -52,7 +57,11 @@ class MBTilesMapSource(MapSource):
     def fill_tile(self, tile):
         if tile.state == "done":
             return
-        Downloader.instance(self.cache_dir).submit(self._load_tile, tile)
+        self.get_downloader(tile).submit(self._load_tile, tile)
+
+    def prefetch_tiles(self, tiles, cache_dir=None, downloader=None):
+        # everything is already local
+        pass
 
     def _load_tile(self, tile):
         # global db context cannot be shared across threads.
@@ -69,8 +78,8 @@ class MBTilesMapSource(MapSource):
         # print "fetch", tile.zoom, tile.tile_x, tile.tile_y
         row = c.fetchone()
         if not row:
-            tile.state = "done"
-            return
+            return self._load_tile_missing, (tile, )
+        tracer.emit_tile("cache-hit", tile)
 
         # no-file loading
         try:
@@ -84,15 +93,22 @@ class MBTilesMapSource(MapSource):
                     tile.tile_y))
 
         if im is None:
-            tile.state = "done"
-            return
+            return self._load_tile_missing, (tile, )
+        tracer.emit_tile("decoded", tile)
 
         return self._load_tile_done, (tile, im, )
 
     def _load_tile_done(self, tile, im):
+        # the tile may have left the view meanwhile
+        if tile.state == "done":
+            return
         tile.texture = im.texture
         tile.state = "need-animation"
 
+    def _load_tile_missing(self, tile):
+        # on the main thread, the view stops waiting for the tile
+        tile.state = "done"
+
     def get_x(self, zoom, lon):
         if self.is_xy:
             return lon
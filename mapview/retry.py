@@ -0,0 +1,213 @@
+# coding=utf-8
+"""
+Retry and throttling policies
+=============================
+
+Policies used by the downloaders to be nice with the tile servers:
+
+- :class:`TokenBucket`: limit the request rate to a host
+- :class:`RetryPolicy`: exponential backoff with jitter for the transient
+  failures (timeouts, 429, 5xx), honoring `Retry-After`
+- :class:`CircuitBreaker`: pause a host after repeated failures
+
+They never sleep by themselves: they return delays, so the same policy can
+be used from threads, from an asyncio loop, or with the Kivy Clock.
+"""
+
+__all__ = ["RetryLater", "TokenBucket", "RetryPolicy", "CircuitBreaker",
+           "HostPolicy", "parse_retry_after"]
+
+from email.utils import parsedate_tz, mktime_tz
+from random import random
+from time import time
+import threading
+
+
+class RetryLater(Exception):
+    """Raised when a request must be tried again after `delay` seconds.
+    `attempt` is the number of the next attempt.
+    """
+
+    def __init__(self, delay, attempt=0):
+        super(RetryLater, self).__init__(delay, attempt)
+        self.delay = delay
+        self.attempt = attempt
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds of a `Retry-After` header, or None
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0., mktime_tz(date) - time())
+
+
+class TokenBucket(object):
+    """Allow `rate` requests per second on average, with bursts up to `burst`
+    requests.
+    """
+
+    def __init__(self, rate, burst=None):
+        super(TokenBucket, self).__init__()
+        self.rate = float(rate)
+        self.burst = float(burst or rate)
+        self.tokens = self.burst
+        self._time = time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, and return 0, or return the delay before a token is
+        available, without taking it.
+        """
+        with self._lock:
+            now = time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._time) * self.rate)
+            self._time = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter.
+
+    :param int retries: Maximum number of retries
+    :param float backoff: Delay before the first retry, in seconds
+    :param float max_backoff: Maximum delay between two attempts
+    :param float jitter: Random part of the delay, from 0 to 1
+    """
+
+    RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+
+    def __init__(self, retries=3, backoff=.5, max_backoff=60., jitter=.5):
+        super(RetryPolicy, self).__init__()
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def is_retryable(self, status):
+        """A None status is a timeout or a connection error
+        """
+        return status is None or status in self.RETRY_STATUS
+
+    def get_delay(self, attempt, retry_after=None):
+        """Return the delay before the next attempt, or None if `attempt`
+        was the last one.
+        """
+        if attempt >= self.retries:
+            return None
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        delay *= 1 - self.jitter * random()
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.max_backoff))
+        return delay
+
+
+class CircuitBreaker(object):
+    """Pause a host after `threshold` consecutive failures, for `cooldown`
+    seconds. Then a single request is allowed to probe the host: the
+    circuit is closed on success, or opened again on failure. Meanwhile, the
+    other requests are delayed by `probe_delay` only, to resume promptly.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold=5, cooldown=30., probe_delay=.5):
+        super(CircuitBreaker, self).__init__()
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.probe_delay = probe_delay
+        self.state = self.CLOSED
+        self.failures = 0
+        self._until = 0
+        self._lock = threading.Lock()
+
+    def get_delay(self):
+        """Return 0 if a request can be done now, or the delay to wait.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0
+            now = time()
+            if now >= self._until:
+                # let one request probe the host, again if the last probe
+                # never reported
+                self.state = self.HALF_OPEN
+                self._until = now + self.cooldown
+                return 0
+            if self.state == self.HALF_OPEN:
+                # poll until the probe closes the circuit
+                return min(self.probe_delay, self._until - now)
+            return max(self._until - now, .1)
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self, pause=None):
+        """Record a failure. `pause` opens the circuit at once for that
+        many seconds, ie: from a `Retry-After` header.
+        """
+        with self._lock:
+            self.failures += 1
+            if pause is None:
+                if self.state == self.CLOSED and \
+                        self.failures < self.threshold:
+                    return
+                pause = self.cooldown
+            self.state = self.OPEN
+            self._until = time() + pause
+
+
+class HostPolicy(object):
+    """Rate limit, retries and circuit breaker of a single host.
+
+    :param float rate: Maximum requests per second, None for unlimited
+    :param int burst: Maximum burst of requests
+    :param RetryPolicy retry: Retry policy, defaults to :class:`RetryPolicy`
+    :param CircuitBreaker breaker: Circuit breaker, defaults to
+        :class:`CircuitBreaker`
+    """
+
+    def __init__(self, rate=None, burst=None, retry=None, breaker=None):
+        super(HostPolicy, self).__init__()
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker(
+            probe_delay=self.retry.backoff)
+
+    def get_delay(self):
+        """Return 0 and count the request if it can be done now, or the
+        delay to wait before asking again.
+        """
+        delay = self.breaker.get_delay()
+        if delay > 0 or self.bucket is None:
+            return delay
+        return self.bucket.acquire()
+
+    def is_retryable(self, status):
+        return self.retry.is_retryable(status)
+
+    def success(self):
+        self.breaker.record_success()
+
+    def failure(self, status, attempt, retry_after=None):
+        """Record a failed attempt, and return the delay before the next
+        one, or None to give up.
+        """
+        retry_after = parse_retry_after(retry_after)
+        # a 429 or 503 with Retry-After pauses the whole host
+        self.breaker.record_failure(retry_after)
+        return self.retry.get_delay(attempt, retry_after)
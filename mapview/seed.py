@@ -0,0 +1,330 @@
+# coding=utf-8
+"""
+Offline region seeding
+======================
+
+Download all the tiles covering a region, within a zoom range, into the
+tile cache, so a :class:`MapView` can be used offline later.
+
+A region is either a bounding box (lat1, lon1, lat2, lon2), in the same
+order as :meth:`MapView.get_bbox`, or a GeoJSON document containing
+Polygon / MultiPolygon features.
+
+The progress is saved in a manifest next to the cache, an interrupted
+seeding can be resumed by running it again.
+
+From the command line::
+
+    python -m mapview.seed --provider osm --bbox 50.6,3.0,50.7,3.1 \\
+        --zoom 10-16 --workers 4 --rate 8
+"""
+
+__all__ = ["iter_region_tiles", "RegionSeeder"]
+
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, exists, getsize
+from os import makedirs
+from math import floor
+from time import time, sleep
+import argparse
+import json
+import sys
+import threading
+from mapview import CACHE_DIR
+from mapview.downloader import Downloader, _write_atomic
+from mapview.geometry import GeometryStore, unit_x, unit_y
+
+
+def _tile_range(n, min_x, min_y, max_x, max_y):
+    # unit mercator bbox to an inclusive range of tiles
+    def to_tile(v):
+        return int(min(n - 1, max(0, floor(v * n))))
+    return to_tile(min_x), to_tile(min_y), to_tile(max_x), to_tile(max_y)
+
+
+def _point_in_rings(x, y, coords, rings):
+    # even-odd rule over all the rings of a polygon
+    inside = False
+    for start, end in rings:
+        j = end - 1
+        for i in range(start, end):
+            xi, yi = coords[i * 2], coords[i * 2 + 1]
+            xj, yj = coords[j * 2], coords[j * 2 + 1]
+            if (yi > y) != (yj > y) and \
+                    x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+                inside = not inside
+            j = i
+    return inside
+
+
+def _segments_intersect(ax, ay, bx, by, cx, cy, dx, dy):
+    def orient(px, py, qx, qy, rx, ry):
+        return (qx - px) * (ry - py) - (qy - py) * (rx - px)
+    d1 = orient(cx, cy, dx, dy, ax, ay)
+    d2 = orient(cx, cy, dx, dy, bx, by)
+    d3 = orient(ax, ay, bx, by, cx, cy)
+    d4 = orient(ax, ay, bx, by, dx, dy)
+    return ((d1 > 0) != (d2 > 0)) and ((d3 > 0) != (d4 > 0))
+
+
+def _rect_intersects_rings(x0, y0, x1, y1, coords, rings):
+    # the center of the rect is inside the polygon
+    if _point_in_rings((x0 + x1) / 2., (y0 + y1) / 2., coords, rings):
+        return True
+    edges = ((x0, y0, x1, y0), (x1, y0, x1, y1),
+             (x1, y1, x0, y1), (x0, y1, x0, y0))
+    for start, end in rings:
+        for i in range(start, end):
+            ax, ay = coords[i * 2], coords[i * 2 + 1]
+            # a vertex of the polygon is inside the rect
+            if x0 <= ax <= x1 and y0 <= ay <= y1:
+                return True
+            if i + 1 == end:
+                continue
+            bx, by = coords[i * 2 + 2], coords[i * 2 + 3]
+            # an edge of the polygon cross the rect
+            for edge in edges:
+                if _segments_intersect(ax, ay, bx, by, *edge):
+                    return True
+    return False
+
+
+def iter_region_tiles(region, min_zoom, max_zoom):
+    """Yield all the (zoom, tile_x, tile_y) covering the region, for every
+    zoom between `min_zoom` and `max_zoom` included. `tile_y` is counted from
+    the bottom, as in the :class:`MapView`.
+    """
+    if isinstance(region, dict):
+        store = GeometryStore()
+        store.load(region)
+        polygons = [
+            (store.get_bounds(index), parts)
+            for index, tp in enumerate(store.types)
+            if tp in ("Polygon", "MultiPolygon")
+            for parts in store.get_parts(index)]
+        for zoom in range(min_zoom, max_zoom + 1):
+            n = 2 ** zoom
+            seen = set()
+            for bounds, rings in polygons:
+                tx0, ty0, tx1, ty1 = _tile_range(n, *bounds)
+                for tile_x in range(tx0, tx1 + 1):
+                    for tile_y in range(ty0, ty1 + 1):
+                        if (tile_x, tile_y) in seen:
+                            continue
+                        if _rect_intersects_rings(
+                                tile_x / float(n), tile_y / float(n),
+                                (tile_x + 1) / float(n),
+                                (tile_y + 1) / float(n),
+                                store.coords, rings):
+                            seen.add((tile_x, tile_y))
+                            yield zoom, tile_x, tile_y
+    else:
+        lat1, lon1, lat2, lon2 = region
+        xs = unit_x(lon1), unit_x(lon2)
+        ys = unit_y(lat1), unit_y(lat2)
+        for zoom in range(min_zoom, max_zoom + 1):
+            tx0, ty0, tx1, ty1 = _tile_range(
+                2 ** zoom, min(xs), min(ys), max(xs), max(ys))
+            for tile_x in range(tx0, tx1 + 1):
+                for tile_y in range(ty0, ty1 + 1):
+                    yield zoom, tile_x, tile_y
+
+
+class RegionSeeder(object):
+    """Download all the tiles of a region into the cache.
+
+    :param MapSource map_source: Source of the tiles
+    :param region: Bbox (lat1, lon1, lat2, lon2) or GeoJSON dict
+    :param int min_zoom: Minimum zoom to download
+    :param int max_zoom: Maximum zoom to download (included)
+    :param str cache_dir: Cache to fill, defaults to the source cache
+    :param int workers: Number of concurrent downloads
+    :param float rate: Maximum number of tiles per second, None for
+        unlimited
+    :param str manifest: Filename of the manifest used to resume an
+        interrupted seeding. Defaults to `<cache_key>.seed.json` in the
+        cache directory
+    :param callable progress: Called with the :attr:`stats` dict after
+        every tile, from the seeding threads
+    :param Downloader downloader: Downloader used to fetch the tiles,
+        defaults to the one of the source, or to a downloader allowing
+        `workers` requests per host. The `max_per_host` of the downloader
+        caps the concurrent downloads, whatever the `workers`.
+    """
+
+    # save the manifest every N tiles
+    MANIFEST_INTERVAL = 50
+
+    def __init__(self, map_source, region, min_zoom, max_zoom,
+                 cache_dir=None, workers=4, rate=None, manifest=None,
+                 progress=None, downloader=None):
+        super(RegionSeeder, self).__init__()
+        self.map_source = map_source
+        self.region = region
+        self.min_zoom = max(min_zoom, map_source.get_min_zoom())
+        self.max_zoom = min(max_zoom, map_source.get_max_zoom())
+        self.cache_dir = cache_dir or map_source.cache_dir
+        self.workers = workers
+        self.rate = rate
+        self.progress = progress
+        self.manifest = manifest or join(
+            self.cache_dir, "{}.seed.json".format(map_source.cache_key))
+        if downloader is None:
+            # the blocking downloads run in the seeding threads, not in the
+            # workers of the downloader
+            downloader = map_source.downloader or Downloader(
+                max_workers=1, max_per_host=workers, cache_dir=self.cache_dir)
+        self.downloader = downloader
+        self.stats = {}
+        self._done = set()
+        self._lock = threading.Lock()
+        self._manifest_lock = threading.Lock()
+        self._next_time = 0
+
+    def load_manifest(self):
+        if not exists(self.manifest):
+            return
+        with open(self.manifest) as fd:
+            manifest = json.load(fd)
+        if manifest.get("cache_key") == self.map_source.cache_key:
+            self._done = set(manifest.get("done", []))
+
+    def save_manifest(self):
+        with self._lock:
+            manifest = {
+                "cache_key": self.map_source.cache_key,
+                "min_zoom": self.min_zoom,
+                "max_zoom": self.max_zoom,
+                "done": sorted(self._done),
+                "failed": sorted(self.stats.get("failed_tiles", [])),
+            }
+        with self._manifest_lock:
+            _write_atomic(self.manifest, json.dumps(manifest), "w")
+
+    def run(self):
+        """Download the region, and return the :attr:`stats`
+        """
+        if not exists(self.cache_dir):
+            makedirs(self.cache_dir)
+        self.load_manifest()
+        tiles = list(iter_region_tiles(
+            self.region, self.min_zoom, self.max_zoom))
+        self.stats = stats = {
+            "total": len(tiles), "done": 0, "skipped": 0, "failed": 0,
+            "bytes": 0, "elapsed": 0., "tiles_per_second": 0.,
+            "bytes_per_second": 0., "failed_tiles": []}
+        self._start = time()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for _ in executor.map(self._seed_tile, tiles):
+                pass
+        finally:
+            executor.shutdown(wait=True)
+            self.save_manifest()
+        return stats
+
+    def _wait_rate(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time()
+            wait = self._next_time - now
+            self._next_time = max(now, self._next_time) + 1. / self.rate
+        if wait > 0:
+            sleep(wait)
+
+    def _seed_tile(self, tile):
+        zoom, tile_x, tile_y = tile
+        key = "{}/{}/{}".format(zoom, tile_x, tile_y)
+        map_source = self.map_source
+        cache_fn = map_source.get_cache_fn(
+            zoom, tile_x, tile_y, self.cache_dir)
+        size = 0
+        if key in self._done or exists(cache_fn):
+            result = "skipped"
+        else:
+            self._wait_rate()
+            try:
+                fn = self.downloader.fetch_tile(
+                    map_source, zoom, tile_x, tile_y, cache_fn)
+            except Exception:
+                fn = None
+            if fn:
+                result = "done"
+                size = getsize(fn)
+            else:
+                result = "failed"
+
+        stats = self.stats
+        with self._lock:
+            stats[result] += 1
+            if result == "failed":
+                stats["failed_tiles"].append(key)
+            else:
+                self._done.add(key)
+            stats["bytes"] += size
+            elapsed = stats["elapsed"] = time() - self._start
+            if elapsed > 0:
+                stats["tiles_per_second"] = stats["done"] / elapsed
+                stats["bytes_per_second"] = stats["bytes"] / elapsed
+            count = stats["done"] + stats["skipped"] + stats["failed"]
+        if count % self.MANIFEST_INTERVAL == 0:
+            self.save_manifest()
+        if self.progress:
+            self.progress(stats)
+
+
+def _print_progress(stats):
+    count = stats["done"] + stats["skipped"] + stats["failed"]
+    sys.stdout.write(
+        "\r{}/{} tiles ({} skipped, {} failed), {:.1f} tiles/s, "
+        "{:.1f} kB/s".format(
+            count, stats["total"], stats["skipped"], stats["failed"],
+            stats["tiles_per_second"], stats["bytes_per_second"] / 1024.))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    from mapview.source import MapSource
+    parser = argparse.ArgumentParser(
+        description="Download the tiles of a region for offline use")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--provider", help="Provider key, ie: osm")
+    source.add_argument("--url", help="Tile url, ie: "
+                        "http://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png")
+    parser.add_argument("--cache-key", help="Cache key of the --url")
+    region = parser.add_mutually_exclusive_group(required=True)
+    region.add_argument("--bbox", help="lat1,lon1,lat2,lon2")
+    region.add_argument("--geojson", help="GeoJSON file with polygons")
+    parser.add_argument("--zoom", required=True,
+                        help="Zoom range, ie: 10-16")
+    parser.add_argument("--cache-dir", default=CACHE_DIR)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=None,
+                        help="Maximum number of tiles per second")
+    parser.add_argument("--manifest", default=None)
+    args = parser.parse_args(argv)
+
+    if args.provider:
+        map_source = MapSource.from_provider(
+            args.provider, cache_dir=args.cache_dir)
+    else:
+        map_source = MapSource(url=args.url, cache_key=args.cache_key,
+                               cache_dir=args.cache_dir)
+    if args.bbox:
+        region = [float(v) for v in args.bbox.split(",")]
+    else:
+        with open(args.geojson) as fd:
+            region = json.load(fd)
+    zooms = [int(v) for v in args.zoom.split("-")]
+
+    stats = map_source.seed_region(
+        region, zooms[0], zooms[-1], cache_dir=args.cache_dir,
+        workers=args.workers, rate=args.rate, manifest=args.manifest,
+        progress=_print_progress)
+    sys.stdout.write("\n")
+    return 1 if stats["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,9 +4,11 @@ __all__ = ["MapSource"]
 
 from kivy.metrics import dp
 from math import cos, ceil, log, tan, pi, atan, exp
+from random import choice
 from mapview import MIN_LONGITUDE, MAX_LONGITUDE, MIN_LATITUDE, MAX_LATITUDE, \
     CACHE_DIR
 from mapview.downloader import Downloader
+from mapview.cachepath import CachePath
 from mapview.utils import clamp
 import hashlib
 
@@ -65,6 +67,8 @@ class MapSource(object):
         self.default_lat = self.default_lon = self.default_zoom = None
         self.bounds = None
         self.cache_dir = kwargs.get('cache_dir', CACHE_DIR)
+        self.downloader = kwargs.get('downloader')
+        self._cache_path = None
 
     @staticmethod
     def from_provider(key, **kwargs):
@@ -76,7 +80,8 @@ class MapSource(object):
             options = provider[5]
         return MapSource(cache_key=key, min_zoom=min_zoom,
                          max_zoom=max_zoom, url=url, cache_dir=cache_dir,
-                         attribution=attribution, **options)
+                         attribution=attribution,
+                         downloader=kwargs.get('downloader'), **options)
 
     def get_x(self, zoom, lon):
         """Get the x position on the map using this map source's projection
@@ -133,9 +138,62 @@ class MapSource(object):
         """
         return self.max_zoom
 
+    @property
+    def cache_path(self):
+        """Path strategy of the tiles, a :class:`~mapview.cachepath.CachePath`
+        created on first use from `cache_key`, `image_ext` and `cache_fmt`.
+        """
+        if self._cache_path is None:
+            self._cache_path = CachePath(
+                self.cache_key, self.image_ext, self.cache_fmt)
+        return self._cache_path
+
+    def get_cache_fn(self, zoom, tile_x, tile_y, cache_dir=None):
+        """Return the filename of a tile within the cache
+        """
+        return self.cache_path.get_filename(
+            zoom, tile_x, tile_y, cache_dir or self.cache_dir)
+
+    def get_tile_url(self, zoom, tile_x, tile_y):
+        """Return the url of a tile. `tile_y` is counted from the bottom, as
+        in the :class:`MapView`.
+        """
+        tile_y = self.get_row_count(zoom) - tile_y - 1
+        return self.url.format(z=zoom, x=tile_x, y=tile_y,
+                               s=choice(self.subdomains))
+
+    def get_downloader(self, tile=None):
+        """Return the downloader of this source: its own `downloader` if set,
+        else the one of the view displaying the tile, else the one shared by
+        the cache directory.
+        """
+        if self.downloader is not None:
+            return self.downloader
+        downloader = getattr(tile, "downloader", None)
+        if downloader is not None:
+            return downloader
+        return Downloader.instance(cache_dir=self.cache_dir)
+
     def fill_tile(self, tile):
         """Add this tile to load within the downloader
         """
         if tile.state == "done":
             return
-        Downloader.instance(cache_dir=self.cache_dir).download_tile(tile)
+        self.get_downloader(tile).download_tile(tile)
+
+    def seed_region(self, region, min_zoom, max_zoom, **kwargs):
+        """Download all the tiles of a region into the cache, for an offline
+        usage. See :class:`mapview.seed.RegionSeeder` for the region format
+        and the options. Blocking, returns the seeding statistics.
+        """
+        from mapview.seed import RegionSeeder
+        return RegionSeeder(
+            self, region, min_zoom, max_zoom, **kwargs).run()
+
+    def prefetch_tiles(self, tiles, cache_dir=None, downloader=None):
+        """Replace the tiles to prefetch in the cache at low priority, as a
+        list of (zoom, tile_x, tile_y)
+        """
+        downloader = self.downloader or downloader or \
+            Downloader.instance(cache_dir=self.cache_dir)
+        downloader.prefetch_tiles(self, tiles, cache_dir or self.cache_dir)
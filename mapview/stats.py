@@ -0,0 +1,162 @@
+# coding=utf-8
+"""
+Performance statistics
+======================
+
+Counters and histograms of what the map is doing: tile queue depth, cache
+hits (memory, disk, network), download latency, decoding time, layers
+repositioning time, and time spent in the map updates.
+
+The statistics are disabled by default, and cost a single attribute test
+per call site then. Enable them with the `MAPVIEW_STATS=1` environment
+variable, or::
+
+    from mapview.stats import stats
+    stats.enabled = True
+    ...
+    print(stats.as_dict())
+
+They can be pushed to a sink, ie: a logger or a metrics client::
+
+    stats.add_sink(lambda data: Logger.info("MapView: {}".format(data)))
+    Clock.schedule_interval(lambda dt: stats.push(), 10)
+"""
+
+__all__ = ["Stats", "Histogram", "stats"]
+
+from os import environ
+from time import time
+import threading
+
+
+class Histogram(object):
+    """Distribution of a measure. The buckets are counted by their upper
+    bound, the last one being unbounded.
+    """
+
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+    def __init__(self, buckets=None):
+        super(Histogram, self).__init__()
+        self.buckets = tuple(buckets or self.BUCKETS)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        self.counts[index] += 1
+
+    def as_dict(self):
+        buckets = [str(bound) for bound in self.buckets] + ["inf"]
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.,
+            "min": self.min,
+            "max": self.max,
+            "buckets": dict(zip(buckets, self.counts))}
+
+
+class Stats(object):
+    """Named counters and histograms.
+
+    :param bool enabled: Collect the statistics, defaults to the
+        `MAPVIEW_STATS` environment variable
+    """
+
+    def __init__(self, enabled=None):
+        super(Stats, self).__init__()
+        if enabled is None:
+            enabled = environ.get("MAPVIEW_STATS", "") not in ("", "0")
+        self.enabled = enabled
+        self.counters = {}
+        self.histograms = {}
+        self.sinks = []
+        # the downloaders workers report too
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """Add `value` to a counter
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """Add a measure to a histogram
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def observe_since(self, name, start):
+        """Add the milliseconds elapsed since `start` to a histogram
+        """
+        if self.enabled:
+            self.observe(name, (time() - start) * 1000.)
+
+    def get_hit_ratio(self):
+        """Return the ratio of the cache hits, in memory (fallback textures)
+        or on the disk, among all the lookups: memory, disk and network.
+        """
+        counters = self.counters
+        hits = counters.get("cache.memory", 0) + counters.get("cache.disk", 0)
+        total = hits + counters.get("cache.network", 0)
+        return float(hits) / total if total else 0.
+
+    def as_dict(self):
+        """Return the statistics as a dict, suitable for json
+        """
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "histograms": dict(
+                    (name, histogram.as_dict())
+                    for name, histogram in self.histograms.items()),
+                "cache_hit_ratio": self.get_hit_ratio()}
+
+    def add_sink(self, sink):
+        """Add a callable receiving the dict of the statistics on
+        :meth:`push`
+        """
+        self.sinks.append(sink)
+
+    def remove_sink(self, sink):
+        self.sinks.remove(sink)
+
+    def push(self, reset=False):
+        """Send the statistics to the sinks, and reset them if asked
+        """
+        data = self.as_dict()
+        for sink in self.sinks:
+            sink(data)
+        if reset:
+            self.reset()
+        return data
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+#: Statistics shared by the views and the downloaders
+stats = Stats()
@@ -0,0 +1,156 @@
+# coding=utf-8
+"""
+Tile tracing
+============
+
+Timestamped lifecycle events of the tiles, sent to hooks installed by the
+application. The events of a tile are, in order:
+
+- `requested`: the view needs the tile, and created it
+- `cache-hit`: the tile was found in the disk cache or the mbtiles
+- `network-start`, `network-end`: the tile is downloaded
+- `decoded`: the image of the tile is loaded
+- `uploaded`: the texture is set on the tile, it starts to fade in
+- `visible`: the tile is fully displayed
+- `evicted`: the tile left the view
+
+A hook is called with `(event, key, timestamp)`, where `key` is
+`(cache_key, zoom, tile_x, tile_y)`, from the main thread or from the
+downloader workers. Without hooks, tracing costs a single test per event::
+
+    from mapview.trace import tracer, TileTimeline
+    timeline = TileTimeline()
+    tracer.add_hook(timeline)
+    ...
+    print(timeline.get_time_to_viewport(), timeline.get_wasted())
+
+The network and cache events come from the downloader, and are keyed by the
+source actually downloaded: the layers of a composite source are traced
+under their own cache key.
+"""
+
+__all__ = ["Tracer", "TileTimeline", "tracer", "EVENTS"]
+
+from time import time
+import threading
+
+EVENTS = ("requested", "cache-hit", "network-start", "network-end",
+          "decoded", "uploaded", "visible", "evicted")
+
+
+class Tracer(object):
+    """Dispatch the lifecycle events of the tiles to the hooks
+    """
+
+    def __init__(self):
+        super(Tracer, self).__init__()
+        self.hooks = []
+
+    def add_hook(self, hook):
+        """Add a callable receiving `(event, key, timestamp)`
+        """
+        self.hooks = self.hooks + [hook]
+
+    def remove_hook(self, hook):
+        hooks = list(self.hooks)
+        hooks.remove(hook)
+        self.hooks = hooks
+
+    def emit(self, event, cache_key, zoom, tile_x, tile_y):
+        """Send an event of the tile (zoom, tile_x, tile_y) of a source
+        """
+        # the list is replaced, never mutated: safe from the workers
+        hooks = self.hooks
+        if not hooks:
+            return
+        key = (cache_key, zoom, tile_x, tile_y)
+        timestamp = time()
+        for hook in hooks:
+            hook(event, key, timestamp)
+
+    def emit_tile(self, event, tile):
+        """Send an event of a :class:`~mapview.view.Tile`
+        """
+        if self.hooks:
+            self.emit(event, tile.map_source.cache_key, tile.zoom,
+                      tile.tile_x, tile.tile_y)
+
+
+class TileTimeline(object):
+    """Hook recording the events, and computing the loading metrics
+    """
+
+    def __init__(self):
+        super(TileTimeline, self).__init__()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event, key, timestamp):
+        with self._lock:
+            self.events.append((timestamp, event, key))
+
+    def clear(self):
+        with self._lock:
+            self.events = []
+
+    def get_events(self, key=None):
+        """Return the (timestamp, event, key) recorded, sorted by time, of
+        all the tiles or of a single one
+        """
+        with self._lock:
+            events = sorted(self.events, key=lambda item: item[0])
+        if key is not None:
+            events = [item for item in events if item[2] == key]
+        return events
+
+    def get_time_to_viewport(self, since=0):
+        """Return the seconds between the first tile requested after `since`
+        and the moment all the tiles requested were visible (or evicted), or
+        None if it did not happen yet.
+        """
+        pending = set()
+        first = None
+        for timestamp, event, key in self.get_events():
+            if timestamp < since:
+                continue
+            if event == "requested":
+                if first is None:
+                    first = timestamp
+                pending.add(key)
+            elif event in ("visible", "evicted") and key in pending:
+                pending.discard(key)
+                if not pending:
+                    return timestamp - first
+        return None
+
+    def get_wasted(self):
+        """Return the keys of the tiles downloaded, then evicted before being
+        visible, whether the download ended before or after the eviction. A
+        key is listed once per wasted download.
+        """
+        wasted = []
+        # per key, the flags of its current lifecycle
+        downloaded = set()
+        visible = set()
+        evicted = set()
+        for timestamp, event, key in self.get_events():
+            if event == "requested":
+                downloaded.discard(key)
+                visible.discard(key)
+                evicted.discard(key)
+            elif event in ("network-start", "network-end"):
+                if key in evicted and key not in downloaded and \
+                        key not in visible:
+                    wasted.append(key)
+                downloaded.add(key)
+            elif event == "visible":
+                visible.add(key)
+            elif event == "evicted" and key not in evicted:
+                evicted.add(key)
+                if key in downloaded and key not in visible:
+                    wasted.append(key)
+        return wasted
+
+
+#: Tracer shared by the views and the downloaders
+tracer = Tracer()
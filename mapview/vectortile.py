@@ -0,0 +1,335 @@
+# coding=utf-8
+"""
+Vector MBTiles provider for MapView
+===================================
+
+This provider renders vector .mbtiles (Mapbox Vector Tile, aka MVT/PBF)
+on the client side. Tiles are decoded and tesselated within the downloader
+threads into vertex buffers, then drawn into a texture with a small subset
+of the Mapbox GL style: background, fill and line colors, line width.
+
+Decoded tiles are cached, and zoom levels above the maximum zoom of the
+dataset are rendered from the matching quadrant of their ancestor, so one
+dataset covers every zoom level without fetching anything again.
+
+See: https://github.com/mapbox/vector-tile-spec
+"""
+
+__all__ = ["VectorMBTilesMapSource", "decode_tile"]
+
+from collections import OrderedDict
+from struct import unpack_from
+from kivy.graphics import Fbo, ClearColor, ClearBuffers, Color, Mesh, Line, \
+    Translate, Scale
+from kivy.graphics.tesselator import Tesselator, WINDING_ODD, TYPE_POLYGONS
+from kivy.utils import get_color_from_hex
+from mapview.mbtsource import MBTilesMapSource
+import threading
+import sqlite3
+import zlib
+
+
+GEOM_POINT = 1
+GEOM_LINESTRING = 2
+GEOM_POLYGON = 3
+
+CMD_MOVE_TO = 1
+CMD_LINE_TO = 2
+CMD_CLOSE_PATH = 7
+
+# Ordered list of (layer name, paint), drawn from the first to the last.
+# Layer names are the ones from the OpenMapTiles schema.
+DEFAULT_STYLE = [
+    ("background", {"background-color": "#f8f4f0"}),
+    ("landcover", {"fill-color": "#d8e8c8"}),
+    ("park", {"fill-color": "#c8dfb0"}),
+    ("landuse", {"fill-color": "#e8e0d8"}),
+    ("water", {"fill-color": "#a0c8f0"}),
+    ("waterway", {"line-color": "#a0c8f0", "line-width": 1}),
+    ("building", {"fill-color": "#d9d0c9"}),
+    ("boundary", {"line-color": "#9e9cab", "line-width": 1}),
+    ("transportation", {"line-color": "#ffffff", "line-width": 1.5}),
+]
+
+
+# minimal protobuf decoding, only what is needed by the MVT format
+
+def _read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _iter_fields(buf):
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _read_varint(buf, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = _read_varint(buf, pos)
+        elif wire_type == 1:
+            value = buf[pos:pos + 8]
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(buf, pos)
+            value = buf[pos:pos + length]
+            pos += length
+        elif wire_type == 5:
+            value = buf[pos:pos + 4]
+            pos += 4
+        else:
+            raise ValueError("Unsupported protobuf wire type {}".format(
+                wire_type))
+        yield field, wire_type, value
+
+
+def _read_packed(buf):
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = _read_varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _zigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def _decode_value(buf):
+    for field, wire_type, value in _iter_fields(buf):
+        if field == 1:
+            return bytes(value).decode("utf-8")
+        elif field == 2:
+            return unpack_from("<f", value)[0]
+        elif field == 3:
+            return unpack_from("<d", value)[0]
+        elif field in (4, 5):
+            if field == 4 and value >= 1 << 63:
+                value -= 1 << 64
+            return value
+        elif field == 6:
+            return _zigzag(value)
+        elif field == 7:
+            return bool(value)
+
+
+def _decode_geometry(commands):
+    # return a list of rings / lines / points, each one being a flat list of
+    # x, y in tile extent coordinates
+    rings = []
+    ring = None
+    x = y = 0
+    i = 0
+    count = len(commands)
+    while i < count:
+        command = commands[i]
+        cmd_id, cmd_count = command & 0x7, command >> 3
+        i += 1
+        if cmd_id == CMD_CLOSE_PATH:
+            if ring:
+                ring.extend(ring[:2])
+            continue
+        for _ in range(cmd_count):
+            x += _zigzag(commands[i])
+            y += _zigzag(commands[i + 1])
+            i += 2
+            if cmd_id == CMD_MOVE_TO:
+                ring = [x, y]
+                rings.append(ring)
+            else:
+                ring.extend((x, y))
+    return rings
+
+
+def _decode_feature(buf, keys, values):
+    tags = geometry = ()
+    geom_type = 0
+    for field, wire_type, value in _iter_fields(buf):
+        if field == 2:
+            tags = _read_packed(value)
+        elif field == 3:
+            geom_type = value
+        elif field == 4:
+            geometry = _read_packed(value)
+    properties = {}
+    for i in range(0, len(tags) - 1, 2):
+        properties[keys[tags[i]]] = values[tags[i + 1]]
+    return geom_type, properties, _decode_geometry(geometry)
+
+
+def decode_tile(data):
+    """Decode a MVT tile (optionally gzipped), and return a dict of
+    layer name -> (extent, features). Each feature is a tuple of
+    (geometry type, properties, rings), where a ring is a flat list of x, y
+    in the layer extent coordinates, y axis going down.
+    """
+    data = bytes(data)
+    if data[:2] == b"\x1f\x8b":
+        data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    data = bytearray(data)
+    layers = {}
+    for field, wire_type, layer in _iter_fields(data):
+        if field != 3:
+            continue
+        name = None
+        extent = 4096
+        keys = []
+        values = []
+        raw_features = []
+        for lfield, lwire_type, value in _iter_fields(layer):
+            if lfield == 1:
+                name = bytes(value).decode("utf-8")
+            elif lfield == 2:
+                raw_features.append(value)
+            elif lfield == 3:
+                keys.append(bytes(value).decode("utf-8"))
+            elif lfield == 4:
+                values.append(_decode_value(value))
+            elif lfield == 5:
+                extent = value
+        features = [_decode_feature(f, keys, values) for f in raw_features]
+        layers[name] = (extent, features)
+    return layers
+
+
+class VectorMBTilesMapSource(MBTilesMapSource):
+    """Use a vector .mbtiles as a source for a :class:`MapView`.
+
+    :param str filename: Vector mbtiles to read
+    :param list style: Ordered list of (layer name, paint). Defaults to
+        :data:`DEFAULT_STYLE`
+    :param int max_zoom: Maximum zoom of the view, tiles above the maximum
+        zoom of the dataset are overzoomed. Defaults to 22.
+    :param int cache_size: Number of decoded tiles kept in memory
+    """
+
+    is_vector = True
+
+    def __init__(self, filename, style=None, max_zoom=22, cache_size=64,
+                 **kwargs):
+        super(VectorMBTilesMapSource, self).__init__(filename, **kwargs)
+        self.style = style or DEFAULT_STYLE
+        self.data_max_zoom = self.max_zoom
+        self.max_zoom = max(max_zoom, self.data_max_zoom)
+        self.cache_size = cache_size
+        self._decoded = OrderedDict()
+        self._decoded_lock = threading.Lock()
+        self._ctx = threading.local()
+
+    def fill_tile(self, tile):
+        if tile.state == "done":
+            return
+        self.get_downloader(tile).submit(self._load_tile, tile)
+
+    def _load_tile(self, tile):
+        # zoom levels above the dataset are rendered from their ancestor
+        dz = max(0, tile.zoom - self.data_max_zoom)
+        zoom = tile.zoom - dz
+        tile_x = tile.tile_x >> dz
+        tile_y = tile.tile_y >> dz
+        buffers = self._get_buffers(zoom, tile_x, tile_y)
+        if buffers is None:
+            return self._load_tile_missing, (tile, )
+        ox = tile.tile_x - (tile_x << dz)
+        oy = tile.tile_y - (tile_y << dz)
+        return self._load_tile_done, (tile, buffers, dz, ox, oy)
+
+    def _get_buffers(self, zoom, tile_x, tile_y):
+        key = (zoom, tile_x, tile_y)
+        with self._decoded_lock:
+            buffers = self._decoded.get(key)
+            if buffers is not None:
+                self._decoded[key] = self._decoded.pop(key)
+                return buffers
+
+        # global db context cannot be shared across threads.
+        ctx = self._ctx
+        if not hasattr(ctx, "db"):
+            ctx.db = sqlite3.connect(self.filename)
+        c = ctx.db.cursor()
+        c.execute(
+            ("SELECT tile_data FROM tiles WHERE "
+            "zoom_level=? AND tile_column=? AND tile_row=?"),
+            (zoom, tile_x, tile_y))
+        row = c.fetchone()
+        if not row:
+            return
+
+        buffers = self._build_buffers(decode_tile(row[0]))
+        with self._decoded_lock:
+            self._decoded[key] = buffers
+            while len(self._decoded) > self.cache_size:
+                self._decoded.popitem(last=False)
+        return buffers
+
+    def _build_buffers(self, layers):
+        # convert the decoded layers into vertex buffers, ordered by style.
+        # Everything is expressed in tile pixels, y axis going up.
+        size = self.tile_size
+        buffers = []
+        for name, paint in self.style:
+            if name not in layers:
+                continue
+            extent, features = layers[name]
+            f = size / float(extent)
+            fill_color = paint.get("fill-color")
+            line_color = paint.get("line-color")
+            meshes = []
+            lines = []
+            for geom_type, properties, rings in features:
+                rings = [
+                    [v * f if i % 2 == 0 else size - v * f
+                     for i, v in enumerate(ring)]
+                    for ring in rings]
+                if geom_type == GEOM_POLYGON and fill_color:
+                    tess = Tesselator()
+                    for ring in rings:
+                        tess.add_contour(ring)
+                    if tess.tesselate(WINDING_ODD, TYPE_POLYGONS):
+                        meshes.extend(tess.meshes)
+                if geom_type in (GEOM_LINESTRING, GEOM_POLYGON) and \
+                        line_color:
+                    lines.extend(rings)
+            if meshes:
+                buffers.append(("mesh", fill_color, meshes))
+            if lines:
+                buffers.append((
+                    "line", line_color, lines, paint.get("line-width", 1)))
+        return buffers
+
+    def _load_tile_done(self, tile, buffers, dz, ox, oy):
+        if tile.state == "done":
+            return
+        size = self.tile_size
+        background = get_color_from_hex(
+            dict(self.style).get("background", {}).get(
+                "background-color", "#00000000"))
+        f = 2 ** dz
+        fbo = Fbo(size=(size, size))
+        with fbo:
+            ClearColor(*background)
+            ClearBuffers()
+            # render the quadrant of the ancestor when overzoomed
+            Translate(-ox * size, -oy * size, 0)
+            Scale(f, f, 1)
+            for item in buffers:
+                Color(*get_color_from_hex(item[1]))
+                if item[0] == "mesh":
+                    for vertices, indices in item[2]:
+                        Mesh(vertices=vertices, indices=indices,
+                             mode="triangle_fan")
+                else:
+                    width = item[3] / float(f)
+                    for points in item[2]:
+                        Line(points=points, width=width)
+        fbo.draw()
+        tile.texture = fbo.texture
+        tile.state = "need-animation"
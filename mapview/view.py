@@ -3,7 +3,9 @@
 __all__ = ["MapView", "MapMarker", "MapMarkerPopup", "MapLayer",
            "MarkerMapLayer"]
 
-from os.path import join, dirname
+from os.path import join, dirname, exists
+from collections import OrderedDict, deque
+from time import time
 from kivy.clock import Clock
 from kivy.metrics import dp
 from kivy.uix.widget import Widget
@@ -13,7 +15,9 @@ from kivy.uix.scatter import Scatter
 from kivy.uix.behaviors import ButtonBehavior
 from kivy.properties import NumericProperty, ObjectProperty, ListProperty, \
     AliasProperty, BooleanProperty, StringProperty
-from kivy.graphics import Canvas, Color, Rectangle
+from kivy.graphics import Canvas, Color, Rectangle, Fbo, ClearColor, \
+    ClearBuffers
+from kivy.core.image import Image as CoreImage
 from kivy.graphics.transformation import Matrix
 from kivy.lang import Builder
 from kivy.compat import string_types
@@ -21,12 +25,31 @@ from math import ceil
 from mapview import MIN_LONGITUDE, MAX_LONGITUDE, MIN_LATITUDE, MAX_LATITUDE, \
     CACHE_DIR, Coordinate, Bbox
 from mapview.source import MapSource
+from mapview.downloader import Downloader
+from mapview.stats import stats
+from mapview.trace import tracer
 from mapview.utils import clamp
 from itertools import takewhile
 
-import webbrowser
 
-Builder.load_string("""
+def _load_kv_first(kv, filename):
+    # the widgets are imported on first access (PEP 562), maybe after the kv
+    # of the app: keep our rules before its ones, so they still override us.
+    # This relies on the internals of the Builder, without them the rules are
+    # just loaded.
+    rules = getattr(Builder, "rules", None)
+    clear_matchcache = getattr(Builder, "_clear_matchcache", None)
+    if not isinstance(rules, list) or clear_matchcache is None:
+        Builder.load_string(kv, filename=filename)
+        return
+    count = len(rules)
+    Builder.load_string(kv, filename=filename)
+    if count and Builder.rules is rules:
+        rules[:] = rules[count:] + rules[:count]
+        clear_matchcache()
+
+
+_load_kv_first("""
 <MapMarker>:
     size_hint: None, None
     source: root.source
@@ -81,30 +104,99 @@ Builder.load_string("""
         center_x: root.center_x
         size: root.popup_size
 
-""")
+""", "mapview/view.kv")
 
 
 class ClickableLabel(Label):
     def on_ref_press(self, *args):
+        import webbrowser
         webbrowser.open(str(args[0]), new=2)
 
 
+def _range_difference(old, new):
+    # yield the cells (x, y) of the tile range `old` that are not in `new`,
+    # a range being (x_first, y_first, x_last, y_last), last excluded.
+    ox0, oy0, ox1, oy1 = old
+    nx0, ny0, nx1, ny1 = new
+    for x in range(ox0, ox1):
+        if x < nx0 or x >= nx1:
+            for y in range(oy0, oy1):
+                yield x, y
+            continue
+        for y in range(oy0, min(oy1, ny0)):
+            yield x, y
+        for y in range(max(oy0, ny1), oy1):
+            yield x, y
+
+
 class Tile(Rectangle):
+    __slots__ = ("cache_dir", "map_source", "zoom", "tile_x", "tile_y",
+                 "downloader", "opacity", "g_color", "atlas_slot",
+                 "on_need_animation", "on_done", "generation", "priority", "_state",
+                 "_cache_fn")
+
     def __init__(self, *args, **kwargs):
         super(Tile, self).__init__(*args, **kwargs)
         self.cache_dir = kwargs.get('cache_dir', CACHE_DIR)
+        self.map_source = None
+        self.zoom = self.tile_x = self.tile_y = None
+        self.downloader = None
+        self.opacity = 1.
+        self.g_color = Color(1, 1, 1, 0)
+        self.atlas_slot = None
+        # called with the tile when its texture is ready to fade in, and
+        # when it is given up (failed, missing or evicted)
+        self.on_need_animation = None
+        self.on_done = None
+        # changed each time the tile is reused for another cell
+        self.generation = 0
+        # the downloader applies the lowest priorities first
+        self.priority = 0
+        self._state = None
+        self._cache_fn = None
+
+    def reset(self, map_source, zoom, tile_x, tile_y, cache_dir=CACHE_DIR):
+        """Prepare the tile to display another cell
+        """
+        self.generation += 1
+        self.cache_dir = cache_dir
+        self.map_source = map_source
+        self.zoom = zoom
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.texture = None
+        self.g_color.rgba = (1, 1, 1, 0)
+        self.atlas_slot = None
+        self.priority = 0
+        self._state = None
+        self._cache_fn = None
+
+    @property
+    def state(self):
+        return self._state
+
+    @state.setter
+    def state(self, value):
+        self._state = value
+        if value == "need-animation":
+            tracer.emit_tile("uploaded", self)
+            if self.on_need_animation is not None:
+                self.on_need_animation(self)
+        elif value == "done" and self.on_done is not None:
+            self.on_done(self)
 
     @property
     def cache_fn(self):
-        map_source = self.map_source
-        fn = map_source.cache_fmt.format(
-            image_ext=map_source.image_ext,
-            cache_key=map_source.cache_key,
-            **self.__dict__)
-        return join(self.cache_dir, fn)
+        # computed once, the downloader asks for it on each step
+        cache_fn = self._cache_fn
+        if cache_fn is None:
+            cache_fn = self._cache_fn = self.map_source.get_cache_fn(
+                self.zoom, self.tile_x, self.tile_y, self.cache_dir)
+        return cache_fn
 
     def set_source(self, cache_fn):
         self.source = cache_fn
+        tracer.emit_tile("decoded", self)
         self.state = "need-animation"
 
 
@@ -182,6 +274,17 @@ class MapLayer(Widget):
     viewport_x = NumericProperty(0)
     viewport_y = NumericProperty(0)
 
+    name = StringProperty("")
+    """Name of the layer in the statistics of the :class:`MapView`. Defaults
+    to the class and the id of the layer.
+    """
+
+    cheap = BooleanProperty(True)
+    """If True, :meth:`reposition` is fast enough to be called on every move
+    of the map. Otherwise, it may be deferred to a later frame when the
+    frame budget of the :class:`MapView` is spent. Defaults to True.
+    """
+
     def reposition(self):
         """Function called when :class:`MapView` is moved. You must recalculate
         the position of your children.
@@ -307,6 +410,68 @@ class MapView(Widget):
     Default to 100 as 100ms. Use 0 to deactivate.
     """
 
+    fallback_zoom_levels = NumericProperty(4)
+    """Number of zoom levels to look at for an already loaded tile to display
+    while a tile is loading: the matching quadrant of a parent tile, or a
+    mosaic of the children tiles, is shown until the real tile is ready.
+    Parents are looked up in memory, then in the disk cache.
+    Defaults to 4. Use 0 to deactivate.
+    """
+
+    texture_cache_size = NumericProperty(256)
+    """Number of tile textures kept in memory when they leave the view, in
+    order to be used as fallback. Defaults to 256.
+    """
+
+    prefetch_margin = NumericProperty(1)
+    """Number of tiles to prefetch in the cache around the viewport, at low
+    priority. The ring is extended ahead of the current pan, depending of its
+    velocity. Defaults to 1. Use 0 to deactivate.
+    """
+
+    prefetch_next_zoom = BooleanProperty(True)
+    """If True, the tiles of the zoom level the user is pinching toward are
+    prefetched in the cache as well. Defaults to True.
+    """
+
+    update_budget = NumericProperty(8)
+    """Time budget of a map update within a frame, in milliseconds. The
+    layers that are not :attr:`~MapLayer.cheap` and the eviction of the
+    background tiles run when time is left, or in the next frames.
+    Defaults to 8.
+    """
+
+    background_zoom_levels = NumericProperty(2)
+    """Maximum number of previous zoom levels kept in the background while
+    the tiles of the current level are loading. The levels nearest to the
+    current one are kept. Defaults to 2. Use 0 to deactivate.
+    """
+
+    background_max_bytes = NumericProperty(32 * 1024 * 1024)
+    """Maximum size of the textures kept in the background, in bytes,
+    estimated from the tile size. Defaults to 32MB.
+    """
+
+    composite_overlays = BooleanProperty(False)
+    """If True, the map source and the overlays are blended into a single
+    texture per tile off the main thread, see
+    :class:`~mapview.composite.CompositeMapSource` (requires Pillow).
+    Otherwise, each overlay have its own tiles drawn over the map. Defaults
+    to False.
+    """
+
+    use_atlas = BooleanProperty(False)
+    """If True, the loaded tiles are packed into a few large textures, and
+    drawn with one mesh per texture instead of one rectangle per tile, see
+    :class:`~mapview.atlas.TileAtlas`. Defaults to False.
+    """
+
+    downloader = ObjectProperty(None, allownone=True)
+    """:class:`~mapview.downloader.Downloader` used by this view, for the
+    sources without their own downloader. Defaults to None, the downloader
+    shared by the :attr:`cache_dir` is used.
+    """
+
     delta_x = NumericProperty(0)
     delta_y = NumericProperty(0)
     background_color = ListProperty([181 / 255., 208 / 255., 208 / 255., 1])
@@ -316,6 +481,16 @@ class MapView(Widget):
     _scale = 1.
     _disabled_count = 0
 
+    # duration of the motion history used for prefetching, and how far ahead
+    # the pan is anticipated (seconds)
+    MOTION_WINDOW = .3
+    PREFETCH_LOOKAHEAD = .5
+    # number of released tiles kept for reuse
+    TILE_POOL_SIZE = 256
+    # see mapview.stats and mapview.trace
+    stats = stats
+    tracer = tracer
+
     __events__ = ["on_map_relocated"]
 
     # Public API
@@ -496,6 +671,8 @@ class MapView(Widget):
         """
         c = self.canvas
         self._layers.remove(layer)
+        if layer in self._deferred_layers:
+            self._deferred_layers.remove(layer)
         self.canvas = layer.canvas_parent
         super(MapView, self).remove_widget(layer)
         self.canvas = c
@@ -513,13 +690,30 @@ class MapView(Widget):
         from kivy.base import EventLoop
         EventLoop.ensure_window()
         self._invalid_scale = True
-        self._tiles = []
-        self._tiles_bg = []
-        self._tilemap = {}
+        # (zoom, x, y) -> tiles of the cell (the map and its overlays)
+        self._tiles = {}
+        # zoom -> {(zoom, x, y): tiles} of the previous levels
+        self._tiles_bg = {}
+        # zoom -> (tile range, origin) at the last update of the level
+        self._tile_ranges = {}
+        self._tile_pool = []
+        # tiles of the current level not displayed yet, the background is
+        # dropped when there is none left
+        self._pending_tiles = set()
+        self._texture_cache = OrderedDict()
+        self._motion = deque(maxlen=8)
+        self._prefetch_key = None
         self._layers = []
+        # where the user looks at, if not the center: the zoom point
+        self._focus = None
         self._default_marker_layer = None
         self._need_redraw_all = False
         self._transform_lock = False
+        # work left over by the updates, done within the frame budget
+        self._deferred_layers = []
+        self._background_dirty = False
+        self._deferred_event = None
+        self._update_trigger = Clock.create_trigger(self.do_update, -1)
         self.trigger_update(True)
         self.canvas = Canvas()
         self._scatter = MapViewScatter()
@@ -531,39 +725,75 @@ class MapView(Widget):
             self.canvas_layers_out = Canvas()
         self._scale_target_anim = False
         self._scale_target = 1.
-        self._touch_count = 0
+        self._touches = []
         self.map_source.cache_dir = self.cache_dir
-        Clock.schedule_interval(self._animate_color, 1 / 60.)
+        self._overlays = []
+        self._composite_source = None
+        self._atlas = None
+        # tiles fading in, the fade clock only runs while there are some
+        self._fading = set()
+        self._fade_event = None
         self.lat = kwargs.get("lat", self.lat)
         self.lon = kwargs.get("lon", self.lon)
         super(MapView, self).__init__(**kwargs)
 
-    def _animate_color(self, dt):
+    def _start_fade(self, tile):
+        # a late texture of a tile that left the view is not displayed
+        if not self._holds_tile(tile):
+            return
         # fast path
-        d = self.animation_duration
-        if d == 0:
-            for tile in self._tiles:
-                if tile.state == "need-animation":
-                    tile.g_color.a = 1.
-                    tile.state = "animated"
-            for tile in self._tiles_bg:
-                if tile.state == "need-animation":
-                    tile.g_color.a = 1.
-                    tile.state = "animated"
-        else:
-            d = d / 1000.
-            for tile in self._tiles:
-                if tile.state != "need-animation":
-                    continue
-                tile.g_color.a += dt / d
-                if tile.g_color.a >= 1:
-                    tile.state = "animated"
-            for tile in self._tiles_bg:
-                if tile.state != "need-animation":
-                    continue
-                tile.g_color.a += dt / d
-                if tile.g_color.a >= 1:
-                    tile.state = "animated"
+        if self.animation_duration == 0:
+            self._end_fade(tile)
+            if self._atlas is not None:
+                self._atlas.update()
+            return
+        self._fading.add(tile)
+        if self._fade_event is None:
+            self._fade_event = Clock.schedule_interval(
+                self._animate_color, 1 / 60.)
+
+    def _end_fade(self, tile):
+        if not self._holds_tile(tile):
+            return
+        tile.g_color.a = tile.opacity
+        tile.state = "animated"
+        self.tracer.emit_tile("visible", tile)
+        self._pack_tile(tile)
+        self._settle_tile(tile)
+
+    def _holds_tile(self, tile):
+        # the tile is still in a level of the view, front or background
+        key = (tile.zoom, tile.tile_x, tile.tile_y)
+        return tile in self._tiles.get(key, ()) or \
+            tile in self._tiles_bg.get(tile.zoom, {}).get(key, ())
+
+    def _settle_tile(self, tile):
+        # a tile of the current level is displayed, or failed to load
+        pending = self._pending_tiles
+        if tile in pending:
+            pending.discard(tile)
+            if not pending and self._tiles_bg:
+                self._drop_background()
+
+    def _animate_color(self, dt):
+        fading = self._fading
+        d = self.animation_duration / 1000.
+        for tile in list(fading):
+            # the tile may have left the view meanwhile
+            if tile.state != "need-animation":
+                fading.discard(tile)
+                continue
+            alpha = tile.g_color.a + dt / d if d else tile.opacity
+            if alpha >= tile.opacity:
+                fading.discard(tile)
+                self._end_fade(tile)
+            else:
+                tile.g_color.a = alpha
+        if not fading and self._fade_event is not None:
+            self._fade_event.cancel()
+            self._fade_event = None
+        if self._atlas is not None:
+            self._atlas.update()
 
     def add_widget(self, widget):
         if isinstance(widget, MapMarker):
@@ -607,6 +837,8 @@ class MapView(Widget):
         ret = self._scale_target != 0
         if not ret:
             self._pause = False
+            if not self._touches:
+                self._focus = None
         return ret
 
     def diff_scale_at(self, d, x, y):
@@ -630,39 +862,62 @@ class MapView(Widget):
         if "button" in touch.profile and touch.button in (
         "scrolldown", "scrollup"):
             d = 1 if touch.button == "scrollup" else -1
+            self._focus = touch.pos
             self.animated_diff_scale_at(d, *touch.pos)
             return True
         elif touch.is_double_tap and self.double_tap_zoom:
+            self._focus = touch.pos
             self.animated_diff_scale_at(1, *touch.pos)
             return True
         touch.grab(self)
-        self._touch_count += 1
-        if self._touch_count == 1:
+        self._touches.append(touch)
+        self._update_focus()
+        if len(self._touches) == 1:
             self._touch_zoom = (self.zoom, self._scale)
         return super(MapView, self).on_touch_down(touch)
 
+    def on_touch_move(self, touch):
+        if touch.grab_current == self and len(self._touches) > 1:
+            self._update_focus()
+        return super(MapView, self).on_touch_move(touch)
+
     def on_touch_up(self, touch):
         if touch.grab_current == self:
             touch.ungrab(self)
-            self._touch_count -= 1
-            if self._touch_count == 0:
+            if touch in self._touches:
+                self._touches.remove(touch)
+            self._update_focus()
+            if not self._touches:
                 # animate to the closest zoom
                 zoom, scale = self._touch_zoom
                 cur_zoom = self.zoom
                 cur_scale = self._scale
                 if cur_zoom < zoom or cur_scale < scale:
+                    self._focus = touch.pos
                     self.animated_diff_scale_at(1. - cur_scale, *touch.pos)
                 elif cur_zoom > zoom or cur_scale > scale:
+                    self._focus = touch.pos
                     self.animated_diff_scale_at(2. - cur_scale, *touch.pos)
                 self._pause = False
             return True
         return super(MapView, self).on_touch_up(touch)
 
+    def _update_focus(self):
+        # a pan looks at the center, a pinch between the fingers
+        touches = self._touches
+        if len(touches) > 1:
+            count = float(len(touches))
+            self._focus = (sum(touch.x for touch in touches) / count,
+                           sum(touch.y for touch in touches) / count)
+        else:
+            self._focus = None
+
     def on_transform(self, *args):
         self._invalid_scale = True
         if self._transform_lock:
             return
         self._transform_lock = True
+        self._record_motion()
         # recalculate viewport
         map_source = self.map_source
         zoom = self._zoom
@@ -690,6 +945,102 @@ class MapView(Widget):
         self._transform_lock = False
         self._scale = self._scatter.scale
 
+    def _record_motion(self):
+        scatter = self._scatter
+        vx, vy = self.viewport_pos
+        self._motion.append((time(), self._zoom, vx, vy,
+                             2 ** self._zoom * scatter.scale))
+
+    def _get_motion(self):
+        # estimate the pan velocity (in tiles per second) and the zoom
+        # direction from the recent transformations
+        motion = [m for m in self._motion if time() - m[0] < self.MOTION_WINDOW]
+        if len(motion) < 2:
+            return 0, 0, 0
+        t1, zoom1, vx1, vy1, scale1 = motion[-1]
+        scale0 = motion[0][4]
+        # viewport positions are comparable only within the same zoom
+        t0, _, vx0, vy0, _ = [m for m in motion if m[1] == zoom1][0]
+        vel_x = vel_y = 0
+        dt = t1 - t0
+        if dt > 0:
+            size = self.map_source.dp_tile_size
+            vel_x = (vx1 - vx0) / size / dt
+            vel_y = (vy1 - vy0) / size / dt
+        dir_z = 0
+        if scale1 > scale0 * 1.01:
+            dir_z = 1
+        elif scale1 < scale0 / 1.01:
+            dir_z = -1
+        return vel_x, vel_y, dir_z
+
+    def _prefetch_tiles(self):
+        margin = int(self.prefetch_margin)
+        if margin <= 0 and not self.prefetch_next_zoom:
+            return
+        map_source = self.map_source
+        zoom = self._zoom
+        vx, vy = self.viewport_pos
+        x0, y0, x1, y1, _, _ = self.bbox_for_zoom(
+            vx, vy, self.width, self.height, zoom)
+        vel_x, vel_y, dir_z = self._get_motion()
+        lookahead = self.PREFETCH_LOOKAHEAD
+        ahead_x = min(margin * 2, int(ceil(abs(vel_x) * lookahead)))
+        ahead_y = min(margin * 2, int(ceil(abs(vel_y) * lookahead)))
+        ex0 = x0 - margin - (ahead_x if vel_x < 0 else 0)
+        ex1 = x1 + margin + (ahead_x if vel_x > 0 else 0)
+        ey0 = y0 - margin - (ahead_y if vel_y < 0 else 0)
+        ey1 = y1 + margin + (ahead_y if vel_y > 0 else 0)
+
+        key = (zoom, x0, y0, x1, y1, ex0, ey0, ex1, ey1, dir_z)
+        if key == self._prefetch_key:
+            return
+        self._prefetch_key = key
+
+        tiles = []
+        if margin > 0:
+            max_x = map_source.get_col_count(zoom)
+            max_y = map_source.get_row_count(zoom)
+            ring = [
+                (zoom, x, y)
+                for x in range(max(0, ex0), min(max_x, ex1))
+                for y in range(max(0, ey0), min(max_y, ey1))
+                if not (x0 <= x < x1 and y0 <= y < y1)]
+
+            # closest tiles first, and the ones ahead of the pan first
+            def priority(t):
+                x, y = t[1], t[2]
+                distance = max(x0 - x, x - x1 + 1, y0 - y, y - y1 + 1)
+                ahead = (vel_x > 0 and x >= x1) or (vel_x < 0 and x < x0) or \
+                    (vel_y > 0 and y >= y1) or (vel_y < 0 and y < y0)
+                return distance, not ahead
+            ring.sort(key=priority)
+            tiles.extend(ring)
+
+        next_zoom = zoom + dir_z
+        if self.prefetch_next_zoom and dir_z and \
+                map_source.get_min_zoom() <= next_zoom <= \
+                map_source.get_max_zoom():
+            if dir_z > 0:
+                # children of the center of the view
+                w = (x1 - x0) / 2.
+                h = (y1 - y0) / 2.
+                cx = (x0 + x1) / 2.
+                cy = (y0 + y1) / 2.
+                nx0, nx1 = int(2 * (cx - w / 2.)), int(ceil(2 * (cx + w / 2.)))
+                ny0, ny1 = int(2 * (cy - h / 2.)), int(ceil(2 * (cy + h / 2.)))
+            else:
+                nx0, nx1 = (x0 >> 1) - 1, ((x1 - 1) >> 1) + 2
+                ny0, ny1 = (y0 >> 1) - 1, ((y1 - 1) >> 1) + 2
+            max_x = map_source.get_col_count(next_zoom)
+            max_y = map_source.get_row_count(next_zoom)
+            tiles.extend(
+                (next_zoom, x, y)
+                for x in range(max(0, nx0), min(max_x, nx1))
+                for y in range(max(0, ny0), min(max_y, ny1)))
+
+        map_source.prefetch_tiles(tiles, self.cache_dir, self.downloader)
+
     def _apply_bounds(self):
         # if the map_source have any constraints, apply them here.
         map_source = self.map_source
@@ -723,11 +1074,12 @@ class MapView(Widget):
             self.trigger_update(True)
 
     def trigger_update(self, full):
+        # the transform events of a frame are coalesced into one update
         self._need_redraw_full = full or self._need_redraw_full
-        Clock.unschedule(self.do_update)
-        Clock.schedule_once(self.do_update, -1)
+        self._update_trigger()
 
     def do_update(self, dt):
+        start = time()
         zoom = self._zoom
         scale = self._scale
         self.lon = self.map_source.get_lon(zoom,
@@ -737,15 +1089,57 @@ class MapView(Widget):
                                            (
                                            self.center_y - self._scatter.y) / scale - self.delta_y)
         self.dispatch("on_map_relocated", zoom, Coordinate(self.lon, self.lat))
+        deferred = self._deferred_layers
         for layer in self._layers:
-            layer.reposition()
+            if layer.cheap:
+                self._reposition_layer(layer)
+            elif layer not in deferred:
+                deferred.append(layer)
 
         if self._need_redraw_full:
             self._need_redraw_full = False
             self.move_tiles_to_background()
             self.load_visible_tiles()
         else:
-            self.load_visible_tiles()
+            # while panning, the background tiles don't move, evicting them
+            # can wait until a tile boundary is crossed.
+            if self.load_visible_tiles(background=False) and self._tiles_bg:
+                self._background_dirty = True
+
+        if not self._pause:
+            self._prefetch_tiles()
+        self._run_deferred(start)
+        self.stats.observe_since("mapview.update_ms", start)
+
+    def _reposition_layer(self, layer):
+        if not self.stats.enabled:
+            layer.reposition()
+            return
+        start = time()
+        layer.reposition()
+        name = layer.name or "{}-{:x}".format(type(layer).__name__, id(layer))
+        self.stats.observe_since("layer.{}.reposition_ms".format(name), start)
+
+    def _run_deferred(self, start):
+        # at least one item is done per call, so nothing starves during a
+        # long pan. The rest waits for the next frame.
+        deadline = start + self.update_budget / 1000.
+        deferred = self._deferred_layers
+        while deferred or self._background_dirty:
+            if deferred:
+                self._reposition_layer(deferred.pop(0))
+            else:
+                self._background_dirty = False
+                self._update_background()
+            if time() >= deadline:
+                break
+        if (deferred or self._background_dirty) and \
+                self._deferred_event is None:
+            self._deferred_event = Clock.schedule_once(self._do_deferred)
+
+    def _do_deferred(self, dt):
+        self._deferred_event = None
+        self._run_deferred(time())
 
     def bbox_for_zoom(self, vx, vy, w, h, zoom):
         # return a tile-bbox for the zoom
@@ -771,7 +1165,7 @@ class MapView(Widget):
         return (tile_x_first, tile_y_first, tile_x_last, tile_y_last,
                 x_count, y_count)
 
-    def load_visible_tiles(self):
+    def load_visible_tiles(self, background=True):
         map_source = self.map_source
         vx, vy = self.viewport_pos
         zoom = self._zoom
@@ -787,46 +1181,21 @@ class MapView(Widget):
         #    tile_x_last, tile_y_last)
 
         # Adjust tiles behind us
-        for tile in self._tiles_bg[:]:
-            tile_x = tile.tile_x
-            tile_y = tile.tile_y
-
-            f = 2 ** (zoom - tile.zoom)
-            w = self.width / f
-            h = self.height / f
-            btile_x_first, btile_y_first, btile_x_last, btile_y_last, \
-            _, _ = bbox_for_zoom(vx / f, vy / f, w, h, tile.zoom)
-
-            if tile_x < btile_x_first or tile_x >= btile_x_last or \
-                    tile_y < btile_y_first or tile_y >= btile_y_last:
-                tile.state = "done"
-                self._tiles_bg.remove(tile)
-                self.canvas_map.before.remove(tile.g_color)
-                self.canvas_map.before.remove(tile)
-                continue
+        if background:
+            self._update_background()
 
-            tsize = size * f
-            tile.size = tsize, tsize
-            tile.pos = (
-                tile_x * tsize + self.delta_x,
-                tile_y * tsize + self.delta_y)
+        # while panning within the same tiles, the scatter transform moves
+        # them, and the grid is unchanged.
+        tile_range = (tile_x_first, tile_y_first, tile_x_last, tile_y_last)
+        if self._tile_ranges.get(zoom) == (
+                tile_range, (self.delta_x, self.delta_y, size)):
+            return False
 
         # Get rid of old tiles first
-        for tile in self._tiles[:]:
-            tile_x = tile.tile_x
-            tile_y = tile.tile_y
-
-            if tile_x < tile_x_first or tile_x >= tile_x_last or \
-                    tile_y < tile_y_first or tile_y >= tile_y_last:
-                tile.state = "done"
-                self.tile_map_set(tile_x, tile_y, False)
-                self._tiles.remove(tile)
-                self.canvas_map.remove(tile)
-                self.canvas_map.remove(tile.g_color)
-            else:
-                tile.size = (size, size)
-                tile.pos = (
-                tile_x * size + self.delta_x, tile_y * size + self.delta_y)
+        self._update_level(self._tiles, zoom, tile_range, size,
+                           self.canvas_map)
+        if self._atlas is not None:
+            self._atlas.update()
 
         # Load new tiles if needed
         x = tile_x_first + x_count // 2 - 1
@@ -848,28 +1217,275 @@ class MapView(Widget):
                 arm_size += 1
 
             turn += 1
+        self._update_priorities()
+        # the last pending tiles may have left the view
+        if not self._pending_tiles and self._tiles_bg:
+            self._drop_background()
+        return True
+
+    def _update_priorities(self):
+        # squared distance of the tiles to the focus, in tiles
+        fx, fy = self._focus or self.center
+        scatter = self._scatter
+        scale = self.scale
+        size = float(self.map_source.dp_tile_size)
+        fx = ((fx - scatter.x) / scale - self.delta_x) / size - .5
+        fy = ((fy - scatter.y) / scale - self.delta_y) / size - .5
+        for cell in self._tiles.values():
+            for tile in cell:
+                tile.priority = (tile.tile_x - fx) ** 2 + \
+                    (tile.tile_y - fy) ** 2
+
+    def _update_background(self):
+        vx, vy = self.viewport_pos
+        zoom = self._zoom
+        size = self.map_source.dp_tile_size
+        for bzoom, level in list(self._tiles_bg.items()):
+            f = 2 ** (zoom - bzoom)
+            brange = self.bbox_for_zoom(
+                vx / f, vy / f, self.width / f, self.height / f, bzoom)[:4]
+            self._update_level(level, bzoom, brange, size * f,
+                               self.canvas_map.before)
+            if not level:
+                del self._tiles_bg[bzoom]
+                self._tile_ranges.pop(bzoom, None)
+
+    def _update_level(self, tiles, zoom, tile_range, size, canvas):
+        # evict the tiles of a level that left the range, and move the
+        # others only if the origin of the map changed. Compared to the last
+        # update, only the cells that left the range are visited.
+        x0, y0, x1, y1 = tile_range
+        origin = (self.delta_x, self.delta_y, size)
+        previous = self._tile_ranges.get(zoom)
+        if previous is None:
+            evicted = [key for key in tiles
+                       if not (x0 <= key[1] < x1 and y0 <= key[2] < y1)]
+        else:
+            evicted = [(zoom, x, y)
+                       for x, y in _range_difference(previous[0], tile_range)]
+        for key in evicted:
+            for tile in tiles.pop(key, ()):
+                self._release_tile(tile, canvas)
+        if previous is None or previous[1] != origin:
+            for cell in tiles.values():
+                for tile in cell:
+                    self._place_tile(tile, size)
+        self._tile_ranges[zoom] = (tile_range, origin)
+
+    def _place_tile(self, tile, size):
+        tile.size = size, size
+        tile.pos = (tile.tile_x * size + self.delta_x,
+                    tile.tile_y * size + self.delta_y)
+        if tile.atlas_slot is not None:
+            self._atlas.update_tile(tile)
+
+    def _release_tile(self, tile, canvas):
+        self._pending_tiles.discard(tile)
+        self._remember_tile(tile)
+        loaded = tile.state in ("need-animation", "animated")
+        tile.state = "done"
+        self.tracer.emit_tile("evicted", tile)
+        self._fading.discard(tile)
+        if tile.atlas_slot is not None:
+            self._atlas.remove(tile)
+        else:
+            canvas.remove(tile.g_color)
+            canvas.remove(tile)
+        if loaded:
+            self._recycle_tile(tile)
+
+    def _recycle_tile(self, tile):
+        # a tile still loading may be referenced by the downloader, only the
+        # loaded ones are reused.
+        self._fading.discard(tile)
+        if len(self._tile_pool) < self.TILE_POOL_SIZE:
+            tile.texture = None
+            self._tile_pool.append(tile)
+
+    def get_downloader(self):
+        """Return the downloader used by this view
+        """
+        if self.downloader is not None:
+            return self.downloader
+        return Downloader.instance(self.cache_dir)
+
+    def add_overlay(self, map_source, opacity=1.):
+        """Add a raster source drawn over the map, ie: hillshade or transit
+        lines. `map_source` is a :class:`MapSource` or a provider key.
+        """
+        if isinstance(map_source, string_types):
+            map_source = MapSource.from_provider(
+                map_source, cache_dir=self.cache_dir)
+        self._overlays.append((map_source, opacity))
+        self._reset_overlays()
+        return map_source
+
+    def remove_overlay(self, map_source):
+        """Remove an overlay added with :meth:`add_overlay`
+        """
+        self._overlays = [
+            (source, opacity) for source, opacity in self._overlays
+            if source is not map_source]
+        self._reset_overlays()
+
+    def _reset_overlays(self):
+        self._composite_source = None
+        self.remove_all_tiles()
+        self.trigger_update(True)
+
+    def on_composite_overlays(self, instance, value):
+        if self._overlays:
+            self._reset_overlays()
+
+    def _get_composite_source(self):
+        if self._composite_source is None:
+            from mapview.composite import CompositeMapSource
+            self._composite_source = CompositeMapSource(
+                [(self.map_source, 1.)] + self._overlays,
+                cache_dir=self.cache_dir)
+        return self._composite_source
 
     def load_tile(self, x, y, size, zoom):
-        if self.tile_in_tile_map(x, y) or zoom != self._zoom:
+        if (zoom, x, y) in self._tiles or zoom != self._zoom:
             return
-        self.load_tile_for_source(self.map_source, 1., size, x, y, zoom)
-        # XXX do overlay support
-        self.tile_map_set(x, y, True)
+        if self._overlays and self.composite_overlays:
+            self.load_tile_for_source(
+                self._get_composite_source(), 1., size, x, y, zoom)
+        else:
+            self.load_tile_for_source(self.map_source, 1., size, x, y, zoom)
+            for map_source, opacity in self._overlays:
+                if map_source.min_zoom <= zoom <= map_source.max_zoom:
+                    self.load_tile_for_source(
+                        map_source, opacity, size, x, y, zoom)
 
     def load_tile_for_source(self, map_source, opacity, size, x, y, zoom):
-        tile = Tile(size=(size, size), cache_dir=self.cache_dir)
-        tile.g_color = Color(1, 1, 1, 0)
-        tile.tile_x = x
-        tile.tile_y = y
-        tile.zoom = zoom
+        pool = self._tile_pool
+        tile = pool.pop() if pool else Tile()
+        tile.reset(map_source, zoom, x, y, self.cache_dir)
+        tile.downloader = self.downloader
+        tile.opacity = opacity
+        tile.on_need_animation = self._start_fade
+        tile.on_done = self._settle_tile
+        tile.size = (size, size)
         tile.pos = (x * size + self.delta_x, y * size + self.delta_y)
-        tile.map_source = map_source
         tile.state = "loading"
+        self._pending_tiles.add(tile)
+        self.tracer.emit_tile("requested", tile)
+        # registered first, a source may fill the tile right away
+        self._tiles.setdefault((zoom, x, y), []).append(tile)
         if not self._pause:
             map_source.fill_tile(tile)
+        self._fill_tile_from_fallback(tile)
         self.canvas_map.add(tile.g_color)
         self.canvas_map.add(tile)
-        self._tiles.append(tile)
+        return tile
+
+    def _remember_tile(self, tile):
+        # keep the texture of a loaded tile, to be used later as fallback
+        if tile.state not in ("need-animation", "animated") or \
+                tile.texture is None:
+            return
+        self._remember_texture(tile.map_source, tile.zoom, tile.tile_x,
+                               tile.tile_y, tile.texture)
+
+    def _remember_texture(self, map_source, zoom, x, y, texture):
+        cache = self._texture_cache
+        key = (map_source.cache_key, zoom, x, y)
+        cache.pop(key, None)
+        cache[key] = texture
+        while len(cache) > self.texture_cache_size:
+            cache.popitem(last=False)
+
+    def _fill_tile_from_fallback(self, tile):
+        # display something from the already loaded zoom levels while the
+        # tile is loading
+        levels = int(self.fallback_zoom_levels)
+        if not levels:
+            return
+        map_source = tile.map_source
+        cache = self._texture_cache
+        cache_key = map_source.cache_key
+        zoom = tile.zoom
+        x = tile.tile_x
+        y = tile.tile_y
+        levels = [d for d in range(1, levels + 1) if zoom - d >= 0]
+
+        # quadrant of a parent tile
+        for d in levels:
+            texture = cache.get((cache_key, zoom - d, x >> d, y >> d))
+            if texture is not None:
+                self.stats.incr("cache.memory")
+                self._set_fallback(tile, self._get_quadrant(texture, d, x, y))
+                return
+
+        # mosaic of the children tiles
+        children = []
+        for i in (0, 1):
+            for j in (0, 1):
+                texture = cache.get((cache_key, zoom + 1, x * 2 + i, y * 2 + j))
+                if texture is not None:
+                    children.append((i, j, texture))
+        if children:
+            self.stats.incr("cache.memory")
+            self._set_fallback(tile, self._get_mosaic(map_source, children))
+            return
+
+        # quadrant of a parent tile from the disk cache
+        if levels:
+            candidates = [
+                (d, map_source.get_cache_fn(
+                    zoom - d, x >> d, y >> d, tile.cache_dir))
+                for d in levels]
+            self.get_downloader().submit(
+                self._load_fallback, tile, tile.generation, candidates)
+
+    def _load_fallback(self, tile, generation, candidates):
+        for d, cache_fn in candidates:
+            if tile.state != "loading" or tile.generation != generation:
+                return
+            if exists(cache_fn):
+                im = CoreImage(cache_fn, nocache=True)
+                return self._load_fallback_done, (tile, generation, im, d)
+
+    def _load_fallback_done(self, tile, generation, im, d):
+        # the tile may have been reused for another cell meanwhile
+        if tile.generation != generation:
+            return
+        x = tile.tile_x
+        y = tile.tile_y
+        texture = im.texture
+        self._remember_texture(
+            tile.map_source, tile.zoom - d, x >> d, y >> d, texture)
+        if tile.state != "loading":
+            return
+        self._set_fallback(tile, self._get_quadrant(texture, d, x, y))
+
+    def _set_fallback(self, tile, texture):
+        # the fallback is displayed at once, the real texture will replace it
+        # without animation.
+        tile.texture = texture
+        tile.g_color.a = tile.opacity
+
+    def _get_quadrant(self, texture, d, x, y):
+        f = 2 ** d
+        w, h = texture.size
+        return texture.get_region(
+            (x - ((x >> d) << d)) * w // f, (y - ((y >> d) << d)) * h // f,
+            w // f, h // f)
+
+    def _get_mosaic(self, map_source, children):
+        size = map_source.tile_size
+        half = size / 2.
+        fbo = Fbo(size=(size, size))
+        with fbo:
+            ClearColor(0, 0, 0, 0)
+            ClearBuffers()
+            Color(1, 1, 1, 1)
+            for i, j, texture in children:
+                Rectangle(texture=texture, pos=(i * half, j * half),
+                          size=(half, half))
+        fbo.draw()
+        return fbo.texture
 
     def move_tiles_to_background(self):
         # remove all the tiles of the main map to the background map
@@ -880,57 +1496,148 @@ class MapView(Widget):
         btiles = self._tiles_bg
         canvas_map = self.canvas_map
         tile_size = self.map_source.tile_size
+        self._pending_tiles.clear()
 
         # move all tiles to background
-        while tiles:
-            tile = tiles.pop()
-            if tile.state == "loading":
-                tile.state = "done"
-                continue
-            btiles.append(tile)
+        for key, cell in tiles.items():
+            kept = []
+            for tile in cell:
+                self._remember_tile(tile)
+                if tile.atlas_slot is not None:
+                    self._atlas.remove(tile)
+                if tile.state == "loading":
+                    tile.state = "done"
+                    self.tracer.emit_tile("evicted", tile)
+                    continue
+                kept.append(tile)
+            if kept:
+                btiles.setdefault(key[0], {}).setdefault(key, []).extend(kept)
+        tiles.clear()
+        self._tile_ranges.clear()
 
         # clear the canvas
         canvas_map.clear()
         canvas_map.before.clear()
-        self._tilemap = {}
-
-        # unsure if it's really needed, i personnally didn't get issues right now
-        # btiles.sort(key=lambda z: -z.zoom)
+        self._attach_atlas()
 
-        # add all the btiles into the back canvas.
-        # except for the tiles that are owned by the current zoom level
-        for tile in btiles[:]:
-            if tile.zoom == zoom:
-                btiles.remove(tile)
-                tiles.append(tile)
+        # the tiles of the current zoom level go back to the front, the
+        # others are drawn into the back canvas.
+        tiles.update(btiles.pop(zoom, {}))
+        for cell in tiles.values():
+            for tile in cell:
                 tile.size = tile_size, tile_size
+                if tile.state == "need-animation":
+                    self._pending_tiles.add(tile)
+                if tile.state == "animated" and self._pack_tile(tile):
+                    continue
                 canvas_map.add(tile.g_color)
                 canvas_map.add(tile)
-                self.tile_map_set(tile.tile_x, tile.tile_y, True)
+        self._trim_background()
+        # coarse levels first, the finer ones are drawn over them
+        for bzoom in sorted(btiles):
+            for cell in btiles[bzoom].values():
+                for tile in cell:
+                    canvas_map.before.add(tile.g_color)
+                    canvas_map.before.add(tile)
+        if self._atlas is not None:
+            self._atlas.update()
+
+    def _trim_background(self):
+        # keep the background levels nearest to the current one, within the
+        # levels and bytes budgets. Called while they are out of the canvas.
+        btiles = self._tiles_bg
+        zoom = self._zoom
+        tile_bytes = self.map_source.tile_size ** 2 * 4
+        kept = total = 0
+        for bzoom in sorted(btiles, key=lambda z: abs(z - zoom)):
+            level = btiles[bzoom]
+            size = tile_bytes * sum(len(cell) for cell in level.values())
+            if kept < self.background_zoom_levels and \
+                    total + size <= self.background_max_bytes:
+                kept += 1
+                total += size
                 continue
-            canvas_map.before.add(tile.g_color)
-            canvas_map.before.add(tile)
+            del btiles[bzoom]
+            for cell in level.values():
+                for tile in cell:
+                    self._remember_tile(tile)
+                    tile.state = "done"
+                    self.tracer.emit_tile("evicted", tile)
+                    self._recycle_tile(tile)
+
+    def _drop_background(self):
+        # the current level covers the view, the background is useless
+        before = self.canvas_map.before
+        for bzoom, level in self._tiles_bg.items():
+            self._tile_ranges.pop(bzoom, None)
+            for cell in level.values():
+                for tile in cell:
+                    self._release_tile(tile, before)
+        self._tiles_bg.clear()
 
     def remove_all_tiles(self):
         # clear the map of all tiles.
         self.canvas_map.clear()
         self.canvas_map.before.clear()
-        for tile in self._tiles:
-            tile.state = "done"
-        del self._tiles[:]
-        del self._tiles_bg[:]
-        self._tilemap = {}
-
-    def tile_map_set(self, tile_x, tile_y, value):
-        key = tile_y * self.map_source.get_col_count(self._zoom) + tile_x
-        if value:
-            self._tilemap[key] = value
-        else:
-            self._tilemap.pop(key, None)
+        if self._atlas is not None:
+            self._atlas.clear()
+            self._attach_atlas()
+        self._pending_tiles.clear()
+        levels = [self._tiles] + list(self._tiles_bg.values())
+        for level in levels:
+            for cell in level.values():
+                for tile in cell:
+                    loaded = tile.state in ("need-animation", "animated")
+                    tile.state = "done"
+                    self.tracer.emit_tile("evicted", tile)
+                    if loaded:
+                        self._recycle_tile(tile)
+        self._tiles.clear()
+        self._tiles_bg.clear()
+        self._tile_ranges.clear()
+        self._fading.clear()
+
+    def _pack_tile(self, tile):
+        # move a settled tile of the current level from its own rectangle to
+        # the atlas. Overlays are kept as rectangles, to stay on top.
+        if not self.use_atlas or tile.opacity < 1 or \
+                tile.zoom != self._zoom or tile.atlas_slot is not None or \
+                tile.map_source not in (self.map_source,
+                                        self._composite_source):
+            return False
+        atlas = self._atlas
+        if atlas is None:
+            from mapview.atlas import TileAtlas
+            atlas = self._atlas = TileAtlas(self.map_source.tile_size)
+            self._attach_atlas()
+        if not atlas.add(tile):
+            return False
+        if tile.g_color in self.canvas_map.children:
+            self.canvas_map.remove(tile.g_color)
+            self.canvas_map.remove(tile)
+        return True
+
+    def _attach_atlas(self):
+        # the atlas is drawn first, below the tiles still fading in
+        if self._atlas is not None:
+            self.canvas_map.insert(0, self._atlas.canvas)
+
+    def _drop_atlas(self):
+        atlas = self._atlas
+        if atlas is None:
+            return
+        atlas.clear()
+        if atlas.canvas in self.canvas_map.children:
+            self.canvas_map.remove(atlas.canvas)
+        self._atlas = None
+
+    def on_use_atlas(self, instance, value):
+        self.remove_all_tiles()
+        self._drop_atlas()
+        self.trigger_update(True)
 
     def tile_in_tile_map(self, tile_x, tile_y):
-        key = tile_y * self.map_source.get_col_count(self._zoom) + tile_x
-        return key in self._tilemap
+        return (self._zoom, tile_x, tile_y) in self._tiles
 
     def on_size(self, instance, size):
         for layer in self._layers:
@@ -957,5 +1664,7 @@ class MapView(Widget):
             raise Exception("Invalid map source provider")
         self.zoom = clamp(self.zoom,
                           self.map_source.min_zoom, self.map_source.max_zoom)
+        self._composite_source = None
         self.remove_all_tiles()
+        self._drop_atlas()
         self.trigger_update(True)
@@ -0,0 +1,73 @@
+import os
+import time
+import unittest
+from mapview.downloader import Downloader
+from tests import test_downloader
+from tests.test_downloader import TileHandler
+try:
+    from mapview.aiodownloader import AsyncioDownloader
+except Exception:
+    AsyncioDownloader = None
+
+
+@unittest.skipIf(AsyncioDownloader is None, "aiohttp is not available")
+class AsyncioDownloaderTest(test_downloader.DownloaderTest):
+
+    def setUp(self):
+        super(AsyncioDownloaderTest, self).setUp()
+        self.downloader.executor.shutdown(wait=True)
+        self.downloader = AsyncioDownloader(cache_dir=self.tmpdir)
+
+    def tearDown(self):
+        self.downloader.stop()
+        super(AsyncioDownloaderTest, self).tearDown()
+
+    def test_get_backend(self):
+        self.assertIs(Downloader.get_backend("asyncio"), AsyncioDownloader)
+        self.assertIs(Downloader.get_backend("thread"), Downloader)
+        self.assertRaises(ValueError, Downloader.get_backend, "gevent")
+
+    def test_stale_tile_revalidation(self):
+        cache_fn = self.fetch()
+        meta = self.read_meta(cache_fn)
+        meta["expires"] = time.time() - 1
+        self.downloader._write_tile(cache_fn, None, meta)
+
+        self.assertEqual(self.fetch(), cache_fn)
+        for i in range(100):
+            if not self.downloader._revalidating:
+                break
+            time.sleep(.02)
+        self.assertEqual(TileHandler.requests[-1][1], '"v1"')
+        self.assertGreater(self.read_meta(cache_fn)["expires"],
+                           time.time() + 30)
+
+    def test_many_tiles_in_flight(self):
+        class Tile(object):
+            def __init__(self, source, tile_x):
+                self.map_source = source
+                self.zoom, self.tile_x, self.tile_y = 6, tile_x, 1
+                self.cache_fn = source.get_cache_fn(6, tile_x, 1)
+                self.state = "loading"
+                self.source = None
+
+            def set_source(self, cache_fn):
+                self.source = cache_fn
+
+        tiles = [Tile(self.source, i) for i in range(64)]
+        for tile in tiles:
+            self.downloader.download_tile(tile)
+        for i in range(200):
+            self.downloader._check_executor(0)
+            if not self.downloader._futures and \
+                    not self.downloader._ready:
+                break
+            time.sleep(.02)
+        self.assertEqual(len(TileHandler.requests), 64)
+        for tile in tiles:
+            self.assertEqual(tile.source, tile.cache_fn)
+            self.assertTrue(os.path.exists(tile.cache_fn))
+
+
+if __name__ == '__main__':
+    unittest.main()
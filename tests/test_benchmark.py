@@ -0,0 +1,40 @@
+import json
+import sys
+import unittest
+from mapview.benchmark import BENCHMARKS, run
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_registry(self):
+        self.assertEqual(
+            list(BENCHMARKS),
+            ["import", "projection", "kdbush", "supercluster", "markers", "geojson",
+             "mbtiles", "downloader"])
+
+    def test_run(self):
+        results = run(["projection", "mbtiles"], quick=True)
+        results = json.loads(json.dumps(results))
+        self.assertEqual(list(results["results"]), ["projection", "mbtiles"])
+        projection = results["results"]["projection"]
+        self.assertGreater(projection["forward"]["per_second"], 0)
+        self.assertGreater(projection["inverse"]["per_second"], 0)
+        self.assertEqual(results["results"]["mbtiles"]["tiles"], 64)
+        self.assertIn("kivy", results)
+
+    def test_lazy_imports(self):
+        """
+        Makes sure the offline imports don't pull the HTTP stack nor the
+        window.
+        """
+        results = run(["import"], quick=True)["results"]["import"]
+        # the names of mapview are lazy from python 3.7 only
+        if sys.version_info >= (3, 7):
+            self.assertEqual(results["import mapview"]["loaded"], [])
+        self.assertEqual(
+            results["from mapview.mbtsource import MBTilesMapSource"][
+                "loaded"], [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import unittest
+from mapview import MapSource
+from mapview.cachepath import CachePath
+
+
+class CachePathTest(unittest.TestCase):
+
+    def test_filename(self):
+        path = CachePath("osm", "png")
+        self.assertEqual(path.get_filename(3, 1, 2, "cache"),
+                         os.path.join("cache", "osm_3_1_2.png"))
+        path = CachePath("{odd}", "jpg", "{cache_key}/{zoom}/{tile_x}/"
+                         "{tile_y}.{image_ext}")
+        self.assertEqual(path.get_filename(3, 1, 2, "c{d}"),
+                         os.path.join("c{d}", "{odd}/3/1/2.jpg"))
+
+    def test_keys(self):
+        path = CachePath("osm", "png")
+        keys = set(path.get_key(z, x, y)
+                   for z in (0, 1, 19) for x in (0, 1, 2 ** 19 - 1)
+                   for y in (0, 1, 2 ** 19 - 1))
+        self.assertEqual(len(keys), 27)
+        self.assertNotEqual(path.get_bytes_key(3, 1, 2),
+                            CachePath("hot", "png").get_bytes_key(3, 1, 2))
+        self.assertEqual(path.get_bytes_key(3, 1, 2)[:7], b"\0\0\0\3osm")
+
+    def test_source(self):
+        source = MapSource(cache_key="osm", cache_dir="cache")
+        self.assertEqual(source.get_cache_fn(3, 1, 2),
+                         os.path.join("cache", "osm_3_1_2.png"))
+        self.assertEqual(source.get_cache_fn(3, 1, 2, "other"),
+                         os.path.join("other", "osm_3_1_2.png"))
+
+
+if __name__ == '__main__':
+    unittest.main()
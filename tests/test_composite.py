@@ -0,0 +1,127 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from mapview.source import MapSource
+from mapview.downloader import Downloader
+from mapview.composite import CompositeMapSource, PILImage
+
+
+class ColorHandler(BaseHTTPRequestHandler):
+    # /<layer>/z/x/y.png: red for the base, blue for the overlay
+
+    def do_GET(self):
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        color = (255, 0, 0, 255) if self.path.startswith("/base") \
+            else (0, 0, 255, 255)
+        data = BytesIO()
+        PILImage.new("RGBA", (4, 4), color).save(data, "png")
+        body = data.getvalue()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@unittest.skipIf(PILImage is None, "Pillow is not available")
+class CompositeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def save(self, name, color):
+        fn = os.path.join(self.tmpdir, name)
+        PILImage.new("RGBA", (4, 4), color).save(fn)
+        return fn
+
+    def test_blend(self):
+        base = MapSource(cache_key="base", cache_dir=self.tmpdir)
+        overlay = MapSource(cache_key="overlay", cache_dir=self.tmpdir,
+                            attribution="")
+        source = CompositeMapSource([(base, 1.), (overlay, .5)])
+        self.assertTrue(source.cache_key.startswith("composite-"))
+        self.assertEqual(source.attribution, base.attribution)
+        image = source._blend([
+            (self.save("base.png", (255, 0, 0, 255)), 1.),
+            (self.save("overlay.png", (0, 0, 255, 255)), .5)])
+        r, g, b, a = image.getpixel((0, 0))
+        self.assertAlmostEqual(r, 128, delta=2)
+        self.assertAlmostEqual(b, 127, delta=2)
+        self.assertEqual(a, 255)
+
+    def fill_tile(self, overlay_path):
+        # fill a tile of a composite source, from a local server
+        server = HTTPServer(("127.0.0.1", 0), ColorHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        url = "http://127.0.0.1:{}/".format(server.server_port)
+        downloader = Downloader(cache_dir=self.tmpdir)
+        try:
+            base = MapSource(url=url + "base/{z}/{x}/{y}.png",
+                             cache_key="base", cache_dir=self.tmpdir)
+            overlay = MapSource(url=url + overlay_path + "/{z}/{x}/{y}.png",
+                                cache_key="overlay", cache_dir=self.tmpdir)
+            source = CompositeMapSource([(base, 1.), (overlay, .5)])
+            tmpdir = self.tmpdir
+
+            class Tile(object):
+                zoom, tile_x, tile_y = 1, 0, 0
+                state = "loading"
+                priority = 0
+                cache_dir = tmpdir
+                cache_fn = source.get_cache_fn(1, 0, 0, tmpdir)
+                texture = None
+
+                def set_source(self, cache_fn):
+                    self.state = "need-animation"
+
+            tile = Tile()
+            tile.map_source = source
+            tile.downloader = downloader
+            source.fill_tile(tile)
+            timeout = time.time() + 5
+            while tile.state == "loading" and time.time() < timeout:
+                downloader._check_executor(0)
+                time.sleep(.01)
+            self.assertEqual(tile.state, "need-animation")
+            return tile
+        finally:
+            downloader.stop()
+            server.shutdown()
+            server.server_close()
+
+    def test_fill_tile(self):
+        tile = self.fill_tile("overlay")
+        r, g, b, a = PILImage.open(tile.cache_fn).getpixel((0, 0))
+        self.assertAlmostEqual(r, 128, delta=2)
+        self.assertAlmostEqual(b, 127, delta=2)
+        # expires with its layers
+        self.assertTrue(os.path.exists(tile.cache_fn + ".meta"))
+
+    def test_partial_tile(self):
+        tile = self.fill_tile("missing")
+        self.assertIsNotNone(tile.texture)
+        self.assertEqual(tuple(tile.texture.size), (4, 4))
+        self.assertFalse(os.path.exists(tile.cache_fn))
+
+
+if __name__ == '__main__':
+    unittest.main()
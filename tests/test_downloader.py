@@ -0,0 +1,255 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from mapview.source import MapSource
+from mapview.downloader import Downloader
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        TileHandler.requests.append(
+            (self.path, self.headers.get("If-None-Match")))
+        if self.headers.get("If-None-Match") == '"v1"':
+            self.send_response(304)
+            self.send_header("Cache-Control", "max-age=60")
+            self.end_headers()
+            return
+        body = self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Cache-Control", "public, max-age=3600")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    # answer 503, then 429, then the tile
+    requests = []
+
+    def do_GET(self):
+        FlakyHandler.requests.append(self.path)
+        count = len(FlakyHandler.requests)
+        if count < 3:
+            self.send_response(503 if count == 1 else 429)
+            self.send_header("Retry-After", "0")
+            self.end_headers()
+            return
+        body = b"tile"
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = HTTPServer(("127.0.0.1", 0), TileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        del TileHandler.requests[:]
+        self.source = MapSource(
+            url="http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png".format(
+                self.server.server_port),
+            cache_key="test", cache_dir=self.tmpdir)
+        self.downloader = Downloader(cache_dir=self.tmpdir)
+
+    def tearDown(self):
+        self.downloader.executor.shutdown(wait=True)
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def fetch(self):
+        cache_fn = self.source.get_cache_fn(1, 0, 0)
+        return self.downloader.fetch_tile(self.source, 1, 0, 0, cache_fn)
+
+    def read_meta(self, cache_fn):
+        with open(cache_fn + ".meta") as fd:
+            return json.load(fd)
+
+    def test_fresh_tile_from_cache(self):
+        cache_fn = self.fetch()
+        meta = self.read_meta(cache_fn)
+        self.assertEqual(meta["etag"], '"v1"')
+        self.assertGreater(meta["expires"], time.time() + 3000)
+        self.assertEqual(self.fetch(), cache_fn)
+        self.assertEqual(len(TileHandler.requests), 1)
+
+    def test_stale_tile_revalidation(self):
+        cache_fn = self.fetch()
+        meta = self.read_meta(cache_fn)
+        meta["expires"] = time.time() - 1
+        with open(cache_fn + ".meta", "w") as fd:
+            json.dump(meta, fd)
+
+        # served at once, and revalidated in the background
+        self.assertEqual(self.fetch(), cache_fn)
+        self.downloader.executor.shutdown(wait=True)
+        self.assertEqual(TileHandler.requests[-1][1], '"v1"')
+        meta = self.read_meta(cache_fn)
+        self.assertEqual(meta["etag"], '"v1"')
+        self.assertGreater(meta["expires"], time.time() + 30)
+        with open(cache_fn, "rb") as fd:
+            self.assertEqual(fd.read(), b"/1/0/1.png")
+
+    def test_coalesce_duplicate_tiles(self):
+        class Tile(object):
+            def __init__(self, source):
+                self.map_source = source
+                self.zoom, self.tile_x, self.tile_y = 2, 1, 1
+                self.cache_fn = source.get_cache_fn(2, 1, 1)
+                self.state = "loading"
+                self.source = None
+
+            def set_source(self, cache_fn):
+                self.source = cache_fn
+
+        tiles = [Tile(self.source) for i in range(3)]
+        tiles[1].state = "done"
+        for tile in tiles:
+            self.downloader.download_tile(tile)
+        self.assertEqual(len(self.downloader._futures), 1)
+        for i in range(100):
+            self.downloader._check_executor(0)
+            if not self.downloader._futures and \
+                    not self.downloader._ready:
+                break
+            time.sleep(.02)
+        self.assertEqual(len(TileHandler.requests), 1)
+        self.assertEqual(tiles[0].source, tiles[0].cache_fn)
+        self.assertIsNone(tiles[1].source)
+        self.assertEqual(tiles[2].source, tiles[0].cache_fn)
+        self.assertEqual(self.downloader._inflight, {})
+        self.assertEqual(
+            [fn for fn in os.listdir(self.tmpdir) if fn.endswith(".tmp")], [])
+
+    def test_retry_failed_tile(self):
+        server = HTTPServer(("127.0.0.1", 0), FlakyHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        del FlakyHandler.requests[:]
+        try:
+            source = MapSource(
+                url="http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png".format(
+                    server.server_port),
+                cache_key="flaky", cache_dir=self.tmpdir)
+            self.downloader.RETRIES = 2
+            policy = self.downloader.get_host_policy(source.url)
+            policy.retry.backoff = .01
+            policy.breaker.cooldown = .01
+            cache_fn = source.get_cache_fn(1, 0, 0)
+            self.assertEqual(self.downloader.fetch_tile(
+                source, 1, 0, 0, cache_fn), cache_fn)
+            self.assertEqual(len(FlakyHandler.requests), 3)
+
+            # retries exhausted
+            del FlakyHandler.requests[:]
+            policy.retry.retries = 1
+            cache_fn = source.get_cache_fn(1, 1, 0)
+            self.assertIsNone(self.downloader.fetch_tile(
+                source, 1, 1, 0, cache_fn))
+            self.assertEqual(len(FlakyHandler.requests), 2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_instance_per_cache_dir(self):
+        other_dir = tempfile.mkdtemp()
+        try:
+            first = Downloader.instance(self.tmpdir)
+            second = Downloader.instance(other_dir)
+            self.assertIsNot(first, second)
+            self.assertIs(Downloader.instance(self.tmpdir + "/"), first)
+            self.assertEqual(second.cache_dir, other_dir)
+            first.stop()
+            second.stop()
+            self.assertNotIn(first, Downloader._instances.values())
+            self.assertIsNot(Downloader.instance(self.tmpdir), first)
+            Downloader.instance(self.tmpdir).stop()
+        finally:
+            shutil.rmtree(other_dir)
+
+    def test_source_downloader(self):
+        class Tile(object):
+            zoom, tile_x, tile_y = 1, 1, 1
+            state = "loading"
+            downloader = None
+
+        own = Downloader(cache_dir=self.tmpdir)
+        tile = Tile()
+        tile.downloader = self.downloader
+        self.assertIs(self.source.get_downloader(tile), self.downloader)
+        self.source.downloader = own
+        self.assertIs(self.source.get_downloader(tile), own)
+        own.stop()
+
+    def test_apply_by_priority(self):
+        class Tile(object):
+            def __init__(self, priority):
+                self.priority = priority
+
+        applied = []
+        self.downloader.max_apply = 2
+        for priority in (3, 1, 2):
+            self.downloader.submit(
+                lambda tile: (lambda t: applied.append(t.priority), (tile,)),
+                Tile(priority))
+        for future in self.downloader._futures:
+            future.result()
+        self.downloader._check_executor(0)
+        self.assertEqual(applied, [1, 2])
+        self.downloader._check_executor(0)
+        self.assertEqual(applied, [1, 2, 3])
+
+    def test_host_slots(self):
+        from mapview.retry import RetryLater
+        downloader = Downloader(cache_dir=self.tmpdir, max_workers=4)
+        self.assertEqual(downloader.max_per_host, 2)
+        slow = downloader.get_host_policy("http://slow.example.com/1.png")
+        fast = downloader.get_host_policy("http://fast.example.com/1.png")
+        self.assertTrue(downloader._acquire_slot(slow))
+        self.assertTrue(downloader._acquire_slot(slow))
+        # the slow host is full, the others still get a worker
+        self.assertFalse(downloader._acquire_slot(slow))
+        self.assertTrue(downloader._acquire_slot(fast))
+        downloader._release_slot(fast)
+        source = MapSource(url="http://slow.example.com/{z}/{x}/{y}.png",
+                           cache_key="slow", cache_dir=self.tmpdir)
+        self.assertRaises(
+            RetryLater, downloader._download_tile, source, 1, 0, 0,
+            source.get_cache_fn(1, 0, 0))
+        # a blocking caller waits for the slot
+        timer = threading.Timer(.1, downloader._release_slot, (slow, ))
+        timer.start()
+        self.assertTrue(downloader._acquire_slot(slow, block=True))
+        timer.join()
+        downloader._release_slot(slow)
+        downloader._release_slot(slow)
+        self.assertEqual(downloader._host_active[slow], 0)
+        downloader.stop()
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
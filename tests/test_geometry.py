@@ -0,0 +1,72 @@
+import unittest
+from mapview.geometry import GeometryStore, unit_x, unit_y, unit_lon, \
+    unit_lat
+
+
+FEATURES = {
+    "type": "FeatureCollection",
+    "features": [{
+        "type": "Feature",
+        "properties": {"color": "blue"},
+        "geometry": {
+            "type": "Polygon",
+            "coordinates": [
+                [[0, 0], [10, 0], [10, 10], [0, 10], [0, 0]],
+                [[2, 2], [4, 2], [4, 4], [2, 2]]]}
+    }, {
+        "type": "Feature",
+        "properties": None,
+        "geometry": {
+            "type": "MultiLineString",
+            "coordinates": [[[0, 0], [20, 5]], [[-5, -5], [-6, -6]]]}
+    }, {
+        "type": "Feature",
+        "properties": {},
+        "geometry": {"type": "Point", "coordinates": [-30, -40]}
+    }]
+}
+
+
+class GeometryStoreTest(unittest.TestCase):
+
+    def test_unit_projection(self):
+        self.assertAlmostEqual(unit_x(0), .5)
+        self.assertAlmostEqual(unit_y(0), .5)
+        self.assertAlmostEqual(unit_lon(unit_x(42.5)), 42.5)
+        self.assertAlmostEqual(unit_lat(unit_y(-33.8)), -33.8)
+
+    def test_layout(self):
+        store = GeometryStore()
+        store.load(FEATURES)
+        self.assertEqual(len(store), 3)
+        self.assertEqual(len(store.coords), 2 * (5 + 4 + 2 + 2 + 1))
+        self.assertEqual(store.get_parts(0), [[(0, 5), (5, 9)]])
+        self.assertEqual(store.get_parts(1), [[(9, 11)], [(11, 13)]])
+        self.assertEqual(store.get_vertex_range(2), (13, 14))
+        self.assertEqual(store.properties[1], {})
+
+    def test_bounds(self):
+        store = GeometryStore()
+        self.assertEqual(store.bounds[0], float("inf"))
+        store.load(FEATURES)
+        self.assertEqual(store.get_bounds(1), (
+            unit_x(-6), unit_y(-6), unit_x(20), unit_y(5)))
+        self.assertEqual(store.get_bounds(), (
+            unit_x(-30), unit_y(-40), unit_x(20), unit_y(10)))
+        store.add_feature({"type": "Feature", "geometry": {
+            "type": "MultiPoint", "coordinates": [[50, 60]]}})
+        self.assertEqual(store.get_bounds(), (
+            unit_x(-30), unit_y(-40), unit_x(50), unit_y(60)))
+
+    def test_project(self):
+        store = GeometryStore()
+        store.load(FEATURES)
+        xy = store.project(2., 1., 4., -1., start=13, end=14)
+        self.assertEqual(len(xy), 2)
+        self.assertAlmostEqual(xy[0], unit_x(-30) * 2. + 1., places=5)
+        self.assertAlmostEqual(xy[1], unit_y(-40) * 4. - 1., places=5)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
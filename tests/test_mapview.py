@@ -12,6 +12,384 @@ class TextInputTest(unittest.TestCase):
         mapview = MapView(**kwargs)
         self.assertEqual(len(mapview.children), 2)
 
+    def test_tile_fallback_from_parent(self):
+        """
+        Makes sure a loading tile displays the quadrant of its parent.
+        """
+        from kivy.graphics.texture import Texture
+        mapview = MapView(zoom=3)
+        mapview._pause = True
+        texture = Texture.create(size=(256, 256))
+        mapview._remember_texture(mapview.map_source, 2, 1, 1, texture)
+        mapview.load_tile(3, 2, 256, 3)
+        tile = mapview._tiles[(3, 3, 2)][-1]
+        self.assertEqual(tuple(tile.texture.size), (128, 128))
+        self.assertEqual(tuple(tile.texture.uvpos), (.5, 0))
+        self.assertEqual(tile.g_color.a, 1)
+
+    def test_prefetch_ahead_of_pan(self):
+        """
+        Makes sure the prefetch ring is extended in the direction of the pan.
+        """
+        from time import time
+        mapview = MapView(zoom=5, size=(512, 512))
+        prefetched = []
+        mapview.map_source.prefetch_tiles = \
+            lambda tiles, cache_dir, downloader=None: prefetched.extend(tiles)
+        now = time()
+        size = mapview.map_source.dp_tile_size
+        mapview._motion.clear()
+        mapview._motion.append((now - .1, 5, 0, 0, 32.))
+        mapview._motion.append((now, 5, size, 0, 32.))
+        vx, vy = mapview.viewport_pos
+        x0, y0, x1, y1, _, _ = mapview.bbox_for_zoom(
+            vx, vy, mapview.width, mapview.height, 5)
+        mapview._prefetch_tiles()
+        self.assertTrue(prefetched)
+        xs = [x for zoom, x, y in prefetched]
+        self.assertEqual(min(xs), x0 - 1)
+        self.assertEqual(max(xs), x1 + 2)
+        self.assertEqual(prefetched[0][1], x1)
+
+    def test_overlays(self):
+        """
+        Makes sure the overlays are stacked over the map, or composited.
+        """
+        from mapview import MapSource
+        from mapview.composite import CompositeMapSource
+        mapview = MapView(zoom=3)
+        mapview._pause = True
+        overlay = mapview.add_overlay(MapSource(
+            url="http://localhost/{z}/{x}/{y}.png", cache_key="overlay"),
+            opacity=.5)
+        mapview.load_tile(3, 2, 256, 3)
+        self.assertEqual(
+            [(tile.map_source, tile.opacity)
+             for tile in mapview._tiles[(3, 3, 2)]],
+            [(mapview.map_source, 1.), (overlay, .5)])
+
+        mapview.composite_overlays = True
+        self.assertEqual(mapview._tiles, {})
+        mapview.load_tile(3, 2, 256, 3)
+        self.assertEqual(len(mapview._tiles[(3, 3, 2)]), 1)
+        source = mapview._tiles[(3, 3, 2)][0].map_source
+        self.assertIsInstance(source, CompositeMapSource)
+        self.assertEqual(source.layers, [(mapview.map_source, 1.),
+                                         (overlay, .5)])
+        mapview.remove_overlay(overlay)
+        mapview.load_tile(3, 2, 256, 3)
+        self.assertEqual(
+            [tile.map_source for tile in mapview._tiles[(3, 3, 2)]],
+            [mapview.map_source])
+
+    def test_atlas(self):
+        """
+        Makes sure the settled tiles are moved into the atlas, and released.
+        """
+        from kivy.graphics.texture import Texture
+        mapview = MapView(zoom=3, use_atlas=True, animation_duration=0)
+        mapview._pause = True
+        mapview.fallback_zoom_levels = 0
+        mapview.load_tile(3, 2, 256, 3)
+        mapview.load_tile(4, 2, 256, 3)
+        tiles = mapview._tiles[(3, 3, 2)] + mapview._tiles[(3, 4, 2)]
+        for tile in tiles:
+            tile.texture = Texture.create(size=(256, 256))
+            tile.state = "need-animation"
+        mapview._animate_color(0)
+        atlas = mapview._atlas
+        self.assertEqual(len(atlas), 2)
+        self.assertEqual(len(atlas.pages), 1)
+        children = mapview.canvas_map.children
+        self.assertIn(atlas.canvas, children)
+        self.assertFalse([tile for tile in tiles if tile in children])
+        tile = tiles[1]
+        page, slot = tile.atlas_slot
+        self.assertEqual(page.vertices[slot * 16:slot * 16 + 2],
+                         list(tile.pos))
+        mapview.remove_all_tiles()
+        self.assertEqual(len(atlas), 0)
+        self.assertIsNone(tile.atlas_slot)
+        # a tile evicted while loading, and completed late
+        mapview.load_tile(3, 2, 256, 3)
+        tile = mapview._tiles[(3, 3, 2)][0]
+        mapview.remove_all_tiles()
+        tile.texture = Texture.create(size=(256, 256))
+        tile.state = "need-animation"
+        self.assertEqual(len(atlas), 0)
+        self.assertIsNone(tile.atlas_slot)
+
+    def test_fade_clock_idle(self):
+        """
+        Makes sure the fade clock only runs while tiles are fading in.
+        """
+        mapview = MapView(zoom=3, animation_duration=100)
+        mapview._pause = True
+        mapview.fallback_zoom_levels = 0
+        self.assertIsNone(mapview._fade_event)
+        mapview.load_tile(3, 2, 256, 3)
+        tile = mapview._tiles[(3, 3, 2)][0]
+        tile.set_source("tile.png")
+        self.assertEqual(mapview._fading, set([tile]))
+        self.assertIsNotNone(mapview._fade_event)
+        mapview._animate_color(.05)
+        self.assertAlmostEqual(tile.g_color.a, .5)
+        mapview._animate_color(.05)
+        self.assertEqual(tile.state, "animated")
+        self.assertEqual(tile.g_color.a, 1)
+        self.assertEqual(mapview._fading, set())
+        self.assertIsNone(mapview._fade_event)
+
+    def test_tile_bookkeeping(self):
+        """
+        Makes sure only the tiles leaving the viewport are evicted, and the
+        previous levels are kept apart.
+        """
+        from mapview.view import _range_difference
+        self.assertEqual(
+            sorted(_range_difference((0, 0, 3, 3), (1, 1, 4, 4))),
+            [(0, 0), (0, 1), (0, 2), (1, 0), (2, 0)])
+        self.assertEqual(list(_range_difference((0, 0, 2, 2), (0, 0, 2, 2))),
+                         [])
+
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        mapview.load_visible_tiles()
+        keys = set(mapview._tiles)
+        self.assertTrue(keys)
+        self.assertTrue(all(zoom == 3 for zoom, x, y in keys))
+        self.assertTrue(mapview.tile_in_tile_map(*sorted(keys)[0][1:]))
+
+        size = mapview.map_source.dp_tile_size
+        mapview._scatter.x -= size
+        mapview.load_visible_tiles()
+        x_first = min(x for zoom, x, y in mapview._tiles)
+        self.assertEqual(x_first, min(x for zoom, x, y in keys) + 1)
+        for key, cell in mapview._tiles.items():
+            self.assertEqual(len(cell), 1)
+            self.assertEqual(cell[0].pos[0],
+                             key[1] * size + mapview.delta_x)
+
+        for cell in mapview._tiles.values():
+            cell[0].state = "animated"
+        mapview._zoom = 4
+        mapview.move_tiles_to_background()
+        self.assertEqual(mapview._tiles, {})
+        self.assertEqual(list(mapview._tiles_bg), [3])
+        for cell in mapview._tiles_bg[3].values():
+            self.assertIn(cell[0], mapview.canvas_map.before.children)
+
+    def test_tile_pool(self):
+        """
+        Makes sure the loaded tiles leaving the view are reused.
+        """
+        mapview = MapView(zoom=3, size=(512, 512), animation_duration=0)
+        mapview._pause = True
+        mapview.fallback_zoom_levels = 0
+        mapview.load_visible_tiles()
+        loaded = mapview._tiles[min(mapview._tiles)][0]
+        loaded.set_source("tile.png")
+        loading = mapview._tiles[max(mapview._tiles)][0]
+        self.assertRaises(AttributeError, setattr, loaded, "foo", 1)
+
+        mapview.remove_all_tiles()
+        self.assertEqual(mapview._tile_pool, [loaded])
+        self.assertEqual(loading.state, "done")
+        generation = loaded.generation
+        tile = mapview.load_tile_for_source(
+            mapview.map_source, 1., 256, 1, 2, 3)
+        self.assertIs(tile, loaded)
+        self.assertEqual(tile.generation, generation + 1)
+        self.assertEqual((tile.zoom, tile.tile_x, tile.tile_y), (3, 1, 2))
+        self.assertEqual(tile.state, "loading")
+        self.assertEqual(tile.g_color.a, 0)
+
+    def test_background_budget(self):
+        """
+        Makes sure the background keeps the nearest levels, and is dropped
+        once the current level is loaded.
+        """
+        mapview = MapView(zoom=3, size=(512, 512), animation_duration=0)
+        mapview._pause = True
+        mapview.fallback_zoom_levels = 0
+        mapview.background_zoom_levels = 2
+        for zoom in (3, 4, 5):
+            mapview._zoom = zoom
+            mapview.move_tiles_to_background()
+            mapview.load_tile(1, 1, 256, zoom)
+            mapview._tiles[(zoom, 1, 1)][0].state = "animated"
+        mapview._zoom = 6
+        mapview.move_tiles_to_background()
+        self.assertEqual(sorted(mapview._tiles_bg), [4, 5])
+        before = mapview.canvas_map.before.children
+        self.assertLess(
+            before.index(list(mapview._tiles_bg[4].values())[0][0]),
+            before.index(list(mapview._tiles_bg[5].values())[0][0]))
+
+        mapview.background_max_bytes = 1
+        mapview.move_tiles_to_background()
+        self.assertEqual(mapview._tiles_bg, {})
+
+        mapview.background_max_bytes = 32 * 1024 * 1024
+        mapview._zoom = 5
+        mapview.load_tile(1, 1, 256, 5)
+        mapview._tiles[(5, 1, 1)][0].set_source("tile.png")
+        mapview._zoom = 6
+        mapview.move_tiles_to_background()
+        mapview.load_tile(2, 2, 256, 6)
+        mapview.load_tile(3, 2, 256, 6)
+        self.assertEqual(list(mapview._tiles_bg), [5])
+        mapview._tiles[(6, 2, 2)][0].set_source("tile.png")
+        self.assertEqual(list(mapview._tiles_bg), [5])
+        mapview._tiles[(6, 3, 2)][0].set_source("tile.png")
+        self.assertEqual(mapview._tiles_bg, {})
+        self.assertEqual(len(mapview.canvas_map.before.children), 0)
+
+        # a failed tile doesn't keep the background forever
+        mapview._zoom = 7
+        mapview.move_tiles_to_background()
+        mapview.load_tile(4, 4, 256, 7)
+        mapview.load_tile(5, 4, 256, 7)
+        mapview._tiles[(7, 4, 4)][0].set_source("tile.png")
+        self.assertEqual(list(mapview._tiles_bg), [6])
+        mapview._tiles[(7, 5, 4)][0].state = "done"
+        self.assertEqual(mapview._tiles_bg, {})
+
+    def test_update_budget(self):
+        """
+        Makes sure the slow layers and the background eviction are deferred
+        when the frame budget is spent, and done in the next frames.
+        """
+        from mapview.view import MapLayer
+
+        class Layer(MapLayer):
+            def __init__(self, **kwargs):
+                super(Layer, self).__init__(**kwargs)
+                self.count = 0
+
+            def reposition(self):
+                self.count += 1
+
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        cheap = Layer()
+        slow = [Layer(cheap=False), Layer(cheap=False)]
+        for layer in [cheap] + slow:
+            mapview.add_layer(layer)
+        mapview.update_budget = 0
+        mapview._need_redraw_full = False
+        mapview._tiles_bg[2] = {}
+        mapview.do_update(0)
+        self.assertEqual([layer.count for layer in [cheap] + slow],
+                         [1, 1, 0])
+        self.assertEqual(mapview._deferred_layers, [slow[1]])
+        self.assertTrue(mapview._background_dirty)
+        self.assertIsNotNone(mapview._deferred_event)
+
+        mapview.do_update(0)
+        self.assertEqual([layer.count for layer in [cheap] + slow],
+                         [2, 1, 1])
+        mapview._deferred_event.cancel()
+        mapview._do_deferred(0)
+        mapview._do_deferred(0)
+        self.assertEqual(slow[0].count, 2)
+        self.assertEqual(mapview._deferred_layers, [])
+        self.assertFalse(mapview._background_dirty)
+        self.assertEqual(mapview._tiles_bg, {})
+
+    def test_pan_fast_path(self):
+        """
+        Makes sure a pan within the same tiles leaves the grid alone.
+        """
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        self.assertTrue(mapview.load_visible_tiles())
+        tiles = dict(mapview._tiles)
+        pos = [tuple(cell[0].pos) for cell in tiles.values()]
+        size = mapview.map_source.dp_tile_size
+        mapview._scatter.x -= size / 4.
+        self.assertFalse(mapview.load_visible_tiles())
+        self.assertEqual(mapview._tiles, tiles)
+        self.assertEqual([tuple(cell[0].pos) for cell in tiles.values()], pos)
+        mapview._scatter.x -= size
+        self.assertTrue(mapview.load_visible_tiles())
+        self.assertNotEqual(set(mapview._tiles), set(tiles))
+
+    def test_tile_priorities(self):
+        """
+        Makes sure the tiles nearest to the focus have the lowest priority.
+        """
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        mapview.load_visible_tiles()
+
+        def nearest():
+            tiles = [cell[0] for cell in mapview._tiles.values()]
+            tile = min(tiles, key=lambda t: t.priority)
+            return tile.pos
+
+        size = mapview.map_source.dp_tile_size
+        x, y = nearest()
+        cx, cy = mapview._scatter.to_local(*mapview.center)
+        self.assertTrue(x <= cx <= x + size and y <= cy <= y + size)
+        mapview._focus = mapview.pos
+        mapview._update_priorities()
+        x, y = nearest()
+        fx, fy = mapview._scatter.to_local(*mapview.pos)
+        self.assertTrue(x <= fx <= x + size and y <= fy <= y + size)
+
+    def test_pinch_focus(self):
+        """
+        Makes sure a pinch looks between the fingers, and the focus is reset
+        when the fingers are up.
+        """
+        from kivy.input.motionevent import MotionEvent
+
+        class Touch(MotionEvent):
+            def depack(self, args):
+                self.sx, self.sy = args
+                self.profile = ["pos"]
+                super(Touch, self).depack(args)
+
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        first = Touch("test", 1, (.1, .1))
+        second = Touch("test", 2, (.3, .2))
+        for touch in (first, second):
+            touch.scale_for_screen(1001, 1001)
+            touch.grab_current = None
+            mapview.on_touch_down(touch)
+        self.assertEqual(mapview._focus, (200, 150))
+        for touch in (first, second):
+            touch.grab_current = mapview
+            mapview.on_touch_up(touch)
+        self.assertIsNone(mapview._focus)
+        mapview.animated_diff_scale_at(1, 10, 10)
+        mapview._focus = (10, 10)
+        from kivy.clock import Clock
+        Clock.unschedule(mapview._animate_scale)
+        while mapview._animate_scale(1 / 60.):
+            pass
+        self.assertIsNone(mapview._focus)
+
+    def test_kv_rules_overridable(self):
+        """
+        Makes sure the kv of the app, loaded before the widgets are imported,
+        still overrides the rules of mapview.
+        """
+        from kivy.lang import Builder
+        from mapview.view import _load_kv_first
+        Builder.load_string("<MapMarker>:\n    size: 48, 48\n",
+                            filename="test_app.kv")
+        try:
+            _load_kv_first("<MapMarker>:\n    size: 10, 10\n",
+                           "test_lib.kv")
+            from mapview import MapMarker
+            self.assertEqual(MapMarker().size, [48, 48])
+        finally:
+            Builder.unload_file("test_app.kv")
+            Builder.unload_file("test_lib.kv")
+
 
 if __name__ == '__main__':
     import unittest
@@ -0,0 +1,70 @@
+import time
+import unittest
+from mapview.retry import TokenBucket, RetryPolicy, CircuitBreaker, \
+    HostPolicy, parse_retry_after
+
+
+class RetryTest(unittest.TestCase):
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(10, 2)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        delay = bucket.acquire()
+        self.assertGreater(delay, 0)
+        self.assertLessEqual(delay, .1)
+        time.sleep(delay + .01)
+        self.assertEqual(bucket.acquire(), 0)
+
+    def test_backoff(self):
+        policy = RetryPolicy(retries=3, backoff=1, jitter=.5)
+        for attempt in range(3):
+            delay = policy.get_delay(attempt)
+            self.assertGreaterEqual(delay, 2 ** attempt * .5)
+            self.assertLessEqual(delay, 2 ** attempt)
+        self.assertIsNone(policy.get_delay(3))
+        self.assertEqual(policy.get_delay(0, retry_after=10), 10)
+        self.assertTrue(policy.is_retryable(None))
+        self.assertTrue(policy.is_retryable(503))
+        self.assertFalse(policy.is_retryable(404))
+
+    def test_retry_after(self):
+        self.assertEqual(parse_retry_after("120"), 120)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("soon"))
+        date = time.strftime(
+            "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 60))
+        self.assertAlmostEqual(parse_retry_after(date), 60, delta=2)
+
+    def test_circuit_breaker(self):
+        breaker = CircuitBreaker(threshold=2, cooldown=.05, probe_delay=.01)
+        breaker.record_failure()
+        self.assertEqual(breaker.get_delay(), 0)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertGreater(breaker.get_delay(), 0)
+        time.sleep(.06)
+        # a single probe is allowed, the others poll shortly
+        self.assertEqual(breaker.get_delay(), 0)
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertGreater(breaker.get_delay(), 0)
+        self.assertLessEqual(breaker.get_delay(), .01)
+        breaker.record_success()
+        self.assertEqual(breaker.get_delay(), 0)
+
+    def test_host_paused_by_retry_after(self):
+        policy = HostPolicy(rate=100)
+        self.assertEqual(policy.get_delay(), 0)
+        delay = policy.failure(429, 0, "30")
+        self.assertEqual(delay, 30)
+        self.assertGreater(policy.get_delay(), 29)
+        # the probe after a short Retry-After leaves the others waiting
+        # for the backoff, not the cooldown
+        policy = HostPolicy()
+        policy.failure(429, 0, "0")
+        self.assertEqual(policy.get_delay(), 0)
+        self.assertLessEqual(policy.get_delay(), policy.retry.backoff)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from mapview.source import MapSource
+from mapview.seed import iter_region_tiles, RegionSeeder
+
+
+class TileHandler(BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        TileHandler.requests.append(self.path)
+        if self.path.startswith("/missing"):
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = self.path.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SeedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = HTTPServer(("127.0.0.1", 0), TileHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        del TileHandler.requests[:]
+        self.source = MapSource(
+            url="http://127.0.0.1:{}/{{z}}/{{x}}/{{y}}.png".format(
+                self.server.server_port),
+            cache_key="seed", cache_dir=self.tmpdir)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_iter_bbox(self):
+        tiles = list(iter_region_tiles((-10, -10, 10, 10), 0, 2))
+        self.assertEqual(tiles[0], (0, 0, 0))
+        self.assertEqual(len([t for t in tiles if t[0] == 1]), 4)
+        self.assertEqual(len([t for t in tiles if t[0] == 2]), 4)
+
+    def test_iter_polygon(self):
+        # a thin triangle in the north east quarter
+        region = {"type": "Feature", "geometry": {
+            "type": "Polygon",
+            "coordinates": [[[10, 10], [170, 10], [10, 80], [10, 10]]]}}
+        tiles = list(iter_region_tiles(region, 1, 1))
+        self.assertEqual(tiles, [(1, 1, 1)])
+        tiles = list(iter_region_tiles(region, 2, 2))
+        self.assertNotIn((2, 3, 3), tiles)
+        self.assertIn((2, 2, 3), tiles)
+        self.assertIn((2, 3, 2), tiles)
+
+    def test_seeder_downloader(self):
+        seeder = RegionSeeder(self.source, (-10, -10, 10, 10), 0, 2,
+                              workers=8)
+        self.assertEqual(seeder.downloader.max_per_host, 8)
+        seeder.downloader.stop()
+
+    def test_seed_and_resume(self):
+        stats = self.source.seed_region(
+            (-10, -10, 10, 10), 0, 2, workers=3, rate=1000)
+        self.assertEqual(stats["total"], 9)
+        self.assertEqual(stats["done"], 9)
+        self.assertEqual(len(TileHandler.requests), 9)
+        # tile y is flipped in the url
+        self.assertIn("/1/0/0.png", TileHandler.requests)
+        fn = self.source.get_cache_fn(1, 0, 1)
+        with open(fn, "rb") as fd:
+            self.assertEqual(fd.read(), b"/1/0/0.png")
+
+        manifest = os.path.join(self.tmpdir, "seed.seed.json")
+        with open(manifest) as fd:
+            self.assertEqual(len(json.load(fd)["done"]), 9)
+
+        stats = self.source.seed_region((-10, -10, 10, 10), 0, 3)
+        self.assertEqual(stats["skipped"], 9)
+        self.assertEqual(stats["done"], 4)
+        self.assertEqual(len(TileHandler.requests), 13)
+
+    def test_seed_failures(self):
+        source = MapSource(
+            url="http://127.0.0.1:{}/missing/{{z}}/{{x}}/{{y}}.png".format(
+                self.server.server_port),
+            cache_key="missing", cache_dir=self.tmpdir)
+        seeder = RegionSeeder(source, (-10, -10, 10, 10), 0, 1)
+        stats = seeder.run()
+        self.assertEqual(stats["failed"], 5)
+        self.assertEqual(len(stats["failed_tiles"]), 5)
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()
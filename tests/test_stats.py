@@ -0,0 +1,60 @@
+import unittest
+from mapview.stats import Stats, Histogram
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_disabled(self):
+        stats = Stats(enabled=False)
+        stats.incr("cache.disk")
+        stats.observe("download.latency_ms", 12)
+        self.assertEqual(stats.counters, {})
+        self.assertEqual(stats.histograms, {})
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 10))
+        for value in (.5, 5, 50, 7):
+            histogram.observe(value)
+        data = histogram.as_dict()
+        self.assertEqual(data["count"], 4)
+        self.assertEqual(data["min"], .5)
+        self.assertEqual(data["max"], 50)
+        self.assertEqual(data["buckets"], {"1": 1, "10": 2, "inf": 1})
+
+    def test_export(self):
+        stats = Stats(enabled=True)
+        stats.incr("cache.disk", 3)
+        stats.incr("cache.network")
+        stats.observe("tile.decode_ms", 2)
+        pushed = []
+        stats.add_sink(pushed.append)
+        data = stats.push(reset=True)
+        self.assertEqual(pushed, [data])
+        self.assertEqual(data["counters"],
+                         {"cache.disk": 3, "cache.network": 1})
+        self.assertEqual(data["cache_hit_ratio"], .75)
+        self.assertEqual(data["histograms"]["tile.decode_ms"]["count"], 1)
+        self.assertEqual(stats.counters, {})
+        stats.incr("cache.memory")
+        stats.incr("cache.network")
+        self.assertEqual(stats.get_hit_ratio(), .5)
+
+    def test_mapview(self):
+        from mapview import MapView
+        from mapview.view import MarkerMapLayer
+        mapview = MapView(zoom=3, size=(512, 512))
+        mapview._pause = True
+        mapview.stats = Stats(enabled=True)
+        layer = MarkerMapLayer()
+        mapview.add_layer(layer)
+        mapview.add_layer(MarkerMapLayer(name="markers"))
+        mapview.do_update(0)
+        histograms = mapview.stats.histograms
+        self.assertEqual(histograms["mapview.update_ms"].count, 1)
+        self.assertEqual(histograms["layer.markers.reposition_ms"].count, 1)
+        self.assertEqual(histograms["layer.MarkerMapLayer-{:x}.reposition_ms"
+                                    .format(id(layer))].count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+from mapview import MapView
+from mapview.trace import Tracer, TileTimeline, tracer
+
+
+class TraceTest(unittest.TestCase):
+
+    def test_hooks(self):
+        events = []
+
+        def hook(*args):
+            events.append(args)
+
+        tracer = Tracer()
+        tracer.emit("requested", "osm", 1, 2, 3)
+        tracer.add_hook(hook)
+        tracer.emit("requested", "osm", 1, 2, 3)
+        tracer.remove_hook(hook)
+        tracer.emit("visible", "osm", 1, 2, 3)
+        self.assertEqual(len(events), 1)
+        event, key, timestamp = events[0]
+        self.assertEqual((event, key), ("requested", ("osm", 1, 2, 3)))
+
+    def test_timeline(self):
+        a, b = ("osm", 1, 0, 0), ("osm", 1, 0, 1)
+        timeline = TileTimeline()
+        for timestamp, event, key in (
+                (10., "requested", a), (10.1, "requested", b),
+                (10.2, "network-start", a), (10.3, "network-start", b),
+                (10.5, "network-end", a), (10.6, "network-end", b),
+                (10.7, "visible", a), (11., "evicted", b)):
+            timeline(event, key, timestamp)
+        self.assertAlmostEqual(timeline.get_time_to_viewport(), 1.)
+        self.assertIsNone(timeline.get_time_to_viewport(since=10.8))
+        self.assertEqual(timeline.get_wasted(), [b])
+        self.assertEqual(len(timeline.get_events(a)), 4)
+        # a download still in flight when its tile is evicted
+        timeline.clear()
+        for timestamp, event in ((1., "requested"), (2., "network-start"),
+                                 (3., "evicted"), (4., "network-end")):
+            timeline(event, a, timestamp)
+        self.assertEqual(timeline.get_wasted(), [a])
+
+    def test_view_events(self):
+        """
+        Makes sure the view traces the lifecycle of its tiles.
+        """
+        timeline = TileTimeline()
+        tracer.add_hook(timeline)
+        try:
+            mapview = MapView(zoom=3, size=(512, 512), animation_duration=0)
+            mapview._pause = True
+            mapview.fallback_zoom_levels = 0
+            mapview.load_tile(1, 2, 256, 3)
+            mapview._tiles[(3, 1, 2)][0].set_source("tile.png")
+            mapview.remove_all_tiles()
+        finally:
+            tracer.remove_hook(timeline)
+        key = (mapview.map_source.cache_key, 3, 1, 2)
+        self.assertEqual(
+            [event for timestamp, event, k in timeline.get_events(key)],
+            ["requested", "decoded", "uploaded", "visible", "evicted"])
+
+    def test_zoom_events(self):
+        """
+        Makes sure the tiles given up by a zoom are traced as evicted.
+        """
+        timeline = TileTimeline()
+        tracer.add_hook(timeline)
+        try:
+            mapview = MapView(zoom=3, size=(512, 512), animation_duration=0)
+            mapview._pause = True
+            mapview.fallback_zoom_levels = 0
+            mapview.load_tile(1, 2, 256, 3)
+            mapview.load_tile(2, 2, 256, 3)
+            mapview._tiles[(3, 2, 2)][0].set_source("tile.png")
+            mapview._zoom = 4
+            mapview.move_tiles_to_background()
+            self.assertIsNotNone(timeline.get_time_to_viewport())
+            mapview.remove_all_tiles()
+        finally:
+            tracer.remove_hook(timeline)
+        cache_key = mapview.map_source.cache_key
+        for x in (1, 2):
+            events = [event for timestamp, event, k
+                      in timeline.get_events((cache_key, 3, x, 2))]
+            self.assertEqual(events[-1], "evicted")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import zlib
+from mapview.vectortile import decode_tile, VectorMBTilesMapSource
+
+
+def varint(value):
+    out = bytearray()
+    while True:
+        b = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+
+def field(number, wire_type, payload):
+    key = varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + varint(payload)
+    return key + varint(len(payload)) + payload
+
+
+def packed(values):
+    return b"".join(varint(v) for v in values)
+
+
+def zigzag(value):
+    return (value << 1) ^ (value >> 31)
+
+
+def gzip(data):
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def encode_tile():
+    # one layer "water", with a square polygon and a string property
+    square = [
+        (1 << 3) | 1, zigzag(0), zigzag(0),
+        (3 << 3) | 2, zigzag(4096), zigzag(0), zigzag(0), zigzag(4096),
+        zigzag(-4096), zigzag(0),
+        (1 << 3) | 7]
+    feature = (field(2, 2, packed([0, 0])) + field(3, 0, 3) +
+               field(4, 2, packed(square)))
+    layer = (field(15, 0, 2) + field(1, 2, b"water") +
+             field(2, 2, feature) + field(3, 2, b"class") +
+             field(4, 2, field(1, 2, b"lake")) + field(5, 0, 4096))
+    return field(3, 2, layer)
+
+
+class Tile(object):
+    def __init__(self, zoom, tile_x, tile_y):
+        self.zoom = zoom
+        self.tile_x = tile_x
+        self.tile_y = tile_y
+        self.state = "loading"
+        self.texture = None
+
+
+class VectorTileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "vector.mbtiles")
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TABLE metadata (name text, value text)")
+        db.execute("CREATE TABLE tiles (zoom_level integer, "
+                   "tile_column integer, tile_row integer, tile_data blob)")
+        db.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("format", "pbf"), ("minzoom", "0"), ("maxzoom", "2")])
+        db.execute("INSERT INTO tiles VALUES (2, 1, 1, ?)",
+                   (sqlite3.Binary(gzip(encode_tile())), ))
+        db.commit()
+        db.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_decode_tile(self):
+        layers = decode_tile(encode_tile())
+        extent, features = layers["water"]
+        self.assertEqual(extent, 4096)
+        geom_type, properties, rings = features[0]
+        self.assertEqual(geom_type, 3)
+        self.assertEqual(properties, {"class": "lake"})
+        self.assertEqual(rings, [[0, 0, 4096, 0, 4096, 4096, 0, 4096, 0, 0]])
+
+    def test_overzoom_reuses_ancestor(self):
+        source = VectorMBTilesMapSource(self.filename,
+                                        cache_dir=self.tmpdir)
+        self.assertEqual(source.data_max_zoom, 2)
+        self.assertEqual(source.max_zoom, 22)
+        callback, args = source._load_tile(Tile(2, 1, 1))
+        tile, buffers, dz, ox, oy = args
+        self.assertEqual((dz, ox, oy), (0, 0, 0))
+        self.assertEqual(buffers[0][0], "mesh")
+
+        callback, args = source._load_tile(Tile(4, 7, 6))
+        self.assertIs(args[1], buffers)
+        self.assertEqual(args[2:], (2, 3, 2))
+
+    def test_missing_tile(self):
+        source = VectorMBTilesMapSource(self.filename,
+                                        cache_dir=self.tmpdir)
+        tile = Tile(2, 0, 0)
+        # given up on the main thread
+        callback, args = source._load_tile(tile)
+        self.assertEqual(tile.state, "loading")
+        callback(*args)
+        self.assertEqual(tile.state, "done")
+
+
+if __name__ == '__main__':
+    import unittest
+    unittest.main()